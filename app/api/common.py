@@ -1,4 +1,5 @@
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.http import parse_etags, parse_http_date_safe
 from rest_framework import exceptions
 import os
 import re
@@ -60,4 +61,22 @@ def get_asset_download_filename(task, asset):
 
     filename = re.sub(r'[^0-9a-zA-Z-_]+', '', name.replace(" ", "-").replace("/", "-")) + ("-" if name else "") + asset
     filename = re.sub(r'-[-]+', '-', filename)
-    return filename
\ No newline at end of file
+    return filename
+
+
+def is_not_modified(request, etag, last_modified=None):
+    """
+    Whether a GET can be answered with 304 Not Modified, given the ETag and
+    last modification time (a timestamp) of the resource
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        # If-Modified-Since is ignored when If-None-Match is present
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.replace('W/', '') in [e.replace('W/', '') for e in etags]
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE') or '')
+    if if_modified_since is not None and last_modified is not None:
+        return int(last_modified) <= if_modified_since
+
+    return False
@@ -4,6 +4,9 @@
 
 import re
 from functools import lru_cache
+import numpy as np
+import numexpr as ne
+from numexpr.necompiler import evaluate_lock, getContext, getExprNames
 from django.utils.translation import gettext_lazy as _
 
 algos = {
@@ -184,6 +187,52 @@ def lookup_formula(algo, band_order = 'RGB'):
 
     return expr, hrange
 
+class CompiledFormula:
+    """
+    A band math expression (see lookup_formula), parsed and compiled to
+    numexpr programs once: one program per comma separated block, over the
+    bands of the block in float32.
+    """
+    def __init__(self, expr):
+        self.expr = expr
+        self.blocks = [b.strip() for b in expr.lower().split(",")]
+        self.indexes = tuple(sorted(set(int(b) for b in re.findall(r"\bb([0-9]{1,2})\b", self.expr.lower()))))
+
+        self.programs = []
+        for block in self.blocks:
+            try:
+                names, uses_vml = getExprNames(block, getContext({}))
+                bands = [self.indexes.index(int(n[1:])) for n in names]
+
+                # float is float32 in numexpr
+                program = ne.NumExpr(block, signature=[(n, float) for n in names])
+            except Exception as e:
+                raise ValueError("Invalid expression \"{}\": {}".format(block, e))
+            self.programs.append((program, bands, uses_vml))
+
+    def evaluate(self, data):
+        """
+        Evaluate the expression on data, an array of the bands of indexes
+        (bands x rows x cols). Returns a float32 array of the blocks
+        (blocks x rows x cols), with NaN and infinite values replaced (like
+        rio-tiler expressions).
+        """
+        data = np.asarray(data)
+        out = np.empty((len(self.programs),) + data.shape[1:], dtype=np.float32)
+
+        # Same lock as numexpr.evaluate, the virtual machine is shared
+        with evaluate_lock:
+            for i, (program, bands, uses_vml) in enumerate(self.programs):
+                # Bands are cast to float32 by blocks, while evaluating
+                program(*[data[b] for b in bands], out=out[i], order='K',
+                        casting='unsafe', ex_uses_vml=uses_vml)
+
+        return np.nan_to_num(out, copy=False)
+
+@lru_cache(maxsize=100)
+def compile_formula(expr):
+    return CompiledFormula(expr)
+
 @lru_cache(maxsize=2)
 def get_algorithm_list(max_bands=3):
     res = []
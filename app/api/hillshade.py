@@ -1,10 +1,12 @@
 # Based on matplotlib https://github.com/matplotlib/matplotlib/blob/master/LICENSE/LICENSE
 # Copyright (c)
 # 2012- Matplotlib Development Team; All Rights Reserved
-# Description of changes: Factored out hillshading code
+# Description of changes: Factored out hillshading code, intensity computed
+# from the gradients in float32 without normal vectors
 
 
 import numpy as np
+import numexpr as ne
 
 def _vector_magnitude(arr):
     # things that don't work here:
@@ -38,12 +40,13 @@ class LightSource:
         ])
 
 
-    def hillshade(self, elevation, vert_exag=1, dx=1, dy=1, fraction=1.):
+    def hillshade(self, elevation, vert_exag=1, dx=1, dy=1, fraction=1., out=None,
+                  intensity_range=None):
         """
         Calculates the illumination intensity for a surface using the defined
         azimuth and elevation for the light source.
-        This computes the normal vectors for the surface, and then passes them
-        on to `shade_normals`
+        The intensity is computed straight from the gradients of the surface,
+        in float32 (see `hillshade_normals` for the normal vectors version)
         Parameters
         ----------
         elevation : array-like
@@ -65,16 +68,61 @@ class LightSource:
             full illumination or shadow (and clipping any values that move
             beyond 0 or 1). Note that this is not visually or mathematically
             the same as vertical exaggeration.
+        out : ndarray, optional
+            A float32 array of the shape of *elevation* to store the result in.
+        intensity_range : tuple, optional
+            The (min, max) `illumination` of the whole surface, when *elevation*
+            is a part of it. Computed from *elevation* by default.
         Returns
         -------
         intensity : ndarray
-            A 2d array of illumination values between 0-1, where 0 is
+            A 2d float32 array of illumination values between 0-1, where 0 is
             completely in shadow and 1 is completely illuminated.
         """
 
+        if np.ma.isMaskedArray(elevation):
+            return self.hillshade_normals(elevation, vert_exag, dx, dy, fraction)
+
+        out = self.illumination(elevation, vert_exag, dx, dy, out)
+
+        return self.stretch_illumination(out, fraction, intensity_range)
+
+    def illumination(self, elevation, vert_exag=1, dx=1, dy=1, out=None):
+        """
+        The illumination of the surface before the contrast stretch of
+        `hillshade`, between -1 and 1 (float32)
+        """
+
         # Because most image and raster GIS data has the first row in the array
         # as the "top" of the image, dy is implicitly negative.  This is
         # consistent to what `imshow` assumes, as well.
+        e_dy, e_dx = np.gradient(np.asarray(elevation, dtype=np.float32), -dy, dx)
+
+        # The dot product of the light direction with the unit normal vectors
+        # (-e_dx, -e_dy, 1) / |(-e_dx, -e_dy, 1)|, in a single pass
+        d0, d1, d2 = self.direction.astype(np.float32)
+        if out is None:
+            out = np.empty(e_dx.shape, dtype=np.float32)
+
+        ne.evaluate("(d2 - d0 * ve * gx - d1 * ve * gy) / sqrt((ve * gx) ** 2 + (ve * gy) ** 2 + 1)",
+                    local_dict={'gx': e_dx, 'gy': e_dy, 've': np.float32(vert_exag),
+                                'd0': d0, 'd1': d1, 'd2': d2},
+                    out=out, casting='same_kind')
+
+        return out
+
+    def stretch_illumination(self, illumination, fraction=1., intensity_range=None):
+        """
+        The intensity of `hillshade` from an `illumination` computed
+        beforehand (e.g. over a larger surface), stretched in place
+        """
+        return _stretch_intensity(illumination, fraction, intensity_range)
+
+    def hillshade_normals(self, elevation, vert_exag=1, dx=1, dy=1, fraction=1.):
+        """
+        Same as `hillshade`, through the normal vectors of the surface (in
+        float64). Keeps the mask of masked arrays.
+        """
         dy = -dy
 
         # compute the normal vectors from the partial derivatives
@@ -114,20 +162,26 @@ class LightSource:
 
         intensity = normals.dot(self.direction)
 
-        # Apply contrast stretch
+        return _stretch_intensity(intensity, fraction)
+
+
+def _stretch_intensity(intensity, fraction, intensity_range=None):
+    # Apply contrast stretch
+    if intensity_range is None:
         imin, imax = intensity.min(), intensity.max()
-        intensity *= fraction
-
-        # Rescale to 0-1, keeping range before contrast stretch
-        # If constant slope, keep relative scaling (i.e. flat should be 0.5,
-        # fully occluded 0, etc.)
-        if (imax - imin) > 1e-6:
-            # Strictly speaking, this is incorrect. Negative values should be
-            # clipped to 0 because they're fully occluded. However, rescaling
-            # in this manner is consistent with the previous implementation and
-            # visually appears better than a "hard" clip.
-            intensity -= imin
-            intensity /= (imax - imin)
-        intensity = np.clip(intensity, 0, 1)
-
-        return intensity
\ No newline at end of file
+    else:
+        imin, imax = intensity_range
+    intensity *= fraction
+
+    # Rescale to 0-1, keeping range before contrast stretch
+    # If constant slope, keep relative scaling (i.e. flat should be 0.5,
+    # fully occluded 0, etc.)
+    if (imax - imin) > 1e-6:
+        # Strictly speaking, this is incorrect. Negative values should be
+        # clipped to 0 because they're fully occluded. However, rescaling
+        # in this manner is consistent with the previous implementation and
+        # visually appears better than a "hard" clip.
+        intensity -= imin
+        intensity /= (imax - imin)
+
+    return np.clip(intensity, 0, 1, out=intensity)
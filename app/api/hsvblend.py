@@ -92,11 +92,42 @@ def hsv_to_rgb( hsv ):
     return rgb
 
 
-def hsv_blend(rgb, intensity):
+def hsv_blend(rgb, intensity, out=None):
+    """
+    Replace the value (brightness) of the rgb pixels with intensity [0,255]
+
+    Hue and saturation do not depend on the value, so the blend is a scaling
+    of each pixel by intensity / max(r,g,b), without going through HSV.
+    Black pixels (no hue nor saturation) become gray. The result is written
+    in out (a uint8 array of the shape of rgb, can be rgb itself).
+    """
+    if out is None:
+        out = np.empty((3,) + intensity.shape, dtype=np.uint8)
+
+    maxc = np.maximum(rgb[0], rgb[1])
+    np.maximum(maxc, rgb[2], out=maxc)
+    black = maxc == 0
+
+    scale = np.zeros(intensity.shape, dtype=np.float32)
+    np.divide(intensity, maxc, out=scale, where=~black)
+
+    channel = np.empty(intensity.shape, dtype=np.float32)
+    for i in range(3):
+        np.multiply(rgb[i], scale, out=channel)
+        np.copyto(channel, intensity, where=black)
+        np.copyto(out[i], channel, casting='unsafe')
+
+    return out
+
+
+def hsv_blend_legacy(rgb, intensity):
+    """
+    hsv_blend through the conversion to HSV and back
+    """
     hsv = rgb_to_hsv(rgb[0], rgb[1], rgb[2])
 
     #replace v with hillshade
     hsv_adjusted = np.asarray( [hsv[0], hsv[1], intensity] )
 
     #convert back to RGB
-    return hsv_to_rgb( hsv_adjusted )
\ No newline at end of file
+    return hsv_to_rgb( hsv_adjusted )
@@ -178,10 +178,10 @@ class ImageDownload(TaskNestedView):
         task = self.get_and_check_task(request, pk)
 
         assets_manager = TaskAssetsManager(task)
-        image_stream = assets_manager.get_image_stream(image_filename)
-        if not image_stream:
+        image_source = assets_manager.open_image(image_filename)
+        if not image_source:
             raise exceptions.NotFound()
 
         return download_file_stream(
-            request, image_stream, "attachment", os.path.basename(image_filename)
+            request, image_source, "attachment", os.path.basename(image_filename)
         )
@@ -7,6 +7,7 @@ import shutil
 import mimetypes
 
 from shutil import copyfileobj
+from urllib.parse import quote
 from django.core.exceptions import (
     ObjectDoesNotExist,
     SuspiciousFileOperation,
@@ -14,7 +15,13 @@ from django.core.exceptions import (
 )
 from django.core.files.uploadedfile import InMemoryUploadedFile, UploadedFile
 from django.db import transaction
-from django.http import HttpResponse
+from django.http import (
+    FileResponse,
+    HttpResponse,
+    HttpResponseNotModified,
+    StreamingHttpResponse,
+)
+from django.utils.http import http_date, parse_http_date_safe
 from rest_framework import (
     status,
     serializers,
@@ -30,14 +37,28 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from app import models, pending_actions, task_asset_status, task_asset_type
-from app.classes.task_assets_manager import TaskAssetsManager
-from app.utils.file_utils import get_file_name
+from app.classes.task_assets_manager import (
+    TaskAssetsManager,
+    LocalAssetSource,
+    get_chunk_size,
+)
+from app.utils.http_range import (
+    parse_range_header,
+    format_content_range,
+    multipart_byteranges,
+)
+from app.classes.s3_zip_stream import S3ZipStream, zip_members
+from app.utils.file_utils import ensure_path_exists, get_file_name
 from app.utils.request_files_utils import save_request_file
 from app.security import path_traversal_check
 from nodeodm import status_codes
 from nodeodm.models import ProcessingNode
 from worker import tasks as worker_tasks
-from .common import get_and_check_project, get_asset_download_filename
+from .common import (
+    get_and_check_project,
+    get_asset_download_filename,
+    is_not_modified,
+)
 from .tags import TagsField
 from django.utils.translation import gettext_lazy as _
 from webodm import settings
@@ -508,15 +529,69 @@ class TaskNestedView(APIView):
         return task
 
 
-def download_file_stream(request, stream, content_disposition, download_filename=None):
-    response = HttpResponse(
-        stream,
-        content_type=(mimetypes.guess_type(download_filename)[0] or "application/zip"),
-    )
+def download_file_stream(request, source, content_disposition, download_filename=None):
+    """
+    Stream an asset source of TaskAssetsManager without buffering it, honoring
+    conditional (If-None-Match, If-Modified-Since) and Range requests
+    """
+    content_type = mimetypes.guess_type(download_filename)[0] or "application/zip"
 
-    response["Content-Type"] = (
-        mimetypes.guess_type(download_filename)[0] or "application/zip"
-    )
+    if is_not_modified(request, source.etag, source.last_modified):
+        response = HttpResponseNotModified()
+        _set_validator_headers(response, source)
+        return response
+
+    x_accel_redirect_path = _x_accel_redirect_path(source)
+
+    if x_accel_redirect_path:
+        # Only authorize here, nginx serves the file (ranges included)
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = x_accel_redirect_path
+        response["Content-Disposition"] = "{}; filename={}".format(
+            content_disposition, download_filename
+        )
+        return response
+
+    ranges = None
+
+    if _if_range_matches(request, source):
+        ranges = parse_range_header(request.META.get("HTTP_RANGE"), source.size)
+
+    if ranges is not None and len(ranges) == 0:
+        response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        response["Content-Range"] = "bytes */{}".format(source.size)
+        return response
+
+    if ranges is None and isinstance(source, LocalAssetSource):
+        # Lets the WSGI server send the file with sendfile
+        response = FileResponse(source.open_file(), content_type=content_type)
+        response.block_size = get_chunk_size(source.size)
+        response["Content-Length"] = source.size
+    elif ranges is None:
+        response = StreamingHttpResponse(source.stream(), content_type=content_type)
+        response["Content-Length"] = source.size
+    elif len(ranges) == 1:
+        first, last = ranges[0]
+        response = StreamingHttpResponse(
+            source.stream(first, last),
+            status=status.HTTP_206_PARTIAL_CONTENT,
+            content_type=content_type,
+        )
+        response["Content-Length"] = last - first + 1
+        response["Content-Range"] = format_content_range(first, last, source.size)
+    else:
+        multipart_content_type, length, body = multipart_byteranges(
+            ranges, source.size, content_type, source.stream
+        )
+        response = StreamingHttpResponse(
+            body,
+            status=status.HTTP_206_PARTIAL_CONTENT,
+            content_type=multipart_content_type,
+        )
+        response["Content-Length"] = length
+
+    _set_validator_headers(response, source)
+    response["Accept-Ranges"] = "bytes"
     response["Content-Disposition"] = "{}; filename={}".format(
         content_disposition, download_filename
     )
@@ -527,6 +602,59 @@ def download_file_stream(request, stream, content_disposition, download_filename
     return response
 
 
+def download_zip_stream(members, download_filename):
+    """
+    Stream a zip archive of zip_members as it is written, nothing is staged on
+    disk (its size is not known ahead, there is no Content-Length)
+    """
+    if len(members) == 0:
+        raise exceptions.NotFound(_("Asset does not exist"))
+
+    response = StreamingHttpResponse(
+        S3ZipStream(members), content_type="application/zip"
+    )
+    response["Content-Disposition"] = "attachment; filename={}".format(
+        download_filename
+    )
+
+    return response
+
+
+def _x_accel_redirect_path(source):
+    if not settings.DOWNLOADS_X_ACCEL_REDIRECT or not isinstance(
+        source, LocalAssetSource
+    ):
+        return None
+
+    media_path = os.path.relpath(source.path, settings.MEDIA_ROOT)
+
+    if media_path.startswith(".."):
+        return None
+
+    source.record_access()
+
+    return settings.DOWNLOADS_X_ACCEL_PREFIX + quote(media_path)
+
+
+def _set_validator_headers(response, source):
+    response["ETag"] = source.etag
+    response["Last-Modified"] = http_date(source.last_modified)
+
+
+def _if_range_matches(request, source):
+    if_range = request.META.get("HTTP_IF_RANGE")
+
+    if not if_range:
+        return True
+
+    if if_range.startswith('"') or if_range.startswith("W/"):
+        return if_range == source.etag
+
+    if_range_date = parse_http_date_safe(if_range)
+
+    return if_range_date is not None and int(source.last_modified) <= if_range_date
+
+
 """
 Task downloads are simply aliases to download the task's assets
 (but require a shorter path and look nicer the API user)
@@ -546,14 +674,14 @@ class TaskDownloads(TaskNestedView):
 
         # Verificar se é um pedido para DZI
         if asset.startswith("foto_giga") and asset.endswith(".dzi"):
-            asset_stream = asset_manager.get_asset_stream(task.assets_path(asset))
+            asset_source = asset_manager.open_asset(task.assets_path(asset))
 
-            if not asset_stream:
+            if not asset_source:
                 raise exceptions.NotFound(_("Asset does not exist"))
 
             content_disposition = "inline; filename={}".format(os.path.basename(asset))
             return download_file_stream(
-                request, asset_stream, content_disposition, get_file_name(asset)
+                request, asset_source, content_disposition, get_file_name(asset)
             )
 
         download_filename = request.GET.get(
@@ -561,6 +689,18 @@ class TaskDownloads(TaskNestedView):
         )
 
         if task.is_asset_a_zip(asset):
+            if request.GET.get("stream") == "true":
+                asset_zip = task.ASSETS_MAP[asset]
+                zip_dir = os.path.abspath(
+                    task.assets_path(asset_zip["deferred_compress_dir"])
+                )
+                return download_zip_stream(
+                    zip_members(
+                        task, zip_dir, asset_zip.get("deferred_exclude_files", tuple())
+                    ),
+                    download_filename,
+                )
+
             celery_task_id = worker_tasks.generate_zip_from_asset.delay(
                 pk, asset
             ).task_id
@@ -576,13 +716,13 @@ class TaskDownloads(TaskNestedView):
         except FileNotFoundError:
             raise exceptions.NotFound(_("Asset does not exist"))
 
-        asset_stream = asset_manager.get_asset_stream(asset_fs)
-        if not asset_stream:
+        asset_source = asset_manager.open_asset(asset_fs)
+        if not asset_source:
             raise exceptions.NotFound(_("Asset does not exist"))
 
         content_disposition = "attachment; filename={}".format(download_filename)
         return download_file_stream(
-            request, asset_stream, content_disposition, get_file_name(asset)
+            request, asset_source, content_disposition, get_file_name(asset)
         )
 
 
@@ -611,7 +751,7 @@ class TaskAssets(TaskNestedView):
             raise exceptions.NotFound(_("Asset does not exist"))
 
         asset_manager = TaskAssetsManager(task)
-        asset = asset_manager.get_asset_stream(asset_path)
+        asset = asset_manager.open_asset(asset_path)
 
         if not asset:
             raise exceptions.NotFound(_("Asset does not exist"))
@@ -701,6 +841,15 @@ class TaskBackup(TaskNestedView):
         Downloads a task's backup
         """
         task = self.get_and_check_task(request, pk)
+        download_filename = request.GET.get(
+            "filename", get_asset_download_filename(task, "backup.zip")
+        )
+
+        if request.GET.get("stream") == "true":
+            ensure_path_exists(task.task_path("data"))
+            task.write_backup_file()
+            zip_dir = os.path.abspath(task.task_path(""))
+            return download_zip_stream(zip_members(task, zip_dir), download_filename)
 
         # Check and download
         try:
@@ -708,10 +857,6 @@ class TaskBackup(TaskNestedView):
         except FileNotFoundError:
             raise exceptions.NotFound(_("Asset does not exist"))
 
-        download_filename = request.GET.get(
-            "filename", get_asset_download_filename(task, "backup.zip")
-        )
-
         return Response(
             {"celery_task_id": celery_task_id, "filename": download_filename},
             status=status.HTTP_200_OK,
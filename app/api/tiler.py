@@ -1,39 +1,67 @@
 import json
+import os
+import time
 import rasterio
 from rasterio.errors import NotGeoreferencedWarning
 from rasterio.enums import ColorInterp
-from rasterio.crs import CRS
-from rasterio.features import bounds as featureBounds
 from rio_tiler.errors import TileOutsideBounds, InvalidColorMapName, AlphaBandWarning
+from rio_tiler.models import ImageData
 from rio_tiler.utils import (
     has_alpha_band,
     non_alpha_indexes,
     render,
-    create_cutline,
     apply_cmap,
-    _stats as raster_stats,
 )
-from rio_tiler.models import ImageStatistics
-from rio_tiler.models import Metadata as RioMetadata
 from rio_tiler.profiles import img_profiles
 from rio_tiler.colormap import cmap as colormap
 import numpy as np
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
 from django.utils.translation import gettext as _
 from rest_framework import exceptions
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 import urllib
 import warnings
-from .common import get_asset_download_filename
+from contextlib import ExitStack
+from .common import get_asset_download_filename, is_not_modified
 from .custom_colormaps_helper import custom_colormaps
 from app.raster_utils import extension_for_export_format, ZOOM_EXTRA_LEVELS
 from .hsvblend import hsv_blend
 from .hillshade import LightSource
-from .formulas import lookup_formula, get_algorithm_list, get_auto_bands
+from .formulas import (
+    lookup_formula,
+    get_algorithm_list,
+    get_auto_bands,
+    compile_formula,
+)
 from .tasks import TaskNestedView
 from worker.tasks import export_raster, export_pointcloud
-from app.utils.s3_utils import open_cog_reader, append_s3_bucket_prefix
+from app.classes.tile_cache import tile_cache, CachedTile, get_tile_etag
+from app.classes.tile_phases import tile_phase
+from app.classes.cutline_cache import cutline_cache
+from app.classes.export_registry import export_registry
+from app.classes.task_assets_manager import TaskAssetsManager
+from app.classes.tile_pyramid import (
+    get_pyramid_tile,
+    get_tile_format,
+    matches_pyramid_params,
+    write_tile_pyramid,
+)
+from app.raster_statistics import get_raster_metadata
+from app.utils.s3_utils import (
+    open_cog_reader,
+    append_s3_bucket_prefix,
+    get_cog_version,
+)
+from worker.utils.redis_file_cache import record_file_access
+from webodm import settings
+
+# Requests for the tiles of a metatile being rendered wait at most this long
+METATILE_LOCK_TIMEOUT = 30
+
+# Tile pyramids only on S3 are brought to the local cache at most this often
+PYRAMID_DOWNLOAD_INTERVAL = 300
+_pyramid_downloads = {}
 
 
 # Disable specific warnings
@@ -95,6 +123,36 @@ def get_pointcloud_path(task):
     return append_s3_bucket_prefix(path)
 
 
+def start_export(task, asset_type, url, opts, start):
+    """
+    Id of the celery task exporting an asset with the given options: an
+    identical export in progress or completed, or a new one started with
+    start(celery_task_id)
+    """
+    key = None
+    if export_registry.enabled:
+        asset_version = get_cog_version(url)
+
+        if asset_version is not None:
+            key = export_registry.make_key(task.id, asset_type, asset_version, opts)
+
+    return export_registry.get_or_start(key, start)
+
+
+def tile_response(request, tile, cache_status=None):
+    if is_not_modified(request, tile.etag):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(tile.content, content_type=tile.content_type)
+
+    response["ETag"] = tile.etag
+
+    if cache_status is not None:
+        response["X-Tile-Cache"] = cache_status
+
+    return response
+
+
 class TileJson(TaskNestedView):
 
     # permission_classes = (IsAuthenticated,)
@@ -189,70 +247,20 @@ class Metadata(TaskNestedView):
 
         except ValueError as e:
             raise exceptions.ValidationError(str(e))
-        pmin, pmax = 2.0, 98.0
 
         url = get_raster_path(task, tile_type)
 
         try:
-            with open_cog_reader(url) as src:
-                band_count = src.dataset.meta["count"]
-                if boundaries_feature is not None:
-                    boundaries_cutline = create_cutline(
-                        src.dataset, boundaries_feature, CRS.from_string("EPSG:4326")
-                    )
-                    boundaries_bbox = featureBounds(boundaries_feature)
-                else:
-                    boundaries_cutline = None
-                    boundaries_bbox = None
-                if has_alpha_band(src.dataset):
-                    band_count -= 1
-                nodata = None
-                # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
-                if tile_type == "orthophoto":
-                    nodata = 0
-                histogram_options = {"bins": 255, "range": hrange}
-                if expr is not None:
-                    if boundaries_cutline is not None:
-                        data, mask = src.preview(
-                            expression=expr, vrt_options={"cutline": boundaries_cutline}
-                        )
-                    else:
-                        data, mask = src.preview(expression=expr)
-                    data = np.ma.array(data)
-                    data.mask = mask == 0
-                    stats = {
-                        str(b + 1): raster_stats(
-                            data[b], percentiles=(pmin, pmax), bins=255, range=hrange
-                        )
-                        for b in range(data.shape[0])
-                    }
-                    stats = {b: ImageStatistics(**s) for b, s in stats.items()}
-                    metadata = RioMetadata(statistics=stats, **src.info().dict())
-                else:
-                    if (boundaries_cutline is not None) and (
-                        boundaries_bbox is not None
-                    ):
-                        metadata = src.metadata(
-                            pmin=pmin,
-                            pmax=pmax,
-                            hist_options=histogram_options,
-                            nodata=nodata,
-                            bounds=boundaries_bbox,
-                            vrt_options={"cutline": boundaries_cutline},
-                        )
-                    else:
-                        metadata = src.metadata(
-                            pmin=pmin,
-                            pmax=pmax,
-                            hist_options=histogram_options,
-                            nodata=nodata,
-                        )
-                info = json.loads(metadata.json())
+            raster_metadata = get_raster_metadata(
+                task, url, tile_type, expr, hrange, boundaries_feature
+            )
         except IndexError as e:
             # Caught when trying to get invalid raster metadata
             raise exceptions.ValidationError(
                 "Cannot retrieve raster metadata: %s" % str(e)
             )
+        info = raster_metadata["info"]
+        band_count = raster_metadata["band_count"]
         # Override min/max
         if hrange:
             for b in info["statistics"]:
@@ -340,11 +348,621 @@ class Metadata(TaskNestedView):
             info["maxzoom"] = info["minzoom"]
         info["maxzoom"] += ZOOM_EXTRA_LEVELS
         info["minzoom"] -= ZOOM_EXTRA_LEVELS
-        info["bounds"] = {"value": src.bounds, "crs": src.dataset.crs}
+        info["bounds"] = raster_metadata["bounds"]
 
         return Response(info)
 
 
+def _get_tile_read_options(
+    src, tile_type, z, expr, nodata, hillshade, boundaries_feature
+):
+    """
+    Options of the reads of the tiles of a raster (src.tile or src.part), the
+    size of the buffer around the tiles and the max zoom of the raster
+    """
+    indexes = None
+
+    minzoom, maxzoom = get_zoom_safe(src)
+    has_alpha = has_alpha_band(src.dataset)
+    if z < minzoom - ZOOM_EXTRA_LEVELS or z > maxzoom + ZOOM_EXTRA_LEVELS:
+        raise exceptions.NotFound()
+    if boundaries_feature is not None:
+        try:
+            with tile_phase("cutline"):
+                boundaries_cutline, _discard_ = cutline_cache.get(
+                    src.dataset, boundaries_feature
+                )
+        except:
+            raise exceptions.ValidationError(_("Invalid boundaries"))
+    else:
+        boundaries_cutline = None
+    # Handle N-bands datasets for orthophotos (not plant health)
+    if tile_type == "orthophoto" and expr is None:
+        ci = src.dataset.colorinterp
+        # More than 4 bands?
+        if len(ci) > 4:
+            # Try to find RGBA band order
+            if (
+                ColorInterp.red in ci
+                and ColorInterp.green in ci
+                and ColorInterp.blue in ci
+            ):
+                indexes = (
+                    ci.index(ColorInterp.red) + 1,
+                    ci.index(ColorInterp.green) + 1,
+                    ci.index(ColorInterp.blue) + 1,
+                )
+            else:
+                # Fallback to first three
+                indexes = (
+                    1,
+                    2,
+                    3,
+                )
+        elif has_alpha:
+            indexes = non_alpha_indexes(src.dataset)
+
+    # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
+    if nodata is None and tile_type == "orthophoto":
+        nodata = 0
+
+    resampling = "nearest"
+    padding = 0
+    tile_buffer = None
+
+    if tile_type in ["dsm", "dtm"]:
+        resampling = "bilinear"
+        padding = 16
+
+    # Hillshading is not a local tile operation and
+    # requires neighbor tiles to be rendered seamlessly
+    if hillshade is not None:
+        tile_buffer = 16
+
+    options = {
+        "nodata": nodata,
+        "padding": padding,
+        "resampling_method": resampling,
+    }
+    if expr is not None:
+        options["indexes"] = compile_formula(expr).indexes
+    elif boundaries_cutline is None:
+        options["indexes"] = indexes
+    if boundaries_cutline is not None:
+        options["vrt_options"] = {"cutline": boundaries_cutline}
+
+    return options, tile_buffer, maxzoom
+
+
+def _apply_formula(image, expr):
+    """
+    Image of the values of a formula expression, from an image of the bands
+    of the expression (read with the options of _get_tile_read_options)
+    """
+    if expr is None:
+        return image
+
+    with tile_phase("formula"):
+        data = compile_formula(expr).evaluate(image.data)
+
+    return ImageData(
+        data,
+        image.mask,
+        assets=image.assets,
+        bounds=image.bounds,
+        crs=image.crs,
+    )
+
+
+def _get_hillshade_light_source(src, z, maxzoom, hillshade, band_count):
+    """
+    Light source and parameters of the hillshade of the tiles at zoom z
+    """
+    try:
+        hillshade = float(hillshade)
+        if hillshade <= 0:
+            hillshade = 1.0
+    except ValueError:
+        raise exceptions.ValidationError(_("Invalid hillshade value"))
+    if band_count != 1:
+        raise exceptions.ValidationError(
+            _("Cannot compute hillshade of non-elevation raster (multiple bands found)")
+        )
+    delta_scale = (maxzoom + ZOOM_EXTRA_LEVELS + 1 - z) * 4
+    dx = src.dataset.meta["transform"][0] * delta_scale
+    dy = -src.dataset.meta["transform"][4] * delta_scale
+
+    return LightSource(azdeg=315, altdeg=45), {
+        "dx": dx,
+        "dy": dy,
+        "vert_exag": hillshade,
+    }
+
+
+def _clear_buffer_corners(arr, tile_buffer, tilesize, value):
+    """
+    Remove the data of the corners of the edge buffer of a tile
+    (to keep intensity uniform across tiles)
+    """
+    arr[0:tile_buffer, 0:tile_buffer] = value
+    arr[tile_buffer + tilesize : tile_buffer * 2 + tilesize, 0:tile_buffer] = value
+    arr[0:tile_buffer, tile_buffer + tilesize : tile_buffer * 2 + tilesize] = value
+    arr[
+        tile_buffer + tilesize : tile_buffer * 2 + tilesize,
+        tile_buffer + tilesize : tile_buffer * 2 + tilesize,
+    ] = value
+
+
+def _encode_tile(
+    tile,
+    tilesize,
+    tile_buffer,
+    nodata,
+    rescale,
+    color_map,
+    ext,
+    accepts_webp,
+    hillshade=None,
+    illumination=None,
+):
+    """
+    Post process and encode a tile read with its buffer. hillshade is the
+    light source and parameters of the hillshade (see
+    _get_hillshade_light_source), illumination the illumination of the tile
+    (with its buffer) when it was computed beforehand.
+    Returns the content and content type of the tile.
+    """
+    if color_map:
+        try:
+            colormap.get(color_map)
+        except InvalidColorMapName:
+            raise exceptions.ValidationError(_("Not a valid color_map value"))
+
+    intensity = None
+    try:
+        rescale_arr = list(map(float, rescale.split(",")))
+    except ValueError:
+        raise exceptions.ValidationError(_("Invalid rescale value"))
+
+    # Auto?
+    if ext is None:
+        # Check for transparency
+        if np.equal(tile.mask, 255).all():
+            ext = "jpg"
+        else:
+            if accepts_webp:
+                ext = "webp"
+            else:
+                ext = "png"
+
+    driver = "jpeg" if ext == "jpg" else ext
+
+    options = img_profiles.get(driver, {})
+    if hillshade is not None:
+        ls, hillshade_params = hillshade
+
+        with tile_phase("hillshade"):
+            elevation = tile.data[0]
+            _clear_buffer_corners(elevation, tile_buffer, tilesize, nodata)
+
+            if illumination is None:
+                intensity = ls.hillshade(elevation, **hillshade_params)
+            else:
+                _clear_buffer_corners(illumination, tile_buffer, tilesize, nodata)
+                intensity = ls.stretch_illumination(illumination)
+
+            intensity = intensity[
+                tile_buffer : tile_buffer + tilesize,
+                tile_buffer : tile_buffer + tilesize,
+            ]
+
+    if intensity is not None:
+        with tile_phase("colormap"):
+            rgb = tile.post_process(in_range=(rescale_arr,))
+            rgb_data = rgb.data[
+                :,
+                tile_buffer : tilesize + tile_buffer,
+                tile_buffer : tilesize + tile_buffer,
+            ]
+            if color_map:
+                rgb, _discard_ = apply_cmap(rgb_data, colormap.get(color_map))
+            if rgb.data.shape[0] != 3:
+                raise exceptions.ValidationError(
+                    _(
+                        "Cannot process tile: intensity image provided, but no RGB data was computed."
+                    )
+                )
+            intensity *= 255.0
+            rgb = hsv_blend(rgb, intensity, out=rgb)
+        if rgb is not None:
+            mask = tile.mask[
+                tile_buffer : tilesize + tile_buffer,
+                tile_buffer : tilesize + tile_buffer,
+            ]
+            with tile_phase("encode"):
+                return (
+                    render(rgb, mask, img_format=driver, **options),
+                    "image/{}".format(ext),
+                )
+
+    with tile_phase("colormap"):
+        image = tile.post_process(in_range=(rescale_arr,))
+
+    # The color map of these tiles is applied while encoding
+    with tile_phase("encode"):
+        if color_map is not None:
+            return (
+                image.render(
+                    img_format=driver, colormap=colormap.get(color_map), **options
+                ),
+                "image/{}".format(ext),
+            )
+
+        return (
+            image.render(img_format=driver, **options),
+            "image/{}".format(ext),
+        )
+
+
+def render_tile(
+    url,
+    tile_type,
+    z,
+    x,
+    y,
+    expr=None,
+    rescale=None,
+    color_map=None,
+    hillshade=None,
+    tilesize=256,
+    nodata=None,
+    ext=None,
+    boundaries_feature=None,
+    accepts_webp=False,
+):
+    """
+    Render a tile of a task raster. Returns its content and content type.
+    """
+    with ExitStack() as stack:
+        with tile_phase("open"):
+            src = stack.enter_context(open_cog_reader(url))
+
+        with tile_phase("tile_exists"):
+            tile_exists = src.tile_exists(z, x, y)
+
+        if not tile_exists:
+            raise exceptions.NotFound(_("Outside of bounds"))
+
+        options, tile_buffer, maxzoom = _get_tile_read_options(
+            src, tile_type, z, expr, nodata, hillshade, boundaries_feature
+        )
+
+        try:
+            with tile_phase("read"):
+                tile = src.tile(
+                    x, y, z, tilesize=tilesize, tile_buffer=tile_buffer, **options
+                )
+        except TileOutsideBounds:
+            raise exceptions.NotFound(_("Outside of bounds"))
+
+        tile = _apply_formula(tile, expr)
+
+        if hillshade is not None:
+            hillshade = _get_hillshade_light_source(
+                src, z, maxzoom, hillshade, tile.data.shape[0]
+            )
+
+        return _encode_tile(
+            tile,
+            tilesize,
+            tile_buffer,
+            options["nodata"],
+            rescale,
+            color_map,
+            ext,
+            accepts_webp,
+            hillshade=hillshade,
+        )
+
+
+def render_metatile(
+    url,
+    tile_type,
+    z,
+    x,
+    y,
+    size,
+    expr=None,
+    rescale=None,
+    color_map=None,
+    hillshade=None,
+    tilesize=256,
+    nodata=None,
+    ext=None,
+    boundaries_feature=None,
+    accepts_webp=False,
+):
+    """
+    Render the size x size block of tiles of a task raster with x, y as its
+    top left tile, with a single read of the raster (and a single hillshade)
+    for the whole block. The tiles are the same as the ones of render_tile.
+
+    Returns the content and content type of the tiles of the block within the
+    raster, by (x, y).
+    """
+    with ExitStack() as stack:
+        with tile_phase("open"):
+            src = stack.enter_context(open_cog_reader(url))
+
+        with tile_phase("tile_exists"):
+            tiles = [
+                (tx, ty)
+                for ty in range(y, y + size)
+                for tx in range(x, x + size)
+                if src.tile_exists(z, tx, ty)
+            ]
+
+        if not tiles:
+            return {}
+
+        options, tile_buffer, maxzoom = _get_tile_read_options(
+            src, tile_type, z, expr, nodata, hillshade, boundaries_feature
+        )
+        buffer = tile_buffer or 0
+
+        # The block with its buffer, on the pixel grid of the tiles
+        left, _discard_, _discard_, top = src.tms.xy_bounds(x, y, z)
+        _discard_, bottom, right, _discard_ = src.tms.xy_bounds(
+            x + size - 1, y + size - 1, z
+        )
+        x_res = (right - left) / (size * tilesize)
+        y_res = (top - bottom) / (size * tilesize)
+        block_size = size * tilesize + 2 * buffer
+
+        try:
+            with tile_phase("read"):
+                block = src.part(
+                    (
+                        left - x_res * buffer,
+                        bottom - y_res * buffer,
+                        right + x_res * buffer,
+                        top + y_res * buffer,
+                    ),
+                    dst_crs=src.tms.crs,
+                    bounds_crs=None,
+                    height=block_size,
+                    width=block_size,
+                    max_size=None,
+                    **options,
+                )
+        except TileOutsideBounds:
+            return {}
+
+        block = _apply_formula(block, expr)
+
+        illumination = None
+        if hillshade is not None:
+            hillshade = _get_hillshade_light_source(
+                src, z, maxzoom, hillshade, block.data.shape[0]
+            )
+            ls, hillshade_params = hillshade
+
+            with tile_phase("hillshade"):
+                illumination = ls.illumination(block.data[0], **hillshade_params)
+
+    rendered = {}
+
+    for tx, ty in tiles:
+        row = (ty - y) * tilesize
+        col = (tx - x) * tilesize
+        window = (
+            slice(row, row + tilesize + 2 * buffer),
+            slice(col, col + tilesize + 2 * buffer),
+        )
+        tile = ImageData(
+            block.data[(slice(None),) + window].copy(),
+            block.mask[window].copy(),
+            crs=block.crs,
+        )
+
+        rendered[(tx, ty)] = _encode_tile(
+            tile,
+            tilesize,
+            tile_buffer,
+            options["nodata"],
+            rescale,
+            color_map,
+            ext,
+            accepts_webp,
+            hillshade=hillshade,
+            illumination=(
+                illumination[window].copy() if illumination is not None else None
+            ),
+        )
+
+    return rendered
+
+
+def generate_tile_pyramid(url, tile_type, path, params, max_zoom):
+    """
+    Render the tiles of a raster with the given parameters (see
+    get_pyramid_params), up to max_zoom, to an MBTiles archive at path.
+    Returns the description of the pyramid, stored in Task.tile_pyramids.
+    """
+    with open_cog_reader(url) as src:
+        minzoom, maxzoom = get_zoom_safe(src)
+        bounds = src.bounds
+        tms = src.tms
+
+    minzoom = max(0, minzoom - ZOOM_EXTRA_LEVELS)
+    maxzoom = min(maxzoom + ZOOM_EXTRA_LEVELS, max_zoom)
+    rescale = "{},{}".format(*params["rescale"])
+
+    def render_tiles():
+        for tile in tms.tiles(*bounds, zooms=list(range(minzoom, maxzoom + 1))):
+            try:
+                content, _discard_ = render_tile(
+                    url,
+                    tile_type,
+                    tile.z,
+                    tile.x,
+                    tile.y,
+                    rescale=rescale,
+                    color_map=params["color_map"],
+                    hillshade=params["hillshade"],
+                    tilesize=params["tilesize"],
+                    # MBTiles archives have one format for all their tiles
+                    ext="png",
+                )
+            except exceptions.NotFound:
+                continue
+
+            yield tile.z, tile.x, tile.y, content
+
+    count = write_tile_pyramid(
+        path,
+        render_tiles(),
+        {
+            "name": tile_type,
+            "type": "overlay",
+            "format": "png",
+            "bounds": ",".join(map(str, bounds)),
+            "minzoom": str(minzoom),
+            "maxzoom": str(maxzoom),
+            "webodm_params": params,
+        },
+    )
+
+    return {"params": params, "minzoom": minzoom, "maxzoom": maxzoom, "tiles": count}
+
+
+def get_task_pyramid_tile(
+    task, tile_type, z, x, y, rescale, color_map, hillshade, tilesize, ext
+):
+    """
+    Tile of the tile pyramid of a task raster, when the pyramid was rendered
+    with the requested parameters and has it, otherwise None
+    """
+    pyramid = task.tile_pyramids.get(tile_type)
+
+    if (
+        pyramid is None
+        or not pyramid["minzoom"] <= z <= pyramid["maxzoom"]
+        or not matches_pyramid_params(
+            pyramid["params"], rescale, color_map, hillshade, tilesize
+        )
+    ):
+        return None
+
+    path = task.get_tile_pyramid_path(tile_type)
+
+    if not os.path.isfile(path):
+        # Rendered tiles are served until the pyramid is downloaded from S3
+        now = time.monotonic()
+
+        if _pyramid_downloads.get(path, 0) < now - PYRAMID_DOWNLOAD_INTERVAL:
+            _pyramid_downloads[path] = now
+            TaskAssetsManager(task).cache_asset(path)
+
+        return None
+
+    content = get_pyramid_tile(path, z, x, y)
+
+    if content is None:
+        return None
+
+    tile_format = get_tile_format(content)
+
+    if ext is not None and ext != tile_format:
+        return None
+
+    record_file_access(path)
+
+    return CachedTile(content, "image/{}".format(tile_format), get_tile_etag(content))
+
+
+def parse_tile_params(query_params, tile_type, z, scale=1, orthophoto_bands=None):
+    """
+    Parse the query parameters of a tile request. Returns the zoom level of the
+    tile and its rendering options (see render_tile).
+    """
+    nodata = None
+
+    formula = query_params.get("formula")
+    bands = query_params.get("bands")
+    rescale = query_params.get("rescale")
+    color_map = query_params.get("color_map")
+    hillshade = query_params.get("hillshade")
+    tilesize = query_params.get("size")
+
+    boundaries_feature = query_params.get("boundaries")
+    if boundaries_feature == "":
+        boundaries_feature = None
+    if boundaries_feature is not None:
+        try:
+            boundaries_feature = json.loads(boundaries_feature)
+        except json.JSONDecodeError:
+            raise exceptions.ValidationError(_("Invalid boundaries parameter"))
+
+    if formula == "":
+        formula = None
+    if bands == "":
+        bands = None
+    if rescale == "":
+        rescale = None
+    if color_map == "":
+        color_map = None
+    if hillshade == "" or hillshade == "0":
+        hillshade = None
+    if tilesize == "" or tilesize is None:
+        tilesize = 256
+    if bands == "auto" and formula:
+        bands, _discard_ = get_auto_bands(orthophoto_bands, formula)
+
+    try:
+        tilesize = int(tilesize)
+        if tilesize != 256 and tilesize != 512:
+            raise ValueError("Invalid size")
+
+        if tilesize == 512:
+            z -= 1
+    except ValueError:
+        raise exceptions.ValidationError(_("Invalid tile size parameter"))
+
+    try:
+        expr, _discard_ = lookup_formula(formula, bands)
+    except ValueError as e:
+        raise exceptions.ValidationError(str(e))
+
+    if tile_type in ["dsm", "dtm"] and rescale is None:
+        rescale = "0,1000"
+    if tile_type == "orthophoto" and rescale is None:
+        rescale = "0,255"
+
+    if tile_type in ["dsm", "dtm"] and color_map is None:
+        color_map = "gray"
+
+    if tile_type == "orthophoto" and formula is not None:
+        if color_map is None:
+            color_map = "gray"
+        if rescale is None:
+            rescale = "-1,1"
+
+    if nodata is not None:
+        nodata = np.nan if nodata == "nan" else float(nodata)
+    tilesize = scale * tilesize
+
+    return z, {
+        "expr": expr,
+        "rescale": rescale,
+        "color_map": color_map,
+        "hillshade": hillshade,
+        "tilesize": tilesize,
+        "nodata": nodata,
+        "boundaries_feature": boundaries_feature,
+    }
+
+
 class Tiles(TaskNestedView):
 
     # permission_classes = (IsAuthenticated,)
@@ -366,302 +984,172 @@ class Tiles(TaskNestedView):
         """
         task = self.get_and_check_task(request, pk)
 
-        z = int(z)
         x = int(x)
         y = int(y)
+        z, params = parse_tile_params(
+            self.request.query_params,
+            tile_type,
+            int(z),
+            int(scale),
+            task.orthophoto_bands,
+        )
+        url = get_raster_path(task, tile_type)
 
-        scale = int(scale)
+        # Default visualizations come from the tile pyramids
+        if (
+            params["expr"] is None
+            and params["boundaries_feature"] is None
+            and params["nodata"] is None
+        ):
+            with tile_phase("cache"):
+                tile = get_task_pyramid_tile(
+                    task,
+                    tile_type,
+                    z,
+                    x,
+                    y,
+                    params["rescale"],
+                    params["color_map"],
+                    params["hillshade"],
+                    params["tilesize"],
+                    ext,
+                )
 
-        indexes = None
-        nodata = None
-        rgb_tile = None
+            if tile is not None:
+                return tile_response(request, tile, cache_status="PYRAMID")
+
+        cache_key = None
+        if tile_cache.enabled:
+            raster_version = get_cog_version(url)
+
+            if raster_version is not None:
+                # Automatic formats depend on what the client accepts
+                requested_ext = ext
+                if requested_ext is None:
+                    accepts_webp = "image/webp" in request.headers.get("Accept", "")
+                    requested_ext = "auto-webp" if accepts_webp else "auto"
+
+                tile_params = {
+                    "tile_type": tile_type,
+                    "z": z,
+                    "x": x,
+                    "y": y,
+                    "expr": params["expr"],
+                    "rescale": params["rescale"],
+                    "color_map": params["color_map"],
+                    "hillshade": params["hillshade"],
+                    "tilesize": params["tilesize"],
+                    "nodata": params["nodata"],
+                    "ext": requested_ext,
+                    "boundaries": params["boundaries_feature"],
+                }
+                cache_key = tile_cache.make_key(task.id, raster_version, tile_params)
+                with tile_phase("cache"):
+                    tile = tile_cache.get(task.id, cache_key)
+
+                if tile is not None:
+                    return tile_response(request, tile, cache_status="HIT")
+
+                if settings.TILE_METATILE_SIZE > 1:
+                    tile, cache_status = self._get_metatile_tile(
+                        task,
+                        url,
+                        raster_version,
+                        cache_key,
+                        tile_params,
+                        ext,
+                        "image/webp" in request.headers.get("Accept", ""),
+                    )
 
-        formula = self.request.query_params.get("formula")
-        bands = self.request.query_params.get("bands")
-        rescale = self.request.query_params.get("rescale")
-        color_map = self.request.query_params.get("color_map")
-        hillshade = self.request.query_params.get("hillshade")
-        tilesize = self.request.query_params.get("size")
+                    if tile is not None:
+                        return tile_response(request, tile, cache_status=cache_status)
+
+        content, content_type = render_tile(
+            url,
+            tile_type,
+            z,
+            x,
+            y,
+            ext=ext,
+            accepts_webp="image/webp" in request.headers.get("Accept", ""),
+            **params,
+        )
 
-        boundaries_feature = self.request.query_params.get("boundaries")
-        if boundaries_feature == "":
-            boundaries_feature = None
-        if boundaries_feature is not None:
-            try:
-                boundaries_feature = json.loads(boundaries_feature)
-            except json.JSONDecodeError:
-                raise exceptions.ValidationError(_("Invalid boundaries parameter"))
+        return self._rendered_tile_response(
+            request, task, cache_key, content, content_type
+        )
 
-        if formula == "":
-            formula = None
-        if bands == "":
-            bands = None
-        if rescale == "":
-            rescale = None
-        if color_map == "":
-            color_map = None
-        if hillshade == "" or hillshade == "0":
-            hillshade = None
-        if tilesize == "" or tilesize is None:
-            tilesize = 256
-        if bands == "auto" and formula:
-            bands, _discard_ = get_auto_bands(task.orthophoto_bands, formula)
+    def _get_metatile_tile(
+        self, task, url, raster_version, cache_key, params, ext, accepts_webp
+    ):
+        """
+        Render the metatile (see render_metatile) of a tile to the tile cache.
+        Concurrent requests for the tiles of a metatile wait for it to be
+        rendered once. Returns the tile and its cache status, or None when it
+        is outside of the raster or was not rendered in time.
+        """
+        size = settings.TILE_METATILE_SIZE
+        x, y = params["x"], params["y"]
+        metatile_x, metatile_y = x - x % size, y - y % size
+        metatile_key = tile_cache.make_key(
+            task.id,
+            raster_version,
+            {**params, "x": metatile_x, "y": metatile_y, "metatile": size},
+        )
 
-        try:
-            tilesize = int(tilesize)
-            if tilesize != 256 and tilesize != 512:
-                raise ValueError("Invalid size")
+        lock_token = tile_cache.lock(metatile_key, METATILE_LOCK_TIMEOUT)
 
-            if tilesize == 512:
-                z -= 1
-        except ValueError:
-            raise exceptions.ValidationError(_("Invalid tile size parameter"))
+        if lock_token is None:
+            tile_cache.wait_unlock(metatile_key, METATILE_LOCK_TIMEOUT)
+            return tile_cache.get(task.id, cache_key), "HIT"
 
         try:
-            expr, _discard_ = lookup_formula(formula, bands)
-        except ValueError as e:
-            raise exceptions.ValidationError(str(e))
-
-        if tile_type in ["dsm", "dtm"] and rescale is None:
-            rescale = "0,1000"
-        if tile_type == "orthophoto" and rescale is None:
-            rescale = "0,255"
-
-        if tile_type in ["dsm", "dtm"] and color_map is None:
-            color_map = "gray"
-
-        if tile_type == "orthophoto" and formula is not None:
-            if color_map is None:
-                color_map = "gray"
-            if rescale is None:
-                rescale = "-1,1"
-
-        if nodata is not None:
-            nodata = np.nan if nodata == "nan" else float(nodata)
-        tilesize = scale * tilesize
-        url = get_raster_path(task, tile_type)
-
-        with open_cog_reader(url) as src:
-            if not src.tile_exists(z, x, y):
-                raise exceptions.NotFound(_("Outside of bounds"))
-
-            minzoom, maxzoom = get_zoom_safe(src)
-            has_alpha = has_alpha_band(src.dataset)
-            if z < minzoom - ZOOM_EXTRA_LEVELS or z > maxzoom + ZOOM_EXTRA_LEVELS:
-                raise exceptions.NotFound()
-            if boundaries_feature is not None:
-                try:
-                    boundaries_cutline = create_cutline(
-                        src.dataset, boundaries_feature, CRS.from_string("EPSG:4326")
-                    )
-                except:
-                    raise exceptions.ValidationError(_("Invalid boundaries"))
-            else:
-                boundaries_cutline = None
-            # Handle N-bands datasets for orthophotos (not plant health)
-            if tile_type == "orthophoto" and expr is None:
-                ci = src.dataset.colorinterp
-                # More than 4 bands?
-                if len(ci) > 4:
-                    # Try to find RGBA band order
-                    if (
-                        ColorInterp.red in ci
-                        and ColorInterp.green in ci
-                        and ColorInterp.blue in ci
-                    ):
-                        indexes = (
-                            ci.index(ColorInterp.red) + 1,
-                            ci.index(ColorInterp.green) + 1,
-                            ci.index(ColorInterp.blue) + 1,
-                        )
-                    else:
-                        # Fallback to first three
-                        indexes = (
-                            1,
-                            2,
-                            3,
-                        )
-                elif has_alpha:
-                    indexes = non_alpha_indexes(src.dataset)
-
-            # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
-            if nodata is None and tile_type == "orthophoto":
-                nodata = 0
-
-            resampling = "nearest"
-            padding = 0
-            tile_buffer = None
-
-            if tile_type in ["dsm", "dtm"]:
-                resampling = "bilinear"
-                padding = 16
-
-            # Hillshading is not a local tile operation and
-            # requires neighbor tiles to be rendered seamlessly
-            if hillshade is not None:
-                tile_buffer = 16
-
-            try:
-                if expr is not None:
-                    if boundaries_cutline is not None:
-                        tile = src.tile(
-                            x,
-                            y,
-                            z,
-                            expression=expr,
-                            tilesize=tilesize,
-                            nodata=nodata,
-                            padding=padding,
-                            tile_buffer=tile_buffer,
-                            resampling_method=resampling,
-                            vrt_options={"cutline": boundaries_cutline},
-                        )
-                    else:
-                        tile = src.tile(
-                            x,
-                            y,
-                            z,
-                            expression=expr,
-                            tilesize=tilesize,
-                            nodata=nodata,
-                            padding=padding,
-                            tile_buffer=tile_buffer,
-                            resampling_method=resampling,
-                        )
-                else:
-                    if boundaries_cutline is not None:
-                        tile = src.tile(
-                            x,
-                            y,
-                            z,
-                            tilesize=tilesize,
-                            nodata=nodata,
-                            padding=padding,
-                            tile_buffer=tile_buffer,
-                            resampling_method=resampling,
-                            vrt_options={"cutline": boundaries_cutline},
-                        )
-                    else:
-                        tile = src.tile(
-                            x,
-                            y,
-                            z,
-                            indexes=indexes,
-                            tilesize=tilesize,
-                            nodata=nodata,
-                            padding=padding,
-                            tile_buffer=tile_buffer,
-                            resampling_method=resampling,
-                        )
-            except TileOutsideBounds:
-                raise exceptions.NotFound(_("Outside of bounds"))
+            tiles = render_metatile(
+                url,
+                params["tile_type"],
+                params["z"],
+                metatile_x,
+                metatile_y,
+                size,
+                expr=params["expr"],
+                rescale=params["rescale"],
+                color_map=params["color_map"],
+                hillshade=params["hillshade"],
+                tilesize=params["tilesize"],
+                nodata=params["nodata"],
+                ext=ext,
+                boundaries_feature=params["boundaries"],
+                accepts_webp=accepts_webp,
+            )
 
-            if color_map:
-                try:
-                    colormap.get(color_map)
-                except InvalidColorMapName:
-                    raise exceptions.ValidationError(_("Not a valid color_map value"))
+            tile = None
 
-            intensity = None
-            try:
-                rescale_arr = list(map(float, rescale.split(",")))
-            except ValueError:
-                raise exceptions.ValidationError(_("Invalid rescale value"))
-
-            # Auto?
-            if ext is None:
-                # Check for transparency
-                if np.equal(tile.mask, 255).all():
-                    ext = "jpg"
+            for (tile_x, tile_y), (content, content_type) in tiles.items():
+                if (tile_x, tile_y) == (x, y):
+                    tile = tile_cache.set(task.id, cache_key, content, content_type)
                 else:
-                    if "image/webp" in request.headers.get("Accept", ""):
-                        ext = "webp"
-                    else:
-                        ext = "png"
-
-            driver = "jpeg" if ext == "jpg" else ext
-
-            options = img_profiles.get(driver, {})
-            if hillshade is not None:
-                try:
-                    hillshade = float(hillshade)
-                    if hillshade <= 0:
-                        hillshade = 1.0
-                except ValueError:
-                    raise exceptions.ValidationError(_("Invalid hillshade value"))
-                if tile.data.shape[0] != 1:
-                    raise exceptions.ValidationError(
-                        _(
-                            "Cannot compute hillshade of non-elevation raster (multiple bands found)"
-                        )
-                    )
-                delta_scale = (maxzoom + ZOOM_EXTRA_LEVELS + 1 - z) * 4
-                dx = src.dataset.meta["transform"][0] * delta_scale
-                dy = -src.dataset.meta["transform"][4] * delta_scale
-                ls = LightSource(azdeg=315, altdeg=45)
-
-                # Remove elevation data from edge buffer tiles
-                # (to keep intensity uniform across tiles)
-                elevation = tile.data[0]
-                elevation[0:tile_buffer, 0:tile_buffer] = nodata
-                elevation[
-                    tile_buffer + tilesize : tile_buffer * 2 + tilesize, 0:tile_buffer
-                ] = nodata
-                elevation[
-                    0:tile_buffer, tile_buffer + tilesize : tile_buffer * 2 + tilesize
-                ] = nodata
-                elevation[
-                    tile_buffer + tilesize : tile_buffer * 2 + tilesize,
-                    tile_buffer + tilesize : tile_buffer * 2 + tilesize,
-                ] = nodata
-
-                intensity = ls.hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade)
-                intensity = intensity[
-                    tile_buffer : tile_buffer + tilesize,
-                    tile_buffer : tile_buffer + tilesize,
-                ]
-
-            if intensity is not None:
-                rgb = tile.post_process(in_range=(rescale_arr,))
-                rgb_data = rgb.data[
-                    :,
-                    tile_buffer : tilesize + tile_buffer,
-                    tile_buffer : tilesize + tile_buffer,
-                ]
-                if color_map:
-                    rgb, _discard_ = apply_cmap(rgb_data, colormap.get(color_map))
-                if rgb.data.shape[0] != 3:
-                    raise exceptions.ValidationError(
-                        _(
-                            "Cannot process tile: intensity image provided, but no RGB data was computed."
-                        )
-                    )
-                intensity = intensity * 255.0
-                rgb = hsv_blend(rgb, intensity)
-                if rgb is not None:
-                    mask = tile.mask[
-                        tile_buffer : tilesize + tile_buffer,
-                        tile_buffer : tilesize + tile_buffer,
-                    ]
-                    return HttpResponse(
-                        render(rgb, mask, img_format=driver, **options),
-                        content_type="image/{}".format(ext),
+                    tile_cache.set(
+                        task.id,
+                        tile_cache.make_key(
+                            task.id,
+                            raster_version,
+                            {**params, "x": tile_x, "y": tile_y},
+                        ),
+                        content,
+                        content_type,
                     )
 
-            if color_map is not None:
-                return HttpResponse(
-                    tile.post_process(in_range=(rescale_arr,)).render(
-                        img_format=driver, colormap=colormap.get(color_map), **options
-                    ),
-                    content_type="image/{}".format(ext),
-                )
+            return tile, "MISS"
+        finally:
+            tile_cache.unlock(metatile_key, lock_token)
 
-            return HttpResponse(
-                tile.post_process(in_range=(rescale_arr,)).render(
-                    img_format=driver, **options
-                ),
-                content_type="image/{}".format(ext),
-            )
+    def _rendered_tile_response(self, request, task, cache_key, content, content_type):
+        if cache_key is None:
+            tile = CachedTile(content, content_type, get_tile_etag(content))
+            return tile_response(request, tile)
+
+        tile = tile_cache.set(task.id, cache_key, content, content_type)
+        return tile_response(request, tile, cache_status="MISS")
 
 
 class Export(TaskNestedView):
@@ -819,17 +1307,25 @@ class Export(TaskNestedView):
                     }
                 )
             else:
-                celery_task_id = export_raster.delay(
+                opts = {
+                    "epsg": epsg,
+                    "expression": expr,
+                    "format": export_format,
+                    "rescale": rescale,
+                    "color_map": color_map,
+                    "hillshade": hillshade,
+                    "asset_type": asset_type,
+                    "name": task.name,
+                }
+                celery_task_id = start_export(
+                    task,
+                    asset_type,
                     url,
-                    epsg=epsg,
-                    expression=expr,
-                    format=export_format,
-                    rescale=rescale,
-                    color_map=color_map,
-                    hillshade=hillshade,
-                    asset_type=asset_type,
-                    name=task.name,
-                ).task_id
+                    opts,
+                    lambda celery_task_id: export_raster.apply_async(
+                        args=(url,), kwargs=opts, task_id=celery_task_id
+                    ),
+                )
                 return Response(
                     {"celery_task_id": celery_task_id, "filename": filename}
                 )
@@ -845,9 +1341,16 @@ class Export(TaskNestedView):
                     }
                 )
             else:
-                celery_task_id = export_pointcloud.delay(
-                    pk, url, epsg=epsg, format=export_format
-                ).task_id
+                opts = {"epsg": epsg, "format": export_format}
+                celery_task_id = start_export(
+                    task,
+                    asset_type,
+                    url,
+                    opts,
+                    lambda celery_task_id: export_pointcloud.apply_async(
+                        args=(pk, url), kwargs=opts, task_id=celery_task_id
+                    ),
+                )
                 return Response(
                     {"celery_task_id": celery_task_id, "filename": filename}
                 )
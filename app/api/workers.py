@@ -4,6 +4,8 @@ import logging
 
 from worker.tasks import TestSafeAsyncResult
 from worker.utils.recover_uploads_task_db import RecoverUploadsTaskDb
+from app.classes.task_assets_manager import S3AssetSource
+from app.utils.s3_utils import get_s3_object_metadata, split_s3_bucket_prefix
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -13,6 +15,8 @@ from django.http import FileResponse
 from django.http import HttpResponse
 from wsgiref.util import FileWrapper
 
+from .tasks import download_file_stream
+
 logger = logging.getLogger("app.logger")
 
 
@@ -28,7 +32,9 @@ class CheckTask(APIView):
         res = TestSafeAsyncResult(celery_task_id)
 
         if not res.ready():
-            return Response({"ready": False}, status=status.HTTP_200_OK)
+            return Response(
+                {"ready": False, **_get_progress(res)}, status=status.HTTP_200_OK
+            )
         else:
             result = res.get()
 
@@ -82,11 +88,27 @@ class GetTaskResult(APIView):
                 return Response({"ready": True, "error": error})
 
             file = result.get("file", None)  # File path
+            s3_file = result.get("s3_file", None)  # s3://bucket/key
             output = result.get("output", None)  # String/object
         else:
             return Response({"ready": False, "error": "Task not ready"})
 
-        if file is not None:
+        if s3_file is not None:
+            s3_bucket, s3_key = split_s3_bucket_prefix(s3_file)
+            s3_object = get_s3_object_metadata(s3_key, s3_bucket)
+
+            if not s3_object or "DeleteMarker" in s3_object:
+                return Response({"ready": True, "error": "Task output not found"})
+
+            filename = request.query_params.get("filename", os.path.basename(s3_key))
+
+            return download_file_stream(
+                request,
+                S3AssetSource(s3_key, s3_bucket, s3_object),
+                "attachment",
+                filename,
+            )
+        elif file is not None:
             filename = request.query_params.get("filename", os.path.basename(file))
             filesize = os.stat(file).st_size
 
@@ -141,6 +163,16 @@ class GetCacheSize(APIView):
         )
 
 
+def _get_progress(res):
+    """
+    Progress (0 to 100) of a running task that reports it, as {"progress": ...}
+    """
+    if getattr(res, "state", None) != "PROGRESS" or not isinstance(res.info, dict):
+        return {}
+
+    return {"progress": res.info.get("progress")}
+
+
 def _get_status_from_recover_db(celery_id: str):
     from app.models import Task
 
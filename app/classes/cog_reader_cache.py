@@ -0,0 +1,209 @@
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from opentelemetry import metrics
+from rasterio.errors import RasterioError
+from rio_tiler.io import COGReader
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+meter = metrics.get_meter("app.cog_reader_cache")
+
+reader_cache_hits = meter.create_counter(
+    "cog_reader_cache_hits", description="Open COGReader handles reused"
+)
+reader_cache_misses = meter.create_counter(
+    "cog_reader_cache_misses", description="COGReader handles opened on demand"
+)
+reader_cache_evictions = meter.create_counter(
+    "cog_reader_cache_evictions", description="Idle COGReader handles closed"
+)
+
+# Interval of the checks of the local files of idle handles, so handles of
+# deleted files do not keep them open until they are idle for long
+FILES_CHECK_SECONDS = 5
+
+
+class CogReaderCache:
+    """
+    Bounded LRU of open COGReader handles for the current process.
+
+    Readers are leased exclusively (a rasterio dataset must not be read by two
+    threads at the same time) and returned to the idle list after use. Entries
+    are keyed by path and a version (file mtime or S3 ETag), so a changed raster
+    is never served from a stale handle. Handles of local files also keep the
+    identity of the file they opened, and are closed once it is deleted or
+    replaced, even with the same version.
+    """
+
+    def __init__(self, max_open: int, idle_seconds: int):
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._idle = OrderedDict()
+        self._leased = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._files_checked_at = time.monotonic()
+
+    @contextmanager
+    def reader(self, path: str, version: str):
+        key = (path, version)
+        source, file_id = self._acquire(key)
+
+        if source is None:
+            try:
+                file_id = _get_file_id(path)
+                source = COGReader(path).__enter__()
+            except BaseException:
+                self._cancel_lease()
+                raise
+
+        reusable = True
+        try:
+            yield source
+        except RasterioError:
+            # The handle may be in an unknown state, do not reuse it
+            reusable = False
+            raise
+        finally:
+            self._release(key, source, file_id, reusable)
+
+    def clear(self):
+        with self._lock:
+            idle = list(self._idle.values())
+            self._idle.clear()
+
+        for source, _, _ in idle:
+            self._close(source)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "idle": len(self._idle),
+                "leased": self._leased,
+                "max_open": self.max_open,
+            }
+
+    def _acquire(self, key):
+        with self._lock:
+            self._reset_after_fork()
+            self._evict_idle()
+
+            for idle_key in list(reversed(self._idle)):
+                if idle_key[0] != key:
+                    continue
+
+                source, _, file_id = self._idle.pop(idle_key)
+
+                if file_id != _get_file_id(key[0]):
+                    # Deleted or replaced since it was opened
+                    self._evict(source)
+                    continue
+
+                self._leased += 1
+                self.hits += 1
+                reader_cache_hits.add(1)
+                return source, file_id
+
+            self._leased += 1
+            self.misses += 1
+            reader_cache_misses.add(1)
+
+        return None, None
+
+    def _cancel_lease(self):
+        with self._lock:
+            self._leased = max(0, self._leased - 1)
+
+    def _release(self, key, source, file_id, reusable: bool):
+        to_close = []
+
+        with self._lock:
+            self._leased = max(0, self._leased - 1)
+
+            if not reusable or self.max_open <= 0 or self._pid != os.getpid():
+                to_close.append(source)
+            else:
+                # Same path with an older version will never be asked again
+                for idle_key in list(self._idle):
+                    if idle_key[0][0] == key[0] and idle_key[0][1] != key[1]:
+                        to_close.append(self._idle.pop(idle_key)[0])
+
+                self._idle[(key, id(source))] = (source, time.monotonic(), file_id)
+
+                while len(self._idle) + self._leased > self.max_open and self._idle:
+                    to_close.append(self._idle.popitem(last=False)[1][0])
+                    self.evictions += 1
+                    reader_cache_evictions.add(1)
+
+        for s in to_close:
+            self._close(s)
+
+    def _evict_idle(self):
+        now = time.monotonic()
+
+        for idle_key, (source, last_used, _) in list(self._idle.items()):
+            if now - last_used < self.idle_seconds:
+                break
+
+            self._idle.pop(idle_key)
+            self._evict(source)
+
+        if now - self._files_checked_at >= FILES_CHECK_SECONDS:
+            self._files_checked_at = now
+
+            for idle_key, (source, _, file_id) in list(self._idle.items()):
+                if file_id != _get_file_id(idle_key[0][0]):
+                    self._idle.pop(idle_key)
+                    self._evict(source)
+
+    def _evict(self, source):
+        self.evictions += 1
+        reader_cache_evictions.add(1)
+        self._close(source)
+
+    def _reset_after_fork(self):
+        # Handles opened by a parent process must not be shared with forked workers
+        current_pid = os.getpid()
+
+        if self._pid != current_pid:
+            self._idle = OrderedDict()
+            self._leased = 0
+            self._pid = current_pid
+
+    def _close(self, source):
+        try:
+            source.__exit__(None, None, None)
+        except Exception as e:
+            logger.warning(f"Failed to close COGReader. Original error: {str(e)}")
+
+
+cog_reader_cache = CogReaderCache(
+    settings.COG_READER_CACHE_MAX_OPEN, settings.COG_READER_CACHE_IDLE_SECONDS
+)
+
+
+def _get_file_id(path: str):
+    """
+    Identity of the local file at path (device and inode), None when it does
+    not exist or path is not a local file (S3 and /vsi paths)
+    """
+    if path.startswith("/vsi") or "://" in path:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat.st_dev, stat.st_ino
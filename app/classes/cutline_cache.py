@@ -0,0 +1,104 @@
+import hashlib
+import json
+import threading
+
+from collections import OrderedDict
+from opentelemetry import metrics
+from rasterio.crs import CRS
+from rasterio.features import bounds as featureBounds
+from rio_tiler.utils import create_cutline
+from webodm import settings
+
+meter = metrics.get_meter("app.cutline_cache")
+
+cutline_cache_hits = meter.create_counter(
+    "cutline_cache_hits", description="Boundary cutlines reused"
+)
+cutline_cache_misses = meter.create_counter(
+    "cutline_cache_misses", description="Boundary cutlines created on demand"
+)
+
+
+class CutlineCache:
+    """
+    Bounded LRU of the boundary cutlines (see rio_tiler.utils.create_cutline)
+    of the current process, with the bounding boxes of the boundaries.
+
+    A cutline only depends on the grid of the raster and on the geometry, so
+    entries are keyed by a hash of the CRS, transform and size of the dataset
+    and of the normalized GeoJSON geometry. They are shared by the tile and
+    metadata requests of all tasks.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, dataset, boundaries_feature: dict):
+        """
+        Cutline (WKT in the pixel space of the dataset) and bounding box
+        (EPSG:4326) of a GeoJSON feature or geometry in EPSG:4326
+        """
+        geometry = boundaries_feature.get("geometry", boundaries_feature)
+        key = self._make_key(dataset, geometry)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                cutline_cache_hits.add(1)
+                return entry
+
+            self.misses += 1
+            cutline_cache_misses.add(1)
+
+        entry = (
+            create_cutline(dataset, geometry, CRS.from_string("EPSG:4326")),
+            featureBounds(geometry),
+        )
+
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+    def _make_key(self, dataset, geometry: dict):
+        key_data = json.dumps(
+            [
+                dataset.crs.to_wkt(),
+                list(dataset.transform),
+                dataset.width,
+                dataset.height,
+                geometry,
+            ],
+            sort_keys=True,
+            separators=(",", ":"),
+        )
+
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+
+cutline_cache = CutlineCache(settings.CUTLINE_CACHE_MAX_ENTRIES)
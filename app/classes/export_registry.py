@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+
+from django_redis import get_redis_connection
+from opentelemetry import metrics
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+meter = metrics.get_meter("app.export_registry")
+
+export_registry_hits = meter.create_counter(
+    "export_registry_hits",
+    description="Export requests served by an export in progress or completed",
+)
+
+REGISTRY_KEY = "export_registry:{}"
+
+# Seconds a key is claimed for while its export is started, it is kept for the
+# ttl once the export was started
+START_CLAIM_SECONDS = 60
+
+# Changes the expiration of a claim, or deletes it (ttl 0), unless it was
+# replaced by another one
+SET_CLAIM_TTL_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return redis.call('DEL', KEYS[1])
+"""
+
+
+class ExportRegistry:
+    """
+    Celery tasks of exports, keyed by the task, the asset, the version of the
+    asset (file mtime and size, or S3 ETag) and the export options.
+
+    Identical requests attach to the export in progress, or reuse its file
+    in MEDIA_TMP while it is younger than the ttl, instead of exporting again.
+    Exports still pending after pending_timeout (celery reports unknown or lost
+    tasks as pending) are started again.
+    """
+
+    def __init__(self, ttl: int, pending_timeout: int = None):
+        self.ttl = ttl
+        self.pending_timeout = (
+            settings.EXPORT_REGISTRY_PENDING_TIMEOUT_SECONDS
+            if pending_timeout is None
+            else pending_timeout
+        )
+        self._scripts = {}
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def make_key(self, task_id, asset_type: str, asset_version: str, opts: dict):
+        key_data = json.dumps(
+            [str(task_id), asset_type, asset_version, opts],
+            sort_keys=True,
+            default=str,
+        )
+
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def get_or_start(self, key: str, start):
+        """
+        Id of the celery task of the export with the given key. When there is
+        none that can be reused, start(celery_task_id) is called to start it.
+        """
+        if not self.enabled or key is None:
+            return self._start(start)
+
+        redis_key = REGISTRY_KEY.format(key)
+
+        try:
+            celery_task_id, claim = self._claim(redis_key)
+        except Exception as e:
+            logger.warning(f"Cannot use the export registry. Original error: {e}")
+            return self._start(start)
+
+        if celery_task_id is None:
+            return self._start(start)
+
+        if claim is None:
+            export_registry_hits.add(1)
+            return celery_task_id
+
+        try:
+            self._start(start, celery_task_id)
+        except Exception:
+            # Nothing to attach to
+            self._set_claim_ttl(redis_key, claim, 0)
+            raise
+
+        self._set_claim_ttl(redis_key, claim, self.ttl)
+
+        return celery_task_id
+
+    def _claim(self, redis_key: str):
+        """
+        (celery task id, claim) of a new export, when the key was claimed, or
+        (celery task id, None) of a reusable one
+        """
+        client = _get_redis_client()
+
+        for _ in range(2):
+            celery_task_id = uuid.uuid4().hex
+            claim = f"{celery_task_id} {time.time()}"
+
+            # Only one of concurrent requests claims the key
+            if client.set(redis_key, claim, nx=True, ex=START_CLAIM_SECONDS):
+                return celery_task_id, claim
+
+            existing_claim = client.get(redis_key)
+
+            if existing_claim is None:
+                continue
+
+            existing_claim = existing_claim.decode()
+            existing_id, _, claimed_at = existing_claim.partition(" ")
+
+            if self._is_reusable(existing_id, float(claimed_at or 0)):
+                return existing_id, None
+
+            self._run_script(SET_CLAIM_TTL_SCRIPT, [redis_key], [existing_claim, 0])
+
+        return None, None
+
+    def _set_claim_ttl(self, redis_key: str, claim: str, ttl: int):
+        try:
+            self._run_script(SET_CLAIM_TTL_SCRIPT, [redis_key], [claim, ttl])
+        except Exception as e:
+            logger.warning(f"Cannot update the export registry. Original error: {e}")
+
+    def _start(self, start, celery_task_id=None):
+        celery_task_id = celery_task_id or uuid.uuid4().hex
+        start(celery_task_id)
+
+        return celery_task_id
+
+    def _is_reusable(self, celery_task_id: str, claimed_at: float):
+        from worker.tasks import TestSafeAsyncResult
+
+        res = TestSafeAsyncResult(celery_task_id)
+
+        if not res.ready():
+            # Started tasks report their state, unknown ones stay pending
+            if getattr(res, "state", "PENDING") != "PENDING":
+                return True
+
+            return time.time() - claimed_at < self.pending_timeout
+
+        try:
+            result = res.get()
+        except Exception:
+            return False
+
+        if not isinstance(result, dict) or result.get("error") is not None:
+            return False
+
+        file = result.get("file")
+
+        try:
+            return file is not None and os.stat(file).st_mtime > time.time() - self.ttl
+        except OSError:
+            return False
+
+    def _run_script(self, source: str, keys: list, args: list):
+        script = self._scripts.get(source)
+
+        if script is None:
+            script = _get_redis_client().register_script(source)
+            self._scripts[source] = script
+
+        return script(keys=keys, args=args)
+
+
+def _get_redis_client():
+    return get_redis_connection("s3_images_cache")
+
+
+export_registry = ExportRegistry(settings.EXPORT_REGISTRY_TTL_SECONDS)
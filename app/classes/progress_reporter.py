@@ -0,0 +1,123 @@
+import logging
+import threading
+
+from django.db import connection
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+
+
+class ProgressReporter:
+    """
+    Reports the progress (0 to 1) of long transfers without slowing them down.
+
+    update() only records the latest value and can be called from any thread,
+    as often as the transfers like. A writer thread coalesces the updates: it
+    calls save(value) at most every interval seconds, or as soon as the progress
+    moved by min_percent, and appends the saved values to the console as
+    "...xx.xx%" marks, marks_per_line per line, in a single write.
+    """
+
+    def __init__(
+        self,
+        save,
+        console=None,
+        interval: float = None,
+        min_percent: float = None,
+        marks_per_line: int = 10,
+    ):
+        self.save = save
+        self.console = console
+        self.interval = (
+            settings.S3_PROGRESS_SAVE_SECONDS if interval is None else interval
+        )
+        self.min_percent = (
+            settings.S3_PROGRESS_SAVE_MIN_PERCENT
+            if min_percent is None
+            else min_percent
+        )
+        self.marks_per_line = marks_per_line
+        self.saves = 0
+        self._value = None
+        self._saved = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def update(self, value: float):
+        with self._cond:
+            self._value = value
+
+            if self._moved():
+                self._cond.notify()
+
+    def close(self):
+        """
+        Save the last progress and stop the writer thread
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _moved(self):
+        if self._value is None:
+            return False
+
+        if self._saved is None:
+            return True
+
+        return abs(self._value - self._saved) * 100 >= self.min_percent
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._cond:
+                    if not self._closed and not self._moved():
+                        self._cond.wait(self.interval)
+
+                    value, closed = self._value, self._closed
+
+                if value is not None and value != self._saved:
+                    self._write(value)
+
+                if closed:
+                    return
+        finally:
+            # The thread has its own database connection
+            connection.close()
+
+    def _write(self, value):
+        with self._cond:
+            self._saved = value
+
+        try:
+            self.save(value)
+        except Exception as e:
+            logger.warning(f"Failed to save the progress. Original error: {e}")
+
+        self.saves += 1
+
+        if self.console is not None:
+            text = f"...{value * 100:.2f}%"
+            if self.saves % self.marks_per_line == 0:
+                text += "\n"
+
+            try:
+                self.console(text)
+            except Exception as e:
+                logger.warning(f"Failed to write the progress. Original error: {e}")
@@ -0,0 +1,476 @@
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import shutil
+import threading
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+from opentelemetry import metrics
+from webodm import settings
+from app.utils.http_range import (
+    parse_range_header,
+    format_content_range,
+    multipart_byteranges,
+)
+from worker.utils.cache_eviction import (
+    CacheEntry,
+    LruEvictionPolicy,
+    evict,
+    get_eviction_target_size,
+)
+
+logger = logging.getLogger("app.logger")
+meter = metrics.get_meter("app.s3_block_cache")
+
+block_cache_hit_bytes = meter.create_counter(
+    "s3_block_cache_hit_bytes", unit="By", description="Bytes read from local blocks"
+)
+block_cache_miss_bytes = meter.create_counter(
+    "s3_block_cache_miss_bytes", unit="By", description="Bytes fetched from S3"
+)
+
+# Upper bound of a single ranged GET to S3 when filling missing blocks
+MAX_BLOCKS_PER_FETCH = 16
+
+# Share of the budget a process writes before checking the size of the whole
+# cache, written by all the processes
+SIZE_CHECK_FRACTION = 0.1
+
+
+class S3BlockCache:
+    """
+    Local cache of the byte ranges of S3 objects that were actually read.
+
+    Objects are split in fixed size blocks, stored under a directory per
+    object and ETag, so a changed object never serves stale blocks. Rasters
+    are read by GDAL through a loopback HTTP server (see reader_path), which
+    answers range requests from local blocks and fetches the missing ones
+    from S3, so only headers, overviews and the tiles viewed are downloaded.
+    The server only answers paths with a random token of the process, the
+    ones of reader_path.
+    """
+
+    def __init__(self, root: str, block_size: int, max_size: int):
+        self.root = root
+        self.block_size = block_size
+        self.max_size = max_size
+        self._server = None
+        self._server_port = None
+        self._server_pid = None
+        self._server_token = None
+        self._server_lock = threading.Lock()
+        # Size of the cache at the last scan plus the blocks written since by
+        # this process, eviction runs in a thread of its own
+        self._size = None
+        self._written = 0
+        self._size_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._evict_event = threading.Event()
+        self._evictor_pid = None
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def reader_path(self, bucket: str, key: str, etag: str, size: int):
+        """
+        GDAL path that reads the object through the block cache. The ETag and
+        size are part of the path, so GDAL's own caches never mix versions.
+        """
+        port, token = self._ensure_server()
+        path = "/".join(
+            quote(part, safe="")
+            for part in [token, _strip_etag(etag), str(size), bucket, key]
+        )
+
+        return f"/vsicurl/http://127.0.0.1:{port}/{path}"
+
+    def read_range(self, bucket: str, key: str, etag: str, size: int, first, last):
+        """
+        Yield the bytes first..last (inclusive) of an object
+        """
+        block_dir = self._block_dir(bucket, key, etag)
+        block = first // self.block_size
+        last_block = last // self.block_size
+
+        while block <= last_block:
+            data = self._read_block(block_dir, block)
+
+            if data is not None:
+                blocks = [data]
+                block_cache_hit_bytes.add(len(data))
+            else:
+                # Fetch the run of consecutive missing blocks with one request
+                missing_last = block
+                while (
+                    missing_last < last_block
+                    and missing_last - block + 1 < MAX_BLOCKS_PER_FETCH
+                    and not os.path.exists(
+                        self._block_path(block_dir, missing_last + 1)
+                    )
+                ):
+                    missing_last += 1
+
+                blocks = self._fetch_blocks(
+                    bucket, key, etag, size, block_dir, block, missing_last
+                )
+
+            for data in blocks:
+                block_start = block * self.block_size
+                yield data[max(first - block_start, 0) : last - block_start + 1]
+                block += 1
+
+    def evict(self):
+        """
+        Remove the least recently read blocks down to the low-water mark when
+        the cache is over its size budget. Returns the freed bytes.
+        """
+        with self._evict_lock:
+            return self._evict()
+
+    def _evict(self):
+        entries = self._scan()
+        cache_size = sum(entry.size for entry in entries)
+
+        if cache_size <= self.max_size:
+            self._set_size(cache_size)
+            return 0
+
+        entries.sort(key=lambda entry: entry.accessed_at)
+
+        def load_entries(start: int, count: int):
+            return entries[start : start + count]
+
+        def remove_entries(selected: list[CacheEntry]):
+            removed = set()
+
+            for entry in selected:
+                removed.add(entry.file)
+
+                try:
+                    os.remove(entry.file)
+                    os.rmdir(os.path.dirname(entry.file))
+                except OSError:
+                    pass
+
+            entries[:] = [entry for entry in entries if entry.file not in removed]
+
+        freed = evict(
+            LruEvictionPolicy(),
+            load_entries,
+            remove_entries,
+            cache_size - get_eviction_target_size(self.max_size, 0),
+        )
+        self._set_size(cache_size - freed)
+
+        return freed
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _fetch_blocks(
+        self,
+        bucket: str,
+        key: str,
+        etag: str,
+        size: int,
+        block_dir: str,
+        first_block: int,
+        last_block: int,
+    ):
+        from app.utils.s3_utils import get_s3_client
+
+        first = first_block * self.block_size
+        last = min((last_block + 1) * self.block_size, size) - 1
+
+        response = get_s3_client().get_object(
+            Bucket=bucket,
+            Key=key,
+            Range=f"bytes={first}-{last}",
+            IfMatch=f'"{_strip_etag(etag)}"',
+        )
+        body = response["Body"].read()
+
+        if len(body) != last - first + 1:
+            raise IOError(
+                f"Expected {last - first + 1} bytes of {bucket}/{key}, got {len(body)}"
+            )
+
+        block_cache_miss_bytes.add(len(body))
+
+        if not os.path.isdir(block_dir):
+            self._remove_other_versions(block_dir)
+            os.makedirs(block_dir, exist_ok=True)
+
+        blocks = [
+            body[i : i + self.block_size] for i in range(0, len(body), self.block_size)
+        ]
+
+        for i, data in enumerate(blocks):
+            self._write_block(block_dir, first_block + i, data)
+
+        self._add_size(len(body))
+
+        return blocks
+
+    def _add_size(self, size: int):
+        """
+        Count the bytes of new blocks, and wake the evictor thread when they
+        take the cache over its budget, instead of waiting for the periodic
+        eviction. Each process only counts its own blocks, so the evictor
+        also scans the whole cache after this process writes a share of the
+        budget.
+        """
+        with self._size_lock:
+            self._written += size
+
+            if self._size is not None:
+                self._size += size
+
+            check_size = (
+                self._size is None
+                or self._size > self.max_size
+                or self._written >= self.max_size * SIZE_CHECK_FRACTION
+            )
+
+        if check_size:
+            self._ensure_evictor()
+            self._evict_event.set()
+
+    def _set_size(self, size: int):
+        with self._size_lock:
+            self._size = size
+            self._written = 0
+
+    def _ensure_evictor(self):
+        with self._size_lock:
+            # Like the server, threads do not survive a fork
+            current_pid = os.getpid()
+
+            if self._evictor_pid == current_pid:
+                return
+
+            self._evictor_pid = current_pid
+            self._evict_event = threading.Event()
+
+        threading.Thread(target=self._run_evictor, daemon=True).start()
+
+    def _run_evictor(self):
+        evict_event = self._evict_event
+
+        while True:
+            evict_event.wait()
+            evict_event.clear()
+
+            try:
+                self.evict()
+            except Exception as e:
+                logger.warning(f"Failed to evict S3 blocks. Original error: {e}")
+
+    def _read_block(self, block_dir: str, block: int):
+        path = self._block_path(block_dir, block)
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+
+            # The modification time is the last access, used by eviction
+            os.utime(path)
+
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write_block(self, block_dir: str, block: int, data: bytes):
+        path = self._block_path(block_dir, block)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to store S3 block {path}. Original error: {e}")
+
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _remove_other_versions(self, block_dir: str):
+        object_dir = os.path.dirname(block_dir)
+
+        if not os.path.isdir(object_dir):
+            return
+
+        for version_dir in os.listdir(object_dir):
+            path = os.path.join(object_dir, version_dir)
+
+            if path != block_dir:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _block_dir(self, bucket: str, key: str, etag: str):
+        object_hash = hashlib.sha1(f"{bucket}/{key}".encode()).hexdigest()
+        etag_hash = hashlib.sha1(_strip_etag(etag).encode()).hexdigest()[:16]
+
+        return os.path.join(self.root, object_hash, etag_hash)
+
+    def _block_path(self, block_dir: str, block: int):
+        return os.path.join(block_dir, str(block))
+
+    def _scan(self):
+        entries = []
+
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append(CacheEntry(path, stat.st_mtime, stat.st_size))
+
+        return entries
+
+    def _ensure_server(self):
+        with self._server_lock:
+            # The server thread does not survive a fork, start one per process
+            current_pid = os.getpid()
+
+            if self._server_pid != current_pid:
+                if self._server is not None:
+                    self._server.server_close()
+
+                handler = type("S3BlockHandler", (_S3BlockHandler,), {"cache": self})
+                self._server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+                self._server.daemon_threads = True
+                self._server_port = self._server.server_address[1]
+                self._server_pid = current_pid
+                self._server_token = secrets.token_urlsafe(16)
+
+                thread = threading.Thread(
+                    target=self._server.serve_forever, daemon=True
+                )
+                thread.start()
+
+            return self._server_port, self._server_token
+
+
+class _S3BlockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cache: S3BlockCache = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        parsed = self._parse_path()
+
+        if parsed is None:
+            return self._send_status(404)
+
+        etag, size, _, _ = parsed
+        self.send_response(200)
+        self._send_object_headers(etag)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+
+    def do_GET(self):
+        parsed = self._parse_path()
+
+        if parsed is None:
+            return self._send_status(404)
+
+        etag, size, bucket, key = parsed
+        ranges = parse_range_header(self.headers.get("Range"), size)
+
+        def read_range(first: int, last: int):
+            return self.cache.read_range(bucket, key, etag, size, first, last)
+
+        if ranges is not None and len(ranges) == 0:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        headers_sent = False
+
+        try:
+            if ranges is None or len(ranges) == 1:
+                first, last = ranges[0] if ranges else (0, size - 1)
+                content_type = "application/octet-stream"
+                length = last - first + 1
+                body = read_range(first, last)
+            else:
+                content_type, length, body = multipart_byteranges(
+                    ranges, size, "application/octet-stream", read_range
+                )
+
+            # Read before answering, so S3 errors on the first blocks become an
+            # error status instead of a truncated body
+            first_chunk = next(body, b"")
+
+            self.send_response(200 if ranges is None else 206)
+            self._send_object_headers(etag)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(length))
+            if ranges is not None and len(ranges) == 1:
+                self.send_header(
+                    "Content-Range", format_content_range(first, last, size)
+                )
+            self.end_headers()
+            headers_sent = True
+
+            self.wfile.write(first_chunk)
+            for chunk in body:
+                self.wfile.write(chunk)
+        except Exception as e:
+            logger.error(
+                f"Failed to read S3 blocks of {bucket}/{key}. Original error: {e}"
+            )
+
+            if headers_sent:
+                # Drop the connection, so GDAL sees a truncated response
+                self.close_connection = True
+            else:
+                self._send_status(502)
+
+    def _parse_path(self):
+        parts = self.path.lstrip("/").split("/", 4)
+
+        if len(parts) != 5 or not parts[2].isdigit():
+            return None
+
+        token, etag, size, bucket, key = [unquote(part) for part in parts]
+
+        # Only the paths of reader_path, not any object of the credentials
+        if not hmac.compare_digest(token, self.cache._server_token or ""):
+            return None
+
+        return etag, int(size), bucket, key
+
+    def _send_object_headers(self, etag: str):
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", f'"{etag}"')
+
+    def _send_status(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def _strip_etag(etag: str):
+    return etag.strip('"')
+
+
+s3_block_cache = S3BlockCache(
+    settings.S3_BLOCK_CACHE_DIR,
+    settings.S3_BLOCK_CACHE_BLOCK_SIZE_KB * 1024,
+    settings.S3_BLOCK_CACHE_MAX_SIZE_MB * 1024 * 1024,
+)
@@ -0,0 +1,214 @@
+import json
+import logging
+
+from django_redis import get_redis_connection
+from opentelemetry import metrics
+from app.utils.file_utils import ensure_sep_at_end
+from app.utils.s3_utils import convert_task_path_to_s3, iter_s3_objects
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+meter = metrics.get_meter("app.s3_manifest")
+
+s3_manifest_hits = meter.create_counter(
+    "s3_manifest_hits", description="S3 listings of tasks served by their manifest"
+)
+s3_manifest_misses = meter.create_counter(
+    "s3_manifest_misses", description="S3 listings of tasks read from the bucket"
+)
+
+MANIFEST_KEY = "s3_manifest:{}"
+VERSION_KEY = "s3_manifest_version:{}"
+
+# Field of the manifest hash marking it complete, no S3 key is empty
+COMPLETE_FIELD = ""
+
+# Stores a manifest listed at the given version, unless it was invalidated since
+STORE_SCRIPT = """
+if tonumber(redis.call('GET', KEYS[2]) or 0) ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HSET', KEYS[1], '', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+# Updates the objects of a manifest, when there is one
+UPDATE_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], '') == 0 then
+    return 0
+end
+for i = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+
+class S3Manifest:
+    """
+    Objects of the tasks in the S3 bucket, listed once and kept in Redis.
+
+    The manifest of a task has the key, size, ETag and checksum (when known) of
+    its objects, in the shape of the entries of list_objects_v2 with a
+    Checksum. Uploads add the objects they wrote to it, and it is dropped when
+    the objects of the task are deleted or replaced, or after the ttl. Without
+    Redis the bucket is listed every time.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._scripts = {}
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def objects(self, task, prefix: str = None):
+        """
+        Objects of a task, only the ones with keys starting with prefix when
+        given. Errors of the listing are raised: an unknown listing is not an
+        empty one.
+        """
+        task_prefix = ensure_sep_at_end(convert_task_path_to_s3(task.task_path()))
+        objects = None
+
+        if self.enabled:
+            objects = self._read(task.id)
+
+        if objects is None:
+            s3_manifest_misses.add(1)
+            objects = self._list(task.id, task_prefix)
+        else:
+            s3_manifest_hits.add(1)
+
+        if prefix is None or prefix == task_prefix:
+            return objects
+
+        return [obj for obj in objects if obj["Key"].startswith(prefix)]
+
+    def update(self, task_id, objects):
+        """
+        Add or replace objects of the manifest of a task, after they were
+        uploaded
+        """
+        args = []
+        for obj in objects:
+            args += [obj["Key"], self._encode(obj)]
+
+        if not self.enabled or len(args) == 0:
+            return
+
+        try:
+            self._run_script(UPDATE_SCRIPT, [MANIFEST_KEY.format(task_id)], args)
+        except Exception as e:
+            logger.warning(
+                f"Cannot update the s3 manifest of {task_id}, dropping it. Original error: {e}"
+            )
+            self.invalidate(task_id)
+
+    def invalidate(self, task_id):
+        """
+        Drop the manifest of a task, after its objects changed
+        """
+        try:
+            client = _get_redis_client()
+            client.incr(VERSION_KEY.format(task_id))
+            client.delete(MANIFEST_KEY.format(task_id))
+        except Exception as e:
+            logger.warning(
+                f"Cannot invalidate the s3 manifest of {task_id}. Original error: {e}"
+            )
+
+    def _read(self, task_id):
+        try:
+            entries = _get_redis_client().hgetall(MANIFEST_KEY.format(task_id))
+        except Exception as e:
+            logger.warning(
+                f"Cannot read the s3 manifest of {task_id}. Original error: {e}"
+            )
+            return None
+
+        if COMPLETE_FIELD.encode() not in entries:
+            return None
+
+        return sorted(
+            (
+                self._decode(key.decode("utf-8"), value)
+                for key, value in entries.items()
+                if key != COMPLETE_FIELD.encode()
+            ),
+            key=lambda obj: obj["Key"],
+        )
+
+    def _list(self, task_id, task_prefix: str):
+        version = None
+
+        if self.enabled:
+            try:
+                version = int(_get_redis_client().get(VERSION_KEY.format(task_id)) or 0)
+            except Exception as e:
+                logger.warning(
+                    f"Cannot read the s3 manifest version of {task_id}. Original error: {e}"
+                )
+
+        try:
+            objects = [
+                {
+                    "Key": obj["Key"],
+                    "Size": obj["Size"],
+                    "ETag": obj.get("ETag"),
+                    "Checksum": None,
+                }
+                for obj in iter_s3_objects(task_prefix, bucket=settings.S3_BUCKET)
+            ]
+        except Exception as e:
+            logger.error(
+                f"Failed to list s3 objects of '{task_prefix}'. Original error: {e}"
+            )
+            raise
+
+        if version is not None and settings.S3_BUCKET:
+            args = [version, self.ttl]
+            for obj in objects:
+                args += [obj["Key"], self._encode(obj)]
+
+            try:
+                self._run_script(
+                    STORE_SCRIPT,
+                    [MANIFEST_KEY.format(task_id), VERSION_KEY.format(task_id)],
+                    args,
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Cannot store the s3 manifest of {task_id}. Original error: {e}"
+                )
+
+        return objects
+
+    def _encode(self, obj):
+        return json.dumps([obj["Size"], obj.get("ETag"), obj.get("Checksum")])
+
+    def _decode(self, key, value):
+        size, etag, checksum = json.loads(value)
+        return {"Key": key, "Size": size, "ETag": etag, "Checksum": checksum}
+
+    def _run_script(self, source: str, keys: list, args: list):
+        script = self._scripts.get(source)
+
+        if script is None:
+            script = _get_redis_client().register_script(source)
+            self._scripts[source] = script
+
+        return script(keys=keys, args=args)
+
+
+def _get_redis_client():
+    return get_redis_connection("s3_images_cache")
+
+
+s3_manifest = S3Manifest(settings.S3_MANIFEST_TTL_SECONDS)
@@ -0,0 +1,488 @@
+import base64
+import hashlib
+import logging
+import os
+import random
+import threading
+import time
+
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from functools import partial
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from botocore.exceptions import ClientError
+from s3transfer.subscribers import BaseSubscriber
+from app.utils.file_utils import calculate_sha256
+from app.utils.s3_utils import calculate_object_checksum, iter_s3_objects
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+
+MB = 1024 * 1024
+
+# Largest object a single CopyObject request can copy
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * MB
+
+# User metadata with the SHA-256 of the uploaded files
+CHECKSUM_METADATA = "Checksumsha256"
+
+# Results of the transfers
+DOWNLOADED = "downloaded"
+UPLOADED = "uploaded"
+SKIPPED = "skipped"
+MISSING = "missing"
+
+
+def get_transfer_config():
+    """
+    Transfer settings of the S3 downloads and uploads: objects larger than the
+    multipart threshold are transferred in parts (ranged GETs), by up to
+    S3_TRANSFER_MAX_CONCURRENCY requests at the same time
+    """
+    return TransferConfig(
+        multipart_threshold=settings.S3_TRANSFER_MULTIPART_THRESHOLD_MB * MB,
+        multipart_chunksize=settings.S3_TRANSFER_MULTIPART_CHUNKSIZE_MB * MB,
+        max_concurrency=settings.S3_TRANSFER_MAX_CONCURRENCY,
+    )
+
+
+class TransferProgress:
+    """
+    Progress of a set of transfers, from 0 to 1. Each transfer accounts for the
+    same share of the progress, whatever its size.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+        self._completed = 0
+        self._partial = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, fraction: float):
+        """
+        Add to the progress of the transfers in progress (a fraction of one)
+        """
+        with self._lock:
+            self._partial += fraction
+
+    def complete(self, fraction: float = 0.0):
+        """
+        Count a transfer as done, given the fraction of it already added
+        """
+        with self._lock:
+            self._completed += 1
+            self._partial -= fraction
+
+    @property
+    def value(self):
+        with self._lock:
+            if self._completed >= self.count:
+                return 1.0
+
+            return min(1.0, max(0.0, (self._completed + self._partial) / self.count))
+
+
+class _ProgressSubscriber(BaseSubscriber):
+    def __init__(self, size: int, progress: TransferProgress):
+        self.size = size
+        self.fraction = 0.0
+        self._progress = progress
+
+    def on_queued(self, future, **kwargs):
+        # Spares the transfer manager a head_object of its own
+        future.meta.provide_transfer_size(self.size)
+
+    def on_progress(self, future, bytes_transferred, **kwargs):
+        fraction = bytes_transferred / self.size
+        self.fraction += fraction
+        self._progress.add(fraction)
+
+
+class _S3TransferPool:
+    """
+    Workers transferring a list of (bucket, key, path) objects, sharing one S3
+    client and one transfer manager (see get_transfer_config). Failed transfers
+    are retried with exponential backoff, and the progress of all of them is
+    reported by the calling thread.
+    """
+
+    action = "transfer"
+
+    def __init__(
+        self,
+        s3_client,
+        max_workers: int,
+        retries: int = None,
+        retry_backoff_seconds: float = None,
+        transfer_config: TransferConfig = None,
+    ):
+        self.s3_client = s3_client
+        self.max_workers = max_workers
+        self.retries = settings.S3_TRANSFER_RETRIES if retries is None else retries
+        self.retry_backoff_seconds = (
+            settings.S3_TRANSFER_RETRY_BACKOFF_SECONDS
+            if retry_backoff_seconds is None
+            else retry_backoff_seconds
+        )
+        self.transfer_config = transfer_config or get_transfer_config()
+
+    def _run(self, objects, transfer, on_progress, progress_interval, on_failure=None):
+        progress = TransferProgress(len(objects))
+        failed = threading.Event()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            with create_transfer_manager(
+                self.s3_client, self.transfer_config
+            ) as manager:
+                futures = {
+                    executor.submit(
+                        self._retry, transfer, manager, progress, failed, obj
+                    ): obj
+                    for obj in objects
+                }
+                pending = set(futures)
+
+                try:
+                    while pending:
+                        done, pending = wait(
+                            pending,
+                            timeout=progress_interval,
+                            return_when=FIRST_EXCEPTION,
+                        )
+                        for future in done:
+                            if future.exception() is not None and on_failure:
+                                on_failure(futures[future], future.exception())
+
+                            future.result()
+
+                        if on_progress is not None:
+                            on_progress(progress.value)
+                except BaseException:
+                    failed.set()
+                    for future in pending:
+                        future.cancel()
+                    raise
+
+        return [future.result() for future in futures]
+
+    def _retry(self, transfer, manager, progress, failed, obj):
+        bucket, key, path = obj
+        attempt = 0
+
+        while True:
+            try:
+                return transfer(manager, progress, bucket, key, path)
+            except Exception as e:
+                # No retries once another transfer failed for good
+                if (
+                    attempt >= self.retries
+                    or failed.is_set()
+                    or not self._is_retryable(e)
+                ):
+                    raise
+
+                delay = self.retry_backoff_seconds * 2**attempt
+                delay *= random.uniform(0.5, 1.0)
+                attempt += 1
+                logger.warning(
+                    f"Failed to {self.action} s3 file {key} (attempt {attempt} of {self.retries + 1}), retrying in {delay:.1f}s. Original error: {str(e)}"
+                )
+                time.sleep(delay)
+
+    def _is_retryable(self, e):
+        # Client errors (missing objects, permissions) would fail again
+        if isinstance(e, ClientError):
+            return _is_retryable_status(_status_code(e))
+
+        return True
+
+
+def _status_code(e: ClientError):
+    return e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+
+
+def _is_retryable_status(status: int):
+    return status >= 500 or status in (408, 429)
+
+
+class S3DownloadPool(_S3TransferPool):
+    """
+    Concurrent downloads of S3 objects to local files.
+
+    A pool of workers checks the objects and downloads them, sharing one S3
+    client and one transfer manager (see get_transfer_config). Failed downloads
+    are retried with exponential backoff, and the progress of all of them is
+    reported by the calling thread.
+    """
+
+    action = "download"
+
+    def __init__(
+        self,
+        s3_client,
+        max_workers: int = None,
+        retries: int = None,
+        retry_backoff_seconds: float = None,
+        transfer_config: TransferConfig = None,
+    ):
+        super().__init__(
+            s3_client,
+            max_workers or settings.S3_IMPORT_MAX_WORKERS,
+            retries,
+            retry_backoff_seconds,
+            transfer_config,
+        )
+
+    def download(
+        self, objects, need_download=None, on_progress=None, progress_interval=1.0
+    ):
+        """
+        Download a list of (bucket, key, path) objects. need_download(s3_object,
+        path) tells whether a file must be downloaded (again); on_progress is
+        called with the progress of all the downloads (0 to 1) every
+        progress_interval seconds. Returns the result of each object, in order:
+        DOWNLOADED, SKIPPED (not needed) or MISSING (not found or empty).
+        Raises the error of the first download that failed after its retries.
+        """
+        return self._run(
+            objects,
+            partial(self._download_once, need_download=need_download),
+            on_progress,
+            progress_interval,
+        )
+
+    def _download_once(self, manager, progress, bucket, key, path, need_download):
+        try:
+            s3_object = self.s3_client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if self._is_retryable(e):
+                raise
+
+            logger.error(
+                f"Failed to get object properties of key '{key}'. Original error: {str(e)}"
+            )
+            progress.complete()
+            return MISSING
+
+        size = s3_object.get("ContentLength", 0)
+
+        if size <= 0:
+            progress.complete()
+            return MISSING
+
+        if need_download is not None and not need_download(s3_object, path):
+            progress.complete()
+            return SKIPPED
+
+        if os.path.exists(path):
+            os.remove(path)
+
+        logger.info("Downloading s3 file {} to {}".format(key, path))
+        subscriber = _ProgressSubscriber(size, progress)
+
+        try:
+            manager.download(bucket, key, path, subscribers=[subscriber]).result()
+        except BaseException:
+            # The transfer starts over
+            progress.add(-subscriber.fraction)
+            raise
+
+        progress.complete(subscriber.fraction)
+        return DOWNLOADED
+
+
+class _ChecksumReader:
+    """
+    Reads a file for an upload, computing its SHA-256 on the way. It is not
+    seekable, so the transfer manager reads it once and in order.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._sha256.update(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def checksum(self):
+        return base64.b64encode(self._sha256.digest()).decode("utf-8")
+
+
+class S3UploadPool(_S3TransferPool):
+    """
+    Concurrent uploads of local files to S3, with their SHA-256 checksum as the
+    Checksumsha256 metadata (see s3_utils.calculate_object_checksum).
+
+    Files are only read once: small files are read in memory and uploaded with
+    a single request, larger ones are uploaded in parts while their checksum is
+    computed, then given their metadata with a copy of the object onto itself.
+    The objects that already exist are found with a listing of their common
+    prefix, and only the objects of the same size are checked for a matching
+    checksum.
+    """
+
+    action = "upload"
+
+    def __init__(
+        self,
+        s3_client,
+        max_workers: int = None,
+        retries: int = None,
+        retry_backoff_seconds: float = None,
+        transfer_config: TransferConfig = None,
+    ):
+        super().__init__(
+            s3_client,
+            max_workers or settings.S3_UPLOAD_MAX_WORKERS,
+            retries,
+            retry_backoff_seconds,
+            transfer_config,
+        )
+        # (bucket, key) -> listing entry (Key, Size, ETag and Checksum) of the
+        # objects uploaded, or found already uploaded
+        self.objects = {}
+
+    def upload(self, objects, on_progress=None, progress_interval=1.0, on_failure=None):
+        """
+        Upload a list of (bucket, key, path) objects. on_progress is called with
+        the progress of all the uploads (0 to 1) every progress_interval
+        seconds, and on_failure(object, error) with the first upload that failed
+        after its retries, whose error is then raised. Returns the result of
+        each object, in order: UPLOADED, SKIPPED (the same file is already in
+        the bucket) or MISSING (no local file).
+        """
+        sizes = {}
+        for bucket in set(bucket for bucket, _, _ in objects):
+            keys = [key for b, key, _ in objects if b == bucket]
+            sizes[bucket] = self._list_sizes(bucket, keys)
+
+        return self._run(
+            objects,
+            partial(self._upload_once, sizes=sizes),
+            on_progress,
+            progress_interval,
+            on_failure,
+        )
+
+    def _list_sizes(self, bucket, keys):
+        """
+        Sizes of the objects under the common prefix of the keys, or None
+        when the bucket cannot be listed
+        """
+        prefix = os.path.commonprefix(keys)
+        prefix = prefix[: prefix.rfind("/") + 1]
+        sizes = {}
+
+        try:
+            for s3_object in iter_s3_objects(prefix, self.s3_client, bucket):
+                sizes[s3_object["Key"]] = s3_object["Size"]
+        except ClientError as e:
+            logger.warning(
+                f"Failed to list s3 objects of '{prefix}', checking them one by one. Original error: {str(e)}"
+            )
+            return None
+
+        return sizes
+
+    def _upload_once(self, manager, progress, bucket, key, path, sizes):
+        if not os.path.isfile(path):
+            progress.complete()
+            return MISSING
+
+        size = os.path.getsize(path)
+        checksum = self._uploaded_checksum(bucket, key, path, size, sizes.get(bucket))
+
+        if checksum is not None:
+            progress.complete()
+            return SKIPPED
+
+        logger.info("Uploading file {} to s3 {}".format(path, key))
+
+        if size < self.transfer_config.multipart_threshold:
+            with open(path, "rb") as f:
+                body = f.read()
+
+            checksum = base64.b64encode(hashlib.sha256(body).digest()).decode("utf-8")
+            response = self.s3_client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=body,
+                Metadata={CHECKSUM_METADATA: checksum},
+            )
+            self._add_object(bucket, key, size, response.get("ETag"), checksum)
+            progress.complete()
+            return UPLOADED
+
+        subscriber = _ProgressSubscriber(size, progress)
+
+        try:
+            with open(path, "rb") as f:
+                reader = _ChecksumReader(f)
+                manager.upload(reader, bucket, key, subscribers=[subscriber]).result()
+        except BaseException:
+            # The transfer starts over
+            progress.add(-subscriber.fraction)
+            raise
+
+        checksum = reader.checksum()
+        etag = self._set_checksum(manager, bucket, key, size, checksum)
+        self._add_object(bucket, key, size, etag, checksum)
+        progress.complete(subscriber.fraction)
+        return UPLOADED
+
+    def _uploaded_checksum(self, bucket, key, path, size, sizes):
+        """
+        Checksum of the file when the same file is already in the bucket
+        """
+        if sizes is not None and sizes.get(key) != size:
+            return None
+
+        try:
+            s3_object = self.s3_client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if _is_retryable_status(_status_code(e)):
+                raise
+
+            return None
+
+        if s3_object.get("ContentLength") != size:
+            return None
+
+        checksum = calculate_object_checksum(s3_object)
+
+        if checksum is None or checksum != calculate_sha256(path):
+            return None
+
+        self._add_object(bucket, key, size, s3_object.get("ETag"), checksum)
+        return checksum
+
+    def _add_object(self, bucket, key, size, etag, checksum):
+        self.objects[(bucket, key)] = {
+            "Key": key,
+            "Size": size,
+            "ETag": etag,
+            "Checksum": checksum,
+        }
+
+    def _set_checksum(self, manager, bucket, key, size, checksum):
+        copy_source = {"Bucket": bucket, "Key": key}
+        extra_args = {
+            "Metadata": {CHECKSUM_METADATA: checksum},
+            "MetadataDirective": "REPLACE",
+        }
+
+        if size <= MAX_COPY_OBJECT_SIZE:
+            response = self.s3_client.copy_object(
+                Bucket=bucket, Key=key, CopySource=copy_source, **extra_args
+            )
+            return response.get("CopyObjectResult", {}).get("ETag")
+
+        manager.copy(copy_source, bucket, key, extra_args=extra_args).result()
+        return None
@@ -0,0 +1,282 @@
+import io
+import os
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from app.classes.s3_manifest import s3_manifest
+from app.classes.s3_transfer_pool import MB, get_transfer_config
+from app.utils.file_utils import ensure_sep_at_end
+from app.utils.s3_utils import convert_task_path_to_s3, get_s3_client
+from app.vendor import zipfly
+from webodm import settings
+
+# Size of the chunks of the members written to the archives
+CHUNK_SIZE = 256 * 1024
+
+
+def zip_members(task, zip_dir: str, exclude_files=tuple([])):
+    """
+    Members of a zip of a folder of a task, sorted by name: its local files,
+    and the objects of the task in S3 under the folder that are not local. Names
+    with a basename in exclude_files are left out.
+    """
+    members = {}
+
+    for dp, dn, filenames in os.walk(zip_dir):
+        for f in filenames:
+            path = os.path.join(dp, f)
+            name = os.path.relpath(path, zip_dir)
+            members[name] = {"n": name, "fs": path}
+
+    s3_dir = ensure_sep_at_end(convert_task_path_to_s3(zip_dir))
+
+    for s3_object in s3_manifest.objects(task, s3_dir):
+        name = s3_object["Key"][len(s3_dir) :]
+
+        # Folder markers
+        if not name or name.endswith("/") or name in members:
+            continue
+
+        members[name] = {
+            "n": name,
+            "bucket": settings.S3_BUCKET,
+            "key": s3_object["Key"],
+            "size": s3_object["Size"],
+            "etag": s3_object.get("ETag"),
+        }
+
+    return [
+        member
+        for name, member in sorted(members.items())
+        if not (
+            isinstance(exclude_files, tuple) and os.path.basename(name) in exclude_files
+        )
+    ]
+
+
+class S3ZipStream:
+    """
+    Zip archive of local files and S3 objects, written as it is read: nothing
+    is staged on disk and the first bytes come out right away.
+
+    The S3 members are read while they are written, and the next prefetch
+    members are requested ahead by a thread pool, so the latency of the
+    requests is not paid once per member. The members up to prefetch_max_size
+    are read in memory ahead, the larger ones are requested when their turn
+    comes (a response left unread for long could time out). Objects are read
+    with If-Match on their listed ETag, the ones replaced since they were
+    listed are read as they are now if they kept their size (it is written in
+    the archive before them), otherwise the archive fails before them.
+
+    members are the ones of zip_members: {"n": name, "fs": path} for local
+    files and {"n", "bucket", "key", "size", "etag"} for S3 objects.
+    """
+
+    def __init__(
+        self,
+        members,
+        s3_client=None,
+        prefetch: int = None,
+        prefetch_max_size: int = None,
+        chunksize: int = CHUNK_SIZE,
+    ):
+        self.members = members
+        self.s3_client = s3_client
+        self.prefetch = max(
+            1, settings.S3_ZIP_PREFETCH_OBJECTS if prefetch is None else prefetch
+        )
+        self.prefetch_max_size = (
+            settings.S3_ZIP_PREFETCH_MAX_SIZE_MB * MB
+            if prefetch_max_size is None
+            else prefetch_max_size
+        )
+        self.chunksize = chunksize
+
+    def __iter__(self):
+        return self.generator()
+
+    def generator(self):
+        """
+        Chunks of the archive
+        """
+        zfly = zipfly.ZipFly(paths=self._entries(), chunksize=self.chunksize)
+        return zfly.generator()
+
+    def upload(self, bucket: str, key: str):
+        """
+        Write the archive to an S3 object, with a multipart upload: only the
+        parts being uploaded are kept in memory
+        """
+        with _ChunksReader(self.generator()) as reader:
+            self._get_s3_client().upload_fileobj(
+                reader, bucket, key, Config=get_transfer_config()
+            )
+
+    def _entries(self):
+        members = iter(self.members)
+        window = deque()
+
+        executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        try:
+            self._fill(window, members, executor)
+
+            while window:
+                member, future = window.popleft()
+                self._fill(window, members, executor)
+
+                if future is None:
+                    yield member
+                    continue
+
+                stream = future.result()
+
+                if isinstance(stream, _ObjectChunks):
+                    # Requested at its turn, before its header is written
+                    stream.open()
+
+                yield {"n": member["n"], "size": member["size"], "stream": stream}
+        finally:
+            # The archive was not read to the end
+            for _, future in window:
+                if future is not None:
+                    future.cancel()
+
+            executor.shutdown(wait=False)
+
+    def _fill(self, window, members, executor):
+        while len(window) < self.prefetch:
+            member = next(members, None)
+
+            if member is None:
+                return
+
+            future = None
+            if "key" in member:
+                future = executor.submit(self._fetch, member)
+
+            window.append((member, future))
+
+    def _fetch(self, member):
+        chunks = _ObjectChunks(self._get_s3_client(), member, self.chunksize)
+
+        if member["size"] > self.prefetch_max_size:
+            return chunks
+
+        return list(chunks)
+
+    def _get_s3_client(self):
+        if self.s3_client is None:
+            self.s3_client = get_s3_client()
+
+        return self.s3_client
+
+
+class _ObjectChunks:
+    """
+    Chunks of an S3 object, requested when they are iterated
+    """
+
+    def __init__(self, s3_client, member, chunksize: int):
+        self.s3_client = s3_client
+        self.member = member
+        self.chunksize = chunksize
+        self._body = None
+
+    def open(self):
+        """
+        Request the object, if it was not requested yet
+        """
+        if self._body is None:
+            self._body = self._get_body()
+
+    def __iter__(self):
+        self.open()
+        body, self._body = self._body, None
+
+        try:
+            for chunk in body.iter_chunks(chunk_size=self.chunksize):
+                yield chunk
+        finally:
+            body.close()
+
+    def _get_body(self):
+        bucket, key, etag = (
+            self.member["bucket"],
+            self.member["key"],
+            self.member.get("etag"),
+        )
+
+        try:
+            return self._get_object(bucket, key, etag)
+        except ClientError as e:
+            if not etag or not _is_precondition_failed(e):
+                raise
+
+        # Replaced since it was listed (the listings are cached)
+        s3_object = self.s3_client.head_object(Bucket=bucket, Key=key)
+
+        if s3_object["ContentLength"] != self.member["size"]:
+            raise IOError(
+                f"{bucket}/{key} changed size since it was listed, "
+                f"from {self.member['size']} to {s3_object['ContentLength']}"
+            )
+
+        return self._get_object(bucket, key, s3_object["ETag"])
+
+    def _get_object(self, bucket: str, key: str, etag: str = None):
+        options = {}
+
+        if etag:
+            options["IfMatch"] = etag
+
+        return self.s3_client.get_object(Bucket=bucket, Key=key, **options)["Body"]
+
+
+def _is_precondition_failed(error: ClientError):
+    response = error.response
+    return (
+        response.get("Error", {}).get("Code") == "PreconditionFailed"
+        or response.get("ResponseMetadata", {}).get("HTTPStatusCode") == 412
+    )
+
+
+class _ChunksReader(io.RawIOBase):
+    """
+    Non-seekable file object reading the chunks of an iterable
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+
+        while size is None or size < 0 or length < size:
+            chunk = next(self._chunks, None)
+
+            if chunk is None:
+                break
+
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = b"".join(chunks)
+
+        if size is None or size < 0:
+            self._buffer = b""
+            return data
+
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+
+        super().close()
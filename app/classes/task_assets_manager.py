@@ -7,6 +7,7 @@ from app.models import Task, TaskAsset
 from app.utils.s3_utils import (
     convert_task_path_to_s3,
     get_s3_object,
+    get_s3_object_metadata,
     append_s3_bucket_prefix,
     download_s3_file,
     split_s3_bucket_prefix,
@@ -17,28 +18,147 @@ from app.utils.file_utils import (
     get_file_name,
     ensure_path_exists,
 )
+from worker.utils.redis_file_cache import record_file_access
 from webodm import settings
 
 logger = logging.getLogger("app.logger")
 
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Share of an S3 asset a range must cover to bring the whole asset to the
+# local cache
+CACHE_ON_READ_MIN_FRACTION = 0.5
+
+
+def get_chunk_size(size: int):
+    """
+    Chunk size for streaming content of the given size: about 256 chunks,
+    between 1MB and 8MB, so large files are not yielded in millions of
+    tiny pieces and small ones are not held in memory at once
+    """
+    chunk_size = MIN_CHUNK_SIZE
+
+    while chunk_size < MAX_CHUNK_SIZE and chunk_size * 256 < size:
+        chunk_size *= 2
+
+    return chunk_size
+
+
+class LocalAssetSource:
+    """
+    An asset stored on the local disk
+    """
+
+    def __init__(self, path: str):
+        stat = os.stat(path)
+        self.path = path
+        self.size = stat.st_size
+        self.last_modified = stat.st_mtime
+        self.etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+    def open_file(self):
+        self.record_access()
+
+        return open(self.path, "rb")
+
+    def record_access(self):
+        record_file_access(self.path)
+
+    def stream(self, first=0, last=None, chunk_size=None):
+        last = self.size - 1 if last is None else last
+        remaining = last - first + 1
+        chunk_size = chunk_size or get_chunk_size(remaining)
+
+        with open(self.path, "rb") as file:
+            file.seek(first)
+
+            while remaining > 0 and (chunk := file.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
+        self.record_access()
+
+
+class S3AssetSource:
+    """
+    An asset only available on S3. Ranges are requested from S3 directly.
+    """
+
+    def __init__(self, s3_key: str, s3_bucket: str, s3_object: dict, on_read=None):
+        self.s3_key = s3_key
+        self.s3_bucket = s3_bucket
+        self.size = s3_object["ContentLength"]
+        self.last_modified = s3_object["LastModified"].timestamp()
+        self.etag = s3_object["ETag"]
+        self.on_read = on_read
+
+    def stream(self, first=0, last=None, chunk_size=None):
+        last = self.size - 1 if last is None else last
+        whole_object = first == 0 and last == self.size - 1
+        chunk_size = chunk_size or get_chunk_size(last - first + 1)
+
+        s3_object = get_s3_object(
+            self.s3_key,
+            bucket=self.s3_bucket,
+            byte_range=None if whole_object else f"bytes={first}-{last}",
+            if_match=self.etag,
+        )
+
+        if not s3_object:
+            raise IOError(f"Could not read {self.s3_key} from S3")
+
+        for chunk in s3_object["Body"].iter_chunks(chunk_size=chunk_size):
+            yield chunk
+
+        # Reads of the whole file, or most of it (a player or a viewer), bring
+        # it to the local cache for the next requests. Small probes do not.
+        large_range = last - first + 1 >= self.size * CACHE_ON_READ_MIN_FRACTION
+        if (whole_object or large_range) and self.on_read:
+            self.on_read()
+
 
 class TaskAssetsManager:
     def __init__(self, task: Task):
         self.task = task
 
-    def get_asset_stream(self, path: str, chunk_size=1024):
+    def get_asset_stream(self, path: str, chunk_size=None):
         return self._generate_stream(path, chunk_size=chunk_size)
 
-    def get_image_stream(self, path, chunk_size=1024):
+    def get_image_stream(self, path, chunk_size=None):
         local_path = self.task.get_image_path(path)
         return self._generate_stream(local_path, chunk_size=chunk_size)
 
+    def open_asset(self, path: str):
+        """
+        Source of an asset with its size and validators, to serve it (or
+        ranges of it) without reading it whole. None if it does not exist.
+        """
+        if os.path.isfile(path):
+            return LocalAssetSource(path)
+
+        s3_bucket, s3_key = self._asset_s3_key(path)
+        s3_object = get_s3_object_metadata(s3_key, s3_bucket)
+
+        if not s3_object or "DeleteMarker" in s3_object:
+            return None
+
+        return S3AssetSource(
+            s3_key,
+            s3_bucket,
+            s3_object,
+            on_read=lambda: self._download_and_add_to_cache(s3_key, s3_bucket, path),
+        )
+
+    def open_image(self, path: str):
+        return self.open_asset(self.task.get_image_path(path))
+
     def download_asset(self, src_path: str, dst_path: str = None):
         destiny_path = dst_path if dst_path else src_path
         s3_bucket, s3_key = self._asset_s3_key(src_path)
 
         if os.path.exists(src_path):
-            self._refresh_file_in_cache(s3_key, s3_bucket)
+            record_file_access(src_path)
 
             return src_path
 
@@ -57,17 +177,29 @@ class TaskAssetsManager:
 
         return destiny_path
 
+    def cache_asset(self, path: str):
+        """
+        Bring an asset only available on S3 to the local cache, in the background
+        """
+        s3_bucket, s3_key = self._asset_s3_key(path)
+        self._download_and_add_to_cache(s3_key, s3_bucket, path)
+
     def download_asset_to_temp(self, src_path: str):
         tmp_file = tempfile.mktemp(
             f"_{os.path.basename(src_path)}", dir=settings.MEDIA_TMP
         )
         return self.download_asset(src_path, tmp_file)
 
-    def _generate_stream(self, path: str, chunk_size=1024):
+    def _generate_stream(self, path: str, chunk_size=None):
         s3_bucket, s3_key = self._asset_s3_key(path)
 
         if os.path.exists(path):
-            return self._stream_file(path, s3_key, s3_bucket, chunk_size=chunk_size)
+            return self._stream_file(
+                path,
+                s3_key,
+                s3_bucket,
+                chunk_size=chunk_size or get_chunk_size(os.path.getsize(path)),
+            )
 
         s3_object = get_s3_object(s3_key, bucket=s3_bucket)
 
@@ -75,28 +207,35 @@ class TaskAssetsManager:
             return None
 
         return self._stream_s3_object(
-            s3_object, s3_key, s3_bucket, path, chunk_size=chunk_size
+            s3_object,
+            s3_key,
+            s3_bucket,
+            path,
+            chunk_size=chunk_size or get_chunk_size(s3_object["ContentLength"]),
         )
 
-    def _stream_file(self, filepath: str, s3_key: str, s3_bucket: str, chunk_size=1024):
+    def _stream_file(
+        self, filepath: str, s3_key: str, s3_bucket: str, chunk_size=MIN_CHUNK_SIZE
+    ):
         with open(filepath, "rb") as file:
             while chunk := file.read(chunk_size):
                 yield chunk
 
-        self._refresh_file_in_cache(s3_key, s3_bucket)
+        record_file_access(filepath)
 
     def _stream_s3_object(
-        self, s3_object, s3_key: str, s3_bucket: str, destiny_path: str, chunk_size=1024
+        self,
+        s3_object,
+        s3_key: str,
+        s3_bucket: str,
+        destiny_path: str,
+        chunk_size=MIN_CHUNK_SIZE,
     ):
         for chunk in s3_object["Body"].iter_chunks(chunk_size=chunk_size):
             yield chunk
 
         self._download_and_add_to_cache(s3_key, s3_bucket, destiny_path)
 
-    def _refresh_file_in_cache(self, s3_key: str, s3_bucket: str):
-        s3_file = append_s3_bucket_prefix(s3_key, bucket=s3_bucket)
-        worker_cache_files_tasks.refresh_file_in_cache.delay(s3_file)
-
     def _download_and_add_to_cache(
         self, s3_key: str, s3_bucket: str, destiny_path: str
     ):
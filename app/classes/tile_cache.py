@@ -0,0 +1,364 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from django_redis import get_redis_connection
+from opentelemetry import metrics
+from webodm import settings
+from worker.utils.cache_eviction import (
+    CacheEntry,
+    LruEvictionPolicy,
+    evict,
+    get_eviction_target_size,
+)
+
+logger = logging.getLogger("app.logger")
+meter = metrics.get_meter("app.tile_cache")
+
+tile_cache_hits = meter.create_counter(
+    "tile_cache_hits", description="Tiles served from the tile cache"
+)
+tile_cache_misses = meter.create_counter(
+    "tile_cache_misses", description="Tiles rendered and added to the tile cache"
+)
+
+# Bump when the rendering of tiles changes, so previously cached tiles are not served
+TILE_CACHE_FORMAT_VERSION = 2
+
+GENERATION_KEY = "tile_cache_generation:{}"
+REDIS_TILE_KEY = "tile_cache:{}"
+LOCK_KEY = "tile_cache_lock:{}"
+
+# Deletes a lock only when it still holds the token of the claim (it may have
+# expired and been claimed by another request)
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class CachedTile:
+    def __init__(self, content: bytes, content_type: str, etag: str):
+        self.content = content
+        self.content_type = content_type
+        self.etag = etag
+
+
+class TileCache:
+    """
+    Content addressed cache of rendered tiles, with a local disk tier and an
+    optional Redis tier (shared by all the webapp instances).
+
+    Keys are a hash of the tile parameters, the version of the raster (file
+    mtime or S3 ETag) and a per task generation, bumped when the assets of
+    the task change. Tiles are stored with the hash of their content, used
+    as a strong ETag.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_size: int,
+        ttl: int,
+        redis_ttl: int = 0,
+        redis_max_tile_size: int = 0,
+    ):
+        self.root = root
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_ttl = redis_ttl
+        self.redis_max_tile_size = redis_max_tile_size
+        self._scripts = {}
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def make_key(self, task_id, raster_version: str, params: dict):
+        generation = self._get_generation(task_id)
+        key_data = json.dumps(
+            [
+                TILE_CACHE_FORMAT_VERSION,
+                str(task_id),
+                generation,
+                raster_version,
+                params,
+            ],
+            sort_keys=True,
+            default=str,
+        )
+
+        return hashlib.sha256(key_data.encode()).hexdigest()
+
+    def get(self, task_id, key: str):
+        tile = self._read_disk(task_id, key)
+
+        if tile is None and self.redis_ttl > 0:
+            tile = self._read_redis(key)
+
+            if tile is not None:
+                self._write_disk(task_id, key, tile)
+
+        if tile is None:
+            tile_cache_misses.add(1)
+        else:
+            tile_cache_hits.add(1)
+
+        return tile
+
+    def set(self, task_id, key: str, content: bytes, content_type: str):
+        tile = CachedTile(content, content_type, get_tile_etag(content))
+        self._write_disk(task_id, key, tile)
+
+        if self.redis_ttl > 0 and len(content) <= self.redis_max_tile_size:
+            self._write_redis(key, tile)
+
+        return tile
+
+    def lock(self, key: str, timeout: int):
+        """
+        Claim the rendering of the tiles of key (e.g. a block of tiles) for at
+        most timeout seconds. Returns the token of the claim, to unlock it,
+        None when it was not claimed. Always claimed when redis is unavailable.
+        """
+        token = uuid.uuid4().hex
+
+        try:
+            if not _get_redis_client().set(
+                LOCK_KEY.format(key), token, nx=True, ex=timeout
+            ):
+                return None
+        except Exception as e:
+            logger.warning(f"Cannot lock tile rendering. Original error: {e}")
+
+        return token
+
+    def unlock(self, key: str, token: str):
+        """
+        Release a claim of lock, unless it expired and was claimed again
+        """
+        try:
+            self._run_script(UNLOCK_SCRIPT, [LOCK_KEY.format(key)], [token])
+        except Exception as e:
+            logger.warning(f"Cannot unlock tile rendering. Original error: {e}")
+
+    def wait_unlock(self, key: str, timeout: float, interval: float = 0.05):
+        """
+        Wait for the rendering claimed with lock to complete, for at most
+        timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+
+        try:
+            client = _get_redis_client()
+
+            while client.exists(LOCK_KEY.format(key)) and time.monotonic() < deadline:
+                time.sleep(interval)
+        except Exception as e:
+            logger.warning(f"Cannot wait for tile rendering. Original error: {e}")
+
+    def _run_script(self, source: str, keys: list, args: list):
+        script = self._scripts.get(source)
+
+        if script is None:
+            script = _get_redis_client().register_script(source)
+            self._scripts[source] = script
+
+        return script(keys=keys, args=args)
+
+    def invalidate(self, task_id):
+        """
+        Drop the tiles of a task, after its assets changed
+        """
+        try:
+            _get_redis_client().incr(GENERATION_KEY.format(task_id))
+        except Exception as e:
+            logger.warning(
+                f"Cannot invalidate the cached tiles of {task_id}. Original error: {e}"
+            )
+
+        shutil.rmtree(self._task_dir(task_id), ignore_errors=True)
+
+    def evict(self):
+        """
+        Remove expired tiles, then the least recently read tiles down to the
+        low-water mark when the cache is over its size budget. Returns the
+        freed bytes.
+        """
+        entries = []
+        freed = 0
+        expired_before = time.time() - self.ttl
+
+        for entry in self._scan():
+            if self._created_at(entry.file) < expired_before:
+                if self._remove(entry.file):
+                    freed += entry.size
+            else:
+                entries.append(entry)
+
+        cache_size = sum(entry.size for entry in entries)
+
+        if cache_size <= self.max_size:
+            return freed
+
+        entries.sort(key=lambda entry: entry.accessed_at)
+
+        def load_entries(start: int, count: int):
+            return entries[start : start + count]
+
+        def remove_entries(selected: list[CacheEntry]):
+            removed = set(entry.file for entry in selected)
+
+            for file in removed:
+                self._remove(file)
+
+            entries[:] = [entry for entry in entries if entry.file not in removed]
+
+        return freed + evict(
+            LruEvictionPolicy(),
+            load_entries,
+            remove_entries,
+            cache_size - get_eviction_target_size(self.max_size, 0),
+        )
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def _get_generation(self, task_id):
+        try:
+            generation = _get_redis_client().get(GENERATION_KEY.format(task_id))
+        except Exception as e:
+            logger.warning(
+                f"Cannot read the tile cache generation. Original error: {e}"
+            )
+            generation = None
+
+        return int(generation) if generation else 0
+
+    def _read_disk(self, task_id, key: str):
+        path = self._tile_path(task_id, key)
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        tile = _decode_tile(data)
+
+        if tile is None or self._created_at(path) < time.time() - self.ttl:
+            self._remove(path)
+            return None
+
+        # The access time is the last read, used by eviction
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except OSError:
+            pass
+
+        return tile
+
+    def _write_disk(self, task_id, key: str, tile: CachedTile):
+        path = self._tile_path(task_id, key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with open(tmp_path, "wb") as f:
+                f.write(_encode_tile(tile))
+
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Failed to store tile {path}. Original error: {e}")
+
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _read_redis(self, key: str):
+        try:
+            data = _get_redis_client().get(REDIS_TILE_KEY.format(key))
+        except Exception as e:
+            logger.warning(f"Cannot read tile from redis. Original error: {e}")
+            return None
+
+        return _decode_tile(data) if data else None
+
+    def _write_redis(self, key: str, tile: CachedTile):
+        try:
+            _get_redis_client().set(
+                REDIS_TILE_KEY.format(key), _encode_tile(tile), ex=self.redis_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Cannot store tile in redis. Original error: {e}")
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def _created_at(self, path: str):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return 0
+
+    def _task_dir(self, task_id):
+        return os.path.join(self.root, str(task_id))
+
+    def _tile_path(self, task_id, key: str):
+        return os.path.join(self._task_dir(task_id), key[:2], key)
+
+    def _scan(self):
+        entries = []
+
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                entries.append(CacheEntry(path, stat.st_atime, stat.st_size))
+
+        return entries
+
+
+def _get_redis_client():
+    return get_redis_connection("s3_images_cache")
+
+
+def get_tile_etag(content: bytes):
+    return '"{}"'.format(hashlib.sha256(content).hexdigest()[:32])
+
+
+def _encode_tile(tile: CachedTile):
+    return f"{tile.content_type}\n{tile.etag}\n".encode() + tile.content
+
+
+def _decode_tile(data: bytes):
+    parts = data.split(b"\n", 2)
+
+    if len(parts) != 3:
+        return None
+
+    return CachedTile(parts[2], parts[0].decode(), parts[1].decode())
+
+
+tile_cache = TileCache(
+    settings.TILE_CACHE_DIR,
+    settings.TILE_CACHE_MAX_SIZE_MB * 1024 * 1024,
+    settings.TILE_CACHE_TTL_SECONDS,
+    settings.TILE_CACHE_REDIS_TTL_SECONDS,
+    settings.TILE_CACHE_REDIS_MAX_TILE_KB * 1024,
+)
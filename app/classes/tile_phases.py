@@ -0,0 +1,68 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from opentelemetry import metrics, trace
+
+tracer = trace.get_tracer("app.tiler")
+meter = metrics.get_meter("app.tiler")
+
+# Most phases take a few milliseconds
+PHASE_DURATION_BUCKETS = [0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+tile_phase_duration = meter.create_histogram(
+    "tiler_phase_duration",
+    unit="ms",
+    description="Duration of the phases of the rendering of tiles",
+    explicit_bucket_boundaries_advisory=PHASE_DURATION_BUCKETS,
+)
+
+# Phases of the rendering of a tile, in order
+TILE_PHASES = (
+    "cache",
+    "open",
+    "tile_exists",
+    "cutline",
+    "read",
+    "formula",
+    "hillshade",
+    "colormap",
+    "encode",
+)
+
+_recorders = threading.local()
+
+
+@contextmanager
+def tile_phase(phase: str, **attributes):
+    """
+    Span and duration metric of a phase of the rendering of tiles (see
+    TILE_PHASES)
+    """
+    start = time.perf_counter()
+
+    with tracer.start_as_current_span(f"tiler.{phase}", attributes=attributes):
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            tile_phase_duration.record(duration * 1000, {"phase": phase, **attributes})
+
+            samples = getattr(_recorders, "samples", None)
+            if samples is not None:
+                samples.setdefault(phase, []).append(duration)
+
+
+@contextmanager
+def record_tile_phases():
+    """
+    Collect the durations (in seconds) of the phases of the tiles rendered by
+    the current thread within the block, by phase
+    """
+    previous = getattr(_recorders, "samples", None)
+    samples = _recorders.samples = {}
+
+    try:
+        yield samples
+    finally:
+        _recorders.samples = previous
@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from opentelemetry import metrics
+
+logger = logging.getLogger("app.logger")
+meter = metrics.get_meter("app.tile_pyramid")
+
+tile_pyramid_hits = meter.create_counter(
+    "tile_pyramid_hits", description="Tiles served from precomputed tile pyramids"
+)
+
+# Tiles of the default visualizations of the map (see Map.jsx)
+PYRAMID_TILESIZE = 512
+DEFAULT_COLOR_MAPS = {"dsm": "viridis", "dtm": "viridis"}
+DEFAULT_HILLSHADE = {"dsm": 6.0, "dtm": 6.0}
+
+_connections = threading.local()
+
+
+def get_pyramid_params(statistics: dict, tile_type: str):
+    """
+    Parameters of the tiles of the map for a raster with the given default
+    statistics (the info of get_raster_metadata), as the map requests them
+    """
+    bands = sorted(statistics["statistics"], key=int)
+
+    # The map takes the range of the last band
+    band = statistics["statistics"][bands[-1]]
+
+    return {
+        "rescale": [band["min"], band["max"]],
+        "color_map": DEFAULT_COLOR_MAPS.get(tile_type),
+        "hillshade": DEFAULT_HILLSHADE.get(tile_type),
+        "tilesize": PYRAMID_TILESIZE,
+    }
+
+
+def matches_pyramid_params(params: dict, rescale, color_map, hillshade, tilesize):
+    """
+    Whether tiles requested with these parameters are the tiles of a pyramid
+    """
+    try:
+        rescale = [float(v) for v in rescale.split(",")]
+        hillshade = float(hillshade) if hillshade is not None else None
+    except ValueError:
+        return False
+
+    return (
+        rescale == params["rescale"]
+        and color_map == params["color_map"]
+        and hillshade == params["hillshade"]
+        and tilesize == params["tilesize"]
+    )
+
+
+def get_tile_format(content: bytes):
+    """
+    Extension of a rendered tile (as in the tile URLs) from its content
+    """
+    if content.startswith(b"\x89PNG"):
+        return "png"
+    if content.startswith(b"RIFF") and content[8:12] == b"WEBP":
+        return "webp"
+    return "jpg"
+
+
+def write_tile_pyramid(path: str, tiles, metadata: dict):
+    """
+    Write tiles, an iterable of (z, x, y, content) in the XYZ scheme, to an
+    MBTiles archive. The archive replaces path once complete.
+
+    Returns the number of tiles written.
+    """
+    tmp_path = path + ".tmp"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    count = 0
+
+    try:
+        conn = sqlite3.connect(tmp_path)
+
+        try:
+            conn.execute("CREATE TABLE metadata (name text, value text)")
+            conn.execute(
+                "CREATE TABLE tiles (zoom_level integer, tile_column integer, "
+                "tile_row integer, tile_data blob)"
+            )
+            conn.executemany(
+                "INSERT INTO metadata (name, value) VALUES (?, ?)",
+                [
+                    (name, value if isinstance(value, str) else json.dumps(value))
+                    for name, value in metadata.items()
+                ],
+            )
+
+            for z, x, y, content in tiles:
+                # MBTiles rows are in the TMS scheme
+                conn.execute(
+                    "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                    (z, x, (2**z - 1) - y, sqlite3.Binary(content)),
+                )
+                count += 1
+
+            conn.execute(
+                "CREATE UNIQUE INDEX tile_index ON tiles "
+                "(zoom_level, tile_column, tile_row)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return count
+
+
+def get_pyramid_tile(path: str, z: int, x: int, y: int):
+    """
+    Content of a tile (XYZ scheme) of an MBTiles archive, None when it is
+    not in the archive or the archive does not exist
+    """
+    conn = _get_connection(path)
+
+    if conn is None:
+        return None
+
+    try:
+        row = conn.execute(
+            "SELECT tile_data FROM tiles "
+            "WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, (2**z - 1) - y),
+        ).fetchone()
+    except sqlite3.Error as e:
+        logger.warning(f"Cannot read tile from {path}. Original error: {e}")
+        _close_connection(path)
+        return None
+
+    if row is None:
+        return None
+
+    tile_pyramid_hits.add(1)
+
+    return bytes(row[0])
+
+
+def _get_connection(path: str):
+    """
+    Read only connection to an archive, kept per thread until the archive
+    changes or is removed
+    """
+    connections = getattr(_connections, "connections", None)
+
+    if connections is None:
+        connections = _connections.connections = {}
+
+    try:
+        version = os.stat(path).st_mtime_ns
+    except OSError:
+        _close_connection(path)
+        return None
+
+    cached = connections.get(path)
+
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    _close_connection(path)
+
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    except sqlite3.Error as e:
+        logger.warning(f"Cannot open tile pyramid {path}. Original error: {e}")
+        return None
+
+    connections[path] = (version, conn)
+
+    return conn
+
+
+def _close_connection(path: str):
+    connections = getattr(_connections, "connections", None) or {}
+    cached = connections.pop(path, None)
+
+    if cached is not None:
+        cached[1].close()
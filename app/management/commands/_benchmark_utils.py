@@ -0,0 +1,39 @@
+import statistics
+import time
+from contextlib import contextmanager
+
+
+def percentile(values, percent):
+    if len(values) == 0:
+        return 0.0
+
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def format_latencies(label, values):
+    """
+    Format a list of latencies (in seconds) as a single report line in milliseconds
+    """
+    if len(values) == 0:
+        return "{}: no samples".format(label)
+
+    return "{}: n={} mean={:.2f}ms p50={:.2f}ms p95={:.2f}ms p99={:.2f}ms max={:.2f}ms".format(
+        label,
+        len(values),
+        statistics.mean(values) * 1000,
+        percentile(values, 50) * 1000,
+        percentile(values, 95) * 1000,
+        percentile(values, 99) * 1000,
+        max(values) * 1000,
+    )
+
+
+@contextmanager
+def measure(samples):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        samples.append(time.perf_counter() - start)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from webodm import settings
+from app.utils.s3_utils import open_cog_reader, append_s3_bucket_prefix
+from worker import cache_files as worker_cache_files_tasks
+from worker.utils.redis_file_cache import flush_file_accesses
+from ._benchmark_utils import format_latencies, measure
+
+
+class Command(BaseCommand):
+    help = "Load test tile reads of a cached raster, comparing a broker message per access with batched access recording"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500, help="Tile reads for each scenario")
+        parser.add_argument("--concurrency", type=int, default=8, help="Concurrent readers")
+        parser.add_argument("--fixture", type=str, required=False,
+                            default=os.path.join(settings.BASE_DIR, "app", "fixtures", "orthophoto.tif"),
+                            help="Raster to read")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        bench_dir = os.path.join(settings.MEDIA_ROOT, "benchmark_cache_access")
+        raster = os.path.join(bench_dir, "orthophoto.tif")
+        os.makedirs(bench_dir, exist_ok=True)
+        shutil.copy(options.get('fixture'), raster)
+        url = append_s3_bucket_prefix(raster)
+
+        try:
+            with open_cog_reader(url) as src:
+                west, south, east, north = src.bounds
+                tile = src.tms.tile((west + east) / 2, (south + north) / 2, src.maxzoom)
+
+            for label, per_request_message in [("celery message per access", True), ("batched access recording", False)]:
+                samples, elapsed, messages = self._run(url, tile, options, per_request_message)
+
+                if not per_request_message:
+                    start = time.perf_counter()
+                    flushed = flush_file_accesses()
+                    self.stdout.write("  final flush wrote {} file(s) in {:.2f}ms".format(flushed, (time.perf_counter() - start) * 1000))
+
+                self.stdout.write(format_latencies(label, samples))
+                self.stdout.write("  broker messages: {} ({:.1f}/s)".format(messages, messages / elapsed if elapsed > 0 else 0))
+        finally:
+            shutil.rmtree(bench_dir, ignore_errors=True)
+
+    def _run(self, url, tile, options, per_request_message):
+        samples = []
+        messages = [0]
+
+        def read_tile(_):
+            with measure(samples):
+                with open_cog_reader(url) as src:
+                    src.tile(tile.x, tile.y, tile.z)
+
+                # Previous behaviour of open_cog_reader
+                if per_request_message:
+                    worker_cache_files_tasks.refresh_file_in_cache.delay(url)
+                    messages[0] += 1
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options.get('concurrency')) as executor:
+            list(executor.map(read_tile, range(options.get('requests'))))
+        elapsed = time.perf_counter() - start
+
+        return samples, elapsed, messages[0]
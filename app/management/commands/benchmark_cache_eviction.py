@@ -0,0 +1,150 @@
+import json
+import random
+import time
+from collections import OrderedDict
+from django.core.management.base import BaseCommand
+from worker.utils.cache_eviction import (
+    CacheEntry,
+    evict,
+    get_eviction_policy,
+    get_eviction_target_size,
+)
+
+MB = 1024 * 1024
+
+
+class ReplayCache:
+    """
+    In memory model of the S3 file cache admission and eviction
+    """
+
+    def __init__(self, policy, max_size, sample_size):
+        self.policy = policy
+        self.max_size = max_size
+        self.sample_size = sample_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_hit = 0
+        self.bytes_missed = 0
+        self.eviction_batches = 0
+        self.evicted_files = 0
+
+    def access(self, file, size, accessed_at):
+        entry = self.entries.get(file)
+
+        if entry is not None:
+            entry.accessed_at = accessed_at
+            entry.hits += 1
+            self.entries.move_to_end(file)
+            self.hits += 1
+            self.bytes_hit += size
+            return
+
+        self.misses += 1
+        self.bytes_missed += size
+
+        if size > self.max_size:
+            return
+
+        if self.max_size - self.size < size:
+            self.eviction_batches += 1
+            evict(
+                self.policy,
+                self._load_entries,
+                self._remove_entries,
+                self.size - get_eviction_target_size(self.max_size, size),
+                self.sample_size,
+            )
+
+        if self.max_size - self.size >= size:
+            self.entries[file] = CacheEntry(file, accessed_at, size, 1)
+            self.size += size
+
+    def _load_entries(self, start, count):
+        return list(self.entries.values())[start:start + count]
+
+    def _remove_entries(self, entries):
+        for entry in entries:
+            del self.entries[entry.file]
+            self.size -= entry.size
+            self.evicted_files += 1
+
+
+class Command(BaseCommand):
+    help = "Replay a cache access trace (see WO_S3_CACHE_ACCESS_TRACE_FILE) against the cache eviction policies"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--trace", type=str, required=False, help="JSON lines access trace. A synthetic trace is used when omitted")
+        parser.add_argument("--policies", type=str, default="lru,gdsf,pin_hot_cogs", help="Comma separated policies to compare")
+        parser.add_argument("--cache-size-mb", type=int, default=4096, help="Simulated cache size")
+        parser.add_argument("--sample-size", type=int, default=1000, help="Entries ranked by the policy per eviction round")
+        parser.add_argument("--accesses", type=int, default=100000, help="Accesses of the synthetic trace")
+        parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic trace")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        if options.get('trace'):
+            trace = self._load_trace(options.get('trace'))
+        else:
+            trace = self._synthetic_trace(options.get('accesses'), options.get('seed'))
+
+        max_size = options.get('cache_size_mb') * MB
+        self.stdout.write("Replaying {} accesses of {} files, cache size {}MB".format(
+            len(trace), len(set(file for file, _, _ in trace)), options.get('cache_size_mb')))
+
+        for name in options.get('policies').split(','):
+            cache = ReplayCache(get_eviction_policy(name, max_size), max_size, options.get('sample_size'))
+
+            start = time.perf_counter()
+            for file, size, accessed_at in trace:
+                cache.access(file, size, accessed_at)
+            elapsed = time.perf_counter() - start
+
+            total = cache.hits + cache.misses
+            total_bytes = cache.bytes_hit + cache.bytes_missed
+            self.stdout.write("{}: hit ratio={:.2f}% byte hit ratio={:.2f}% downloaded={:.1f}MB "
+                  "eviction batches={} evicted files={} replay={:.2f}s".format(
+                name,
+                cache.hits / total * 100 if total else 0,
+                cache.bytes_hit / total_bytes * 100 if total_bytes else 0,
+                cache.bytes_missed / MB,
+                cache.eviction_batches,
+                cache.evicted_files,
+                elapsed))
+
+    def _load_trace(self, path):
+        trace = []
+
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                access = json.loads(line)
+                for _ in range(int(access.get('hits', 1))):
+                    trace.append((access['file'], int(access['size']), float(access['ts'])))
+
+        trace.sort(key=lambda access: access[2])
+        return trace
+
+    def _synthetic_trace(self, accesses, seed):
+        # Many small, frequently viewed orthophotos with a long tail of
+        # popularity, plus a few large DEMs that are rarely viewed
+        rnd = random.Random(seed)
+        small = [("/media/project/{}/orthophoto.tif".format(i), rnd.randint(2, 40) * MB) for i in range(600)]
+        large = [("/media/project/{}/dsm.tif".format(i), rnd.randint(500, 1500) * MB) for i in range(20)]
+        weights = [1.0 / (rank + 1) for rank in range(len(small))]
+
+        trace = []
+        for i in range(accesses):
+            if rnd.random() < 0.01:
+                file, size = rnd.choice(large)
+            else:
+                file, size = rnd.choices(small, weights)[0]
+            trace.append((file, size, float(i)))
+
+        return trace
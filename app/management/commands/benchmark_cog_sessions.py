@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+from django.core.management.base import BaseCommand
+from webodm import settings
+from app.utils import s3_utils
+from app.tests.utils import start_simple_s3_server
+from ._benchmark_utils import format_latencies, measure
+
+
+class Command(BaseCommand):
+    help = "Measure tile latency of open_cog_reader with cold and warm S3 sessions against a local S3 stub"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50, help="Tiles to read for each scenario")
+        parser.add_argument("--latency-ms", type=float, default=2, help="Simulated S3 round trip latency")
+        parser.add_argument("--port", type=int, default=9100, help="Port of the S3 stub")
+        parser.add_argument("--fixture", type=str, required=False,
+                            default=os.path.join(settings.BASE_DIR, "app", "fixtures", "orthophoto.tif"),
+                            help="Raster served by the S3 stub")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        iterations = options.get('iterations')
+        root_dir = tempfile.mkdtemp()
+        bucket = "benchmark"
+        key = "project/task/assets/orthophoto.tif"
+
+        os.makedirs(os.path.join(root_dir, bucket, os.path.dirname(key)))
+        shutil.copy(options.get('fixture'), os.path.join(root_dir, bucket, key))
+        url = "s3://{}/{}".format(bucket, key)
+
+        try:
+            with start_simple_s3_server(root_dir, options.get('port'), options.get('latency_ms')) as endpoint, \
+                 mock.patch.multiple(settings,
+                                     S3_DOWNLOAD_ENDPOINT=endpoint,
+                                     S3_DOWNLOAD_ACCESS_KEY="benchmark",
+                                     S3_DOWNLOAD_SECRET_KEY="benchmark"), \
+                 mock.patch.object(s3_utils, "worker_cache_files_tasks"):
+                tile = self._find_tile(url)
+
+                cold = self._read_tiles(url, tile, iterations, cold=True)
+                warm = self._read_tiles(url, tile, iterations, cold=False)
+        finally:
+            s3_utils.reset_s3_sessions()
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+        self.stdout.write("Tile {}/{}/{} of {}".format(tile[2], tile[0], tile[1], url))
+        self.stdout.write(format_latencies("cold session", cold))
+        self.stdout.write(format_latencies("warm session", warm))
+
+    def _find_tile(self, url):
+        with s3_utils.open_cog_reader(url) as src:
+            west, south, east, north = src.bounds
+            tile = src.tms.tile((west + east) / 2, (south + north) / 2, src.maxzoom)
+
+        return tile.x, tile.y, tile.z
+
+    def _read_tiles(self, url, tile, iterations, cold):
+        samples = []
+        x, y, z = tile
+
+        for _ in range(iterations):
+            if cold:
+                s3_utils.reset_s3_sessions()
+
+            with measure(samples):
+                with s3_utils.open_cog_reader(url) as src:
+                    src.tile(x, y, z)
+
+        return samples
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from webodm import settings
+from app.api.tasks import download_file_stream
+from app.classes.task_assets_manager import LocalAssetSource, S3AssetSource
+from app.utils import s3_utils
+from app.tests.utils import start_simple_s3_server
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = "Measure download throughput of local and S3 assets with 1KB chunks and with adaptive chunks"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size-mb", type=int, default=256, help="Size of the downloaded file")
+        parser.add_argument("--latency-ms", type=float, default=0, help="Simulated S3 round trip latency")
+        parser.add_argument("--port", type=int, default=9100, help="Port of the S3 stub")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        size = options.get('size_mb') * MB
+        root_dir = tempfile.mkdtemp()
+        bucket = "benchmark"
+        key = "project/task/assets/georeferenced_model.laz"
+        path = os.path.join(root_dir, bucket, key)
+
+        os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            for _ in range(options.get('size_mb')):
+                f.write(os.urandom(MB))
+
+        factory = RequestFactory()
+
+        try:
+            local = LocalAssetSource(path)
+            self._report("local, 1KB chunks", size, lambda: local.stream(chunk_size=1024))
+            self._report("local, adaptive chunks", size, lambda: local.stream())
+            self._report("local, FileResponse", size,
+                         lambda: download_file_stream(factory.get('/'), local, "attachment", "model.laz"))
+
+            with start_simple_s3_server(root_dir, options.get('port'), options.get('latency_ms')) as endpoint, \
+                 mock.patch.multiple(settings,
+                                     S3_DOWNLOAD_ENDPOINT=endpoint,
+                                     S3_DOWNLOAD_ACCESS_KEY="benchmark",
+                                     S3_DOWNLOAD_SECRET_KEY="benchmark"):
+                s3_utils.reset_s3_sessions()
+                s3 = S3AssetSource(key, bucket, s3_utils.get_s3_object_metadata(key, bucket))
+                self._report("s3, 1KB chunks", size, lambda: s3.stream(chunk_size=1024))
+                self._report("s3, adaptive chunks", size, lambda: s3.stream())
+        finally:
+            s3_utils.reset_s3_sessions()
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+    def _report(self, label, size, body):
+        start = time.perf_counter()
+        chunks = 0
+        received = 0
+
+        for chunk in body():
+            chunks += 1
+            received += len(chunk)
+
+        elapsed = time.perf_counter() - start
+
+        if received != size:
+            self.stderr.write("{}: received {} bytes, expected {}".format(label, received, size))
+
+        self.stdout.write("{}: {:.1f}MB/s ({} chunks, {:.2f}s)".format(label, size / MB / elapsed, chunks, elapsed))
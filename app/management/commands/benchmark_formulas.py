@@ -0,0 +1,62 @@
+import re
+import numpy as np
+from django.core.management.base import BaseCommand
+from rio_tiler.expression import apply_expression, parse_expression
+from app.api.formulas import compile_formula, lookup_formula
+from ._benchmark_utils import format_latencies, measure
+
+
+class Command(BaseCommand):
+    help = "Compare the evaluation of compiled formulas with rio-tiler expressions"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20, help="Evaluations of each formula per size")
+        parser.add_argument("--formulas", type=str, default="NDVI,VARI,EXG", help="Formulas to evaluate")
+        parser.add_argument("--bands", type=str, default="RGBN", help="Band order of the raster")
+        parser.add_argument("--full-size", type=int, default=4096, help="Side of the full raster case")
+        parser.add_argument("--raster", type=str, required=False,
+                            help="Multispectral raster to use for the full raster case, instead of a synthetic one")
+        parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic bands")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        rnd = np.random.default_rng(options.get('seed'))
+        band_count = len(re.findall(r"[A-Z][a-z]*", options.get('bands')))
+        cases = [("512", rnd.integers(0, 256, size=(band_count, 512, 512), dtype=np.uint8))]
+
+        if options.get('raster'):
+            import rasterio
+            with rasterio.open(options.get('raster')) as src:
+                cases.append(("full ({}x{})".format(src.width, src.height), src.read()))
+        else:
+            size = options.get('full_size')
+            cases.append(("full ({}x{})".format(size, size),
+                          rnd.integers(0, 256, size=(band_count, size, size), dtype=np.uint8)))
+
+        for label, data in cases:
+            self.stdout.write("{}:".format(label))
+
+            for algo in options.get('formulas').split(","):
+                # The parsing of each request is part of the measure
+                samples = {"compiled": [], "rio-tiler expression": []}
+
+                for _ in range(options.get('iterations')):
+                    with measure(samples["compiled"]):
+                        expr, _hrange = lookup_formula(algo, options.get('bands'))
+                        formula = compile_formula(expr)
+                        compiled = formula.evaluate(data[[i - 1 for i in formula.indexes]])
+
+                    with measure(samples["rio-tiler expression"]):
+                        expr, _hrange = lookup_formula.__wrapped__(algo, options.get('bands'))
+                        indexes = parse_expression(expr)
+                        reference = apply_expression(expr.lower().split(","), ["b{}".format(i) for i in indexes],
+                                                     data[[i - 1 for i in indexes]])
+
+                self.stdout.write("  {} ({}):".format(algo, expr))
+                for name, values in samples.items():
+                    self.stdout.write("    " + format_latencies(name, values))
+
+                finite = np.abs(reference) < 1e30
+                self.stdout.write("    max difference: {:.2e}".format(float(np.abs(compiled[finite] - reference[finite]).max())))
@@ -0,0 +1,63 @@
+import numpy as np
+from django.core.management.base import BaseCommand
+from app.api.hillshade import LightSource
+from app.api.hsvblend import hsv_blend, hsv_blend_legacy
+from ._benchmark_utils import format_latencies, measure
+
+
+class Command(BaseCommand):
+    help = "Compare the hillshade and HSV blend kernels with their previous implementations"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=20, help="Runs of each kernel per size")
+        parser.add_argument("--full-size", type=int, default=4096, help="Side of the full raster case")
+        parser.add_argument("--raster", type=str, required=False,
+                            help="Elevation raster to use for the full raster case, instead of a synthetic one")
+        parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic elevation")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        rnd = np.random.default_rng(options.get('seed'))
+        cases = [("256", self._synthetic(rnd, 256 + 32)),
+                 ("512", self._synthetic(rnd, 512 + 32))]
+
+        if options.get('raster'):
+            import rasterio
+            with rasterio.open(options.get('raster')) as src:
+                cases.append(("full ({}x{})".format(src.width, src.height), src.read(1).astype(np.float32)))
+        else:
+            size = options.get('full_size')
+            cases.append(("full ({}x{})".format(size, size), self._synthetic(rnd, size)))
+
+        ls = LightSource(azdeg=315, altdeg=45)
+
+        for label, elevation in cases:
+            rgb = rnd.integers(0, 256, size=(3,) + elevation.shape, dtype=np.uint8)
+            out_intensity = np.empty(elevation.shape, dtype=np.float32)
+            out_rgb = np.empty_like(rgb)
+
+            samples = {"hillshade": [], "hillshade (normals)": [], "hsv_blend": [], "hsv_blend (legacy)": []}
+            for _ in range(options.get('iterations')):
+                with measure(samples["hillshade"]):
+                    intensity = ls.hillshade(elevation, vert_exag=1.5, dx=0.5, dy=0.5, out=out_intensity)
+                with measure(samples["hillshade (normals)"]):
+                    reference = ls.hillshade_normals(elevation.astype(np.float64), vert_exag=1.5, dx=0.5, dy=0.5)
+
+                intensity *= 255.0
+                with measure(samples["hsv_blend"]):
+                    blended = hsv_blend(rgb, intensity, out=out_rgb)
+                with measure(samples["hsv_blend (legacy)"]):
+                    blended_legacy = hsv_blend_legacy(rgb, intensity)
+
+            self.stdout.write("{}:".format(label))
+            for name, values in samples.items():
+                self.stdout.write("  " + format_latencies(name, values))
+            self.stdout.write("  max difference: intensity={:.2e} rgb={}".format(
+                float(np.nanmax(np.abs(intensity / 255.0 - reference))),
+                int(np.abs(blended.astype(np.int16) - blended_legacy.astype(np.int16)).max())))
+
+    def _synthetic(self, rnd, size):
+        # Smooth terrain, a random walk in both directions
+        return np.cumsum(np.cumsum(rnd.normal(size=(size, size)), axis=0), axis=1).astype(np.float32)
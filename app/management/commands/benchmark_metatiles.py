@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from app.api.tiler import get_zoom_safe, render_metatile, render_tile
+from app.utils.s3_utils import open_cog_reader
+from ._benchmark_utils import format_latencies, measure
+
+
+class Command(BaseCommand):
+    help = "Compare the rendering of tiles by metatiles with the rendering of single tiles"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("raster", type=str, help="Path or URL of the raster (COG) to render")
+        parser.add_argument("--tile-type", type=str, default="dsm", choices=["orthophoto", "dsm", "dtm"],
+                            help="Type of the raster")
+        parser.add_argument("--zoom", type=int, required=False, help="Zoom level of the tiles (max zoom by default)")
+        parser.add_argument("--size", type=int, default=4, help="Side of the metatiles, in tiles")
+        parser.add_argument("--metatiles", type=int, default=4, help="Metatiles to render")
+        parser.add_argument("--tilesize", type=int, default=256, help="Size of the tiles")
+        parser.add_argument("--rescale", type=str, default="0,1000", help="Range of the tiles values")
+        parser.add_argument("--color-map", type=str, default="viridis", help="Color map of the tiles")
+        parser.add_argument("--hillshade", type=str, default="6", help="Hillshade of the tiles (0 disables it)")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        url = options.get('raster')
+        tile_type = options.get('tile_type')
+        size = options.get('size')
+
+        with open_cog_reader(url) as src:
+            zoom = options.get('zoom')
+            if zoom is None:
+                zoom = get_zoom_safe(src)[1]
+            tiles = set((t.x, t.y) for t in src.tms.tiles(*src.bounds, zooms=[zoom]))
+
+        # Metatiles within the raster
+        origins = sorted(set((x - x % size, y - y % size) for x, y in tiles))
+        origins.sort(key=lambda o: -sum((o[0] + i, o[1] + j) in tiles for i in range(size) for j in range(size)))
+        origins = origins[:options.get('metatiles')]
+
+        params = {
+            'rescale': options.get('rescale'),
+            'color_map': options.get('color_map'),
+            'hillshade': options.get('hillshade') if options.get('hillshade') != "0" else None,
+            'tilesize': options.get('tilesize'),
+            'ext': 'png',
+        }
+
+        samples = {"metatile (per tile)": [], "single tile": []}
+        rendered_tiles = 0
+
+        for x, y in origins:
+            with measure(samples["metatile (per tile)"]):
+                rendered = render_metatile(url, tile_type, zoom, x, y, size, **params)
+
+            count = max(1, len(rendered))
+            samples["metatile (per tile)"][-1] /= count
+            rendered_tiles += len(rendered)
+
+            for tile_x, tile_y in rendered:
+                with measure(samples["single tile"]):
+                    render_tile(url, tile_type, zoom, tile_x, tile_y, **params)
+
+        self.stdout.write("{} tiles of {} metatiles ({}x{}) at zoom {}:".format(rendered_tiles, len(origins), size, size, zoom))
+        for name, values in samples.items():
+            self.stdout.write("  " + format_latencies(name, values))
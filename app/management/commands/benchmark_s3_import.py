@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+from django.core.management.base import BaseCommand
+from webodm import settings
+from app.classes.s3_transfer_pool import S3DownloadPool
+from app.utils import s3_utils
+from app.tests.utils import start_simple_s3_server
+
+
+class Command(BaseCommand):
+    help = "Measure the time to import the images of a task from a local S3 stub, serially and with the transfer pool"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--images", type=int, default=1000, help="Images to import")
+        parser.add_argument("--size-kb", type=int, default=64, help="Size of each image")
+        parser.add_argument("--latency-ms", type=float, default=2, help="Simulated S3 round trip latency")
+        parser.add_argument("--workers", type=int, default=settings.S3_IMPORT_MAX_WORKERS,
+                            help="Workers of the transfer pool")
+        parser.add_argument("--port", type=int, default=9100, help="Port of the S3 stub")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        root_dir = tempfile.mkdtemp()
+        bucket = "benchmark"
+        images = []
+
+        os.makedirs(os.path.join(root_dir, bucket, "project", "images"))
+        for i in range(options.get('images')):
+            key = "project/images/DJI_{:04d}.JPG".format(i)
+            with open(os.path.join(root_dir, bucket, key), "wb") as f:
+                f.write(os.urandom(options.get('size_kb') * 1024))
+            images.append(key)
+
+        try:
+            with start_simple_s3_server(root_dir, options.get('port'), options.get('latency_ms')) as endpoint, \
+                 mock.patch.multiple(settings,
+                                     S3_DOWNLOAD_ENDPOINT=endpoint,
+                                     S3_DOWNLOAD_ACCESS_KEY="benchmark",
+                                     S3_DOWNLOAD_SECRET_KEY="benchmark"):
+                s3_utils.reset_s3_sessions()
+                s3_client = s3_utils.get_s3_client()
+
+                serial = self._import(images, lambda objects: self._serial_download(s3_client, objects))
+                pool = S3DownloadPool(s3_client, max_workers=options.get('workers'))
+                pooled = self._import(images, lambda objects: pool.download(objects))
+        finally:
+            s3_utils.reset_s3_sessions()
+            shutil.rmtree(root_dir, ignore_errors=True)
+
+        self.stdout.write("{} images of {}KB, {}ms of latency:".format(len(images), options.get('size_kb'),
+                                                         options.get('latency_ms')))
+        self.stdout.write("  serial: {:.2f}s".format(serial))
+        self.stdout.write("  transfer pool ({} workers): {:.2f}s ({:.1f}x)".format(options.get('workers'), pooled,
+                                                                      serial / pooled))
+
+    def _import(self, images, download):
+        download_dir = tempfile.mkdtemp()
+        objects = [("benchmark", key, os.path.join(download_dir, os.path.basename(key))) for key in images]
+
+        try:
+            start = time.perf_counter()
+            download(objects)
+            elapsed = time.perf_counter() - start
+
+            missing = [path for _, _, path in objects if not os.path.isfile(path)]
+            if missing:
+                raise Exception("{} images were not downloaded".format(len(missing)))
+
+            return elapsed
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+    def _serial_download(self, s3_client, objects):
+        # Previous import, an object metadata request before each download
+        for bucket, key, path in objects:
+            s3_utils.get_s3_object_metadata(key, bucket, s3_client)
+            s3_utils.download_s3_file(key, path, s3_client, bucket)
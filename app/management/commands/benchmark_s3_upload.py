@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import mock
+from django.core.management.base import BaseCommand
+from webodm import settings
+from app.classes.s3_transfer_pool import S3UploadPool, get_transfer_config
+from app.utils import s3_utils
+from app.utils.file_utils import calculate_sha256
+from app.tests.utils import start_simple_s3_server
+
+
+class Command(BaseCommand):
+    help = "Measure the time to upload the assets of a task to a local S3 stub, serially and with the transfer pool"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--assets", type=int, default=200, help="Assets to upload")
+        parser.add_argument("--size-kb", type=int, default=256, help="Size of each asset")
+        parser.add_argument("--large-assets", type=int, default=2, help="Assets uploaded in parts")
+        parser.add_argument("--large-size-mb", type=int, default=64, help="Size of each asset uploaded in parts")
+        parser.add_argument("--latency-ms", type=float, default=2, help="Simulated S3 round trip latency")
+        parser.add_argument("--workers", type=int, default=settings.S3_UPLOAD_MAX_WORKERS,
+                            help="Workers of the transfer pool")
+        parser.add_argument("--port", type=int, default=9100, help="Port of the S3 stub")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        root_dir = tempfile.mkdtemp()
+        assets_dir = tempfile.mkdtemp()
+        bucket = "benchmark"
+        objects = []
+
+        os.makedirs(os.path.join(root_dir, bucket))
+        sizes = [options.get('size_kb') * 1024] * options.get('assets') + \
+                [options.get('large_size_mb') * 1024 * 1024] * options.get('large_assets')
+        for i, size in enumerate(sizes):
+            path = os.path.join(assets_dir, "asset_{:04d}.bin".format(i))
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+            objects.append((bucket, "project/task/assets/{}".format(os.path.basename(path)), path))
+
+        try:
+            with start_simple_s3_server(root_dir, options.get('port'), options.get('latency_ms')) as endpoint, \
+                 mock.patch.multiple(settings,
+                                     S3_DOWNLOAD_ENDPOINT=endpoint,
+                                     S3_DOWNLOAD_ACCESS_KEY="benchmark",
+                                     S3_DOWNLOAD_SECRET_KEY="benchmark"):
+                s3_utils.reset_s3_sessions()
+                s3_client = s3_utils.get_s3_client()
+
+                serial = self._measure(lambda: self._serial_upload(s3_client, objects))
+                shutil.rmtree(os.path.join(root_dir, bucket))
+                os.makedirs(os.path.join(root_dir, bucket))
+
+                pool = S3UploadPool(s3_client, max_workers=options.get('workers'))
+                pooled = self._measure(lambda: pool.upload(objects))
+                # Nothing changed since the last upload
+                unchanged = self._measure(lambda: pool.upload(objects))
+        finally:
+            s3_utils.reset_s3_sessions()
+            shutil.rmtree(root_dir, ignore_errors=True)
+            shutil.rmtree(assets_dir, ignore_errors=True)
+
+        self.stdout.write("{} assets of {}KB and {} of {}MB, {}ms of latency:".format(
+            options.get('assets'), options.get('size_kb'), options.get('large_assets'),
+            options.get('large_size_mb'), options.get('latency_ms')))
+        self.stdout.write("  serial: {:.2f}s".format(serial))
+        self.stdout.write("  transfer pool ({} workers): {:.2f}s ({:.1f}x)".format(options.get('workers'), pooled,
+                                                                      serial / pooled))
+        self.stdout.write("  transfer pool, already uploaded: {:.2f}s".format(unchanged))
+
+    def _measure(self, upload):
+        start = time.perf_counter()
+        upload()
+        return time.perf_counter() - start
+
+    def _serial_upload(self, s3_client, objects):
+        # Previous upload, the file read once for its checksum and once more for the upload
+        for bucket, key, path in objects:
+            checksum = calculate_sha256(path)
+            s3_utils.get_object_checksum(key, bucket, s3_client)
+            s3_client.upload_file(path, bucket, key, Config=get_transfer_config(),
+                                  ExtraArgs={"Metadata": {"Checksumsha256": checksum}})
@@ -0,0 +1,137 @@
+import math
+import os
+import re
+import shutil
+import tempfile
+import urllib.parse
+import numpy as np
+import morecantile
+import rasterio
+from rasterio.enums import ColorInterp
+from rasterio.transform import from_origin
+from django.core.management.base import BaseCommand
+from rest_framework import exceptions
+from app.api.tiler import parse_tile_params, render_tile
+from app.classes.tile_phases import TILE_PHASES, record_tile_phases
+from app.cogeo import assure_cogeo
+from ._benchmark_utils import format_latencies, measure
+
+# Same paths as the tiles endpoint (see app/api/urls.py)
+TILE_URL = re.compile(r"/(?P<tile_type>orthophoto|dsm|dtm)/tiles/(?P<z>[\d]+)/(?P<x>[\d]+)/(?P<y>[\d]+)"
+                      r"(@(?P<scale>[\d]+)x)?\.?(?P<ext>png|jpg|webp)?(\?(?P<query>[^\s\"]*))?")
+
+
+class Command(BaseCommand):
+    help = "Replay recorded tile URLs against a raster and report the latency of each phase of the rendering"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("urls", type=str,
+                            help="File with the recorded tile URLs (or access log lines), one per line")
+        parser.add_argument("--raster", type=str, required=False,
+                            help="Raster (COG) to render the tiles from, instead of a synthetic one")
+        parser.add_argument("--repeat", type=int, default=1, help="Replays of the recorded tiles")
+        parser.add_argument("--max-size", type=int, default=4096, help="Maximum side of the synthetic rasters")
+        parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic rasters")
+
+        super(Command, self).add_arguments(parser)
+
+    def handle(self, **options):
+        with open(options.get('urls')) as f:
+            requests = [m.groupdict() for m in map(TILE_URL.search, f) if m is not None]
+
+        if len(requests) == 0:
+            self.stderr.write("No tile URLs in {}".format(options.get('urls')))
+            return
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            rasters = {}
+            for tile_type in set(r['tile_type'] for r in requests):
+                if options.get('raster'):
+                    rasters[tile_type] = options.get('raster')
+                else:
+                    rasters[tile_type] = self._synthetic_raster(
+                        os.path.join(tmp_dir, "{}.tif".format(tile_type)), tile_type,
+                        [r for r in requests if r['tile_type'] == tile_type],
+                        options.get('max_size'), np.random.default_rng(options.get('seed')))
+
+            tiles = []
+            for r in requests:
+                z, params = parse_tile_params(dict(urllib.parse.parse_qsl(r['query'] or "", keep_blank_values=True)),
+                                              r['tile_type'], int(r['z']), int(r['scale'] or 1),
+                                              self._orthophoto_bands(rasters[r['tile_type']]))
+                tiles.append((rasters[r['tile_type']], r['tile_type'], z, int(r['x']), int(r['y']), r['ext'], params))
+
+            total = []
+            outside = 0
+
+            with record_tile_phases() as phases:
+                for _ in range(options.get('repeat')):
+                    for url, tile_type, z, x, y, ext, params in tiles:
+                        try:
+                            with measure(total):
+                                render_tile(url, tile_type, z, x, y, ext=ext, accepts_webp=True, **params)
+                        except exceptions.NotFound:
+                            total.pop()
+                            outside += 1
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.stdout.write("{} tiles ({} outside of the rasters):".format(len(tiles) * options.get('repeat'), outside))
+        for phase in TILE_PHASES:
+            if phase in phases:
+                self.stdout.write("  " + format_latencies(phase, phases[phase]))
+        self.stdout.write("  " + format_latencies("total", total))
+
+    def _orthophoto_bands(self, path):
+        # Same as Task.update_orthophoto_bands_field
+        with rasterio.open(path) as f:
+            return [{"name": c.name, "description": f.descriptions[i]} for i, c in enumerate(f.colorinterp)]
+
+    def _synthetic_raster(self, path, tile_type, requests, max_size, rnd):
+        """
+        Write a COG in EPSG:3857 covering the tiles of the requests, at the
+        resolution of their highest zoom level
+        """
+        tms = morecantile.tms.get("WebMercatorQuad")
+        bounds = [tms.xy_bounds(int(r['x']), int(r['y']), int(r['z'])) for r in requests]
+        left, bottom = min(b.left for b in bounds), min(b.bottom for b in bounds)
+        right, top = max(b.right for b in bounds), max(b.top for b in bounds)
+
+        tile_bounds = bounds[max(range(len(requests)), key=lambda i: int(requests[i]['z']))]
+        resolution = (tile_bounds.right - tile_bounds.left) / 256
+
+        # Larger extents are cropped around the median tile, the tiles outside
+        # of the raster are skipped
+        half_size = max_size * resolution / 2
+        center_x = float(np.median([(b.left + b.right) / 2 for b in bounds]))
+        center_y = float(np.median([(b.bottom + b.top) / 2 for b in bounds]))
+        left, right = max(left, center_x - half_size), min(right, center_x + half_size)
+        bottom, top = max(bottom, center_y - half_size), min(top, center_y + half_size)
+        width, height = math.ceil((right - left) / resolution), math.ceil((top - bottom) / resolution)
+
+        # Smooth terrain with some noise
+        yy, xx = np.arange(height, dtype=np.float32)[:, None], np.arange(width, dtype=np.float32)[None, :]
+        terrain = 30 * np.sin(xx / 70) * np.cos(yy / 90) + 0.01 * xx
+        terrain = terrain + rnd.standard_normal(size=(height, width), dtype=np.float32) * 0.2
+
+        profile = dict(driver='GTiff', height=height, width=width, crs='EPSG:3857',
+                       transform=from_origin(left, top, resolution, resolution),
+                       tiled=True, blockxsize=256, blockysize=256, compress='deflate')
+
+        if tile_type == 'orthophoto':
+            # Red, green, blue, near infrared and alpha
+            rgbn = [np.clip(128 + 3 * terrain * (i + 1) / 4, 0, 255).astype(np.uint8) for i in range(4)]
+            with rasterio.open(path, 'w', count=5, dtype='uint8', **profile) as dst:
+                dst.write(np.stack(rgbn + [np.full((height, width), 255, dtype=np.uint8)]))
+                dst.colorinterp = [ColorInterp.red, ColorInterp.green, ColorInterp.blue,
+                                   ColorInterp.gray, ColorInterp.alpha]
+                for i, description in enumerate(["red", "green", "blue", "nir"]):
+                    dst.set_band_description(i + 1, description)
+        else:
+            with rasterio.open(path, 'w', count=1, dtype='float32', nodata=-9999, **profile) as dst:
+                dst.write((200 + terrain).astype(np.float32), 1)
+
+        assure_cogeo(path)
+        return path
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0057_auto_20250807_1817"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="raster_statistics",
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True,
+                default=dict,
+                help_text="Statistics and histograms of the rasters, by raster type",
+                verbose_name="Raster Statistics",
+            ),
+        ),
+    ]
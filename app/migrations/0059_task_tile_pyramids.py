@@ -0,0 +1,24 @@
+# Generated by Django 3.0.14 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0058_task_raster_statistics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="task",
+            name="tile_pyramids",
+            field=django.contrib.postgres.fields.jsonb.JSONField(
+                blank=True,
+                default=dict,
+                help_text="Precomputed tiles of the rasters (parameters and zoom levels), by raster type",
+                verbose_name="Tile Pyramids",
+            ),
+        ),
+    ]
@@ -19,6 +19,7 @@ from datetime import datetime
 from shutil import copyfile
 import requests
 from PIL import Image
+from rio_tiler.io import COGReader
 from django.contrib.gis.gdal import GDALRaster
 from django.contrib.gis.gdal import OGRGeometry
 from django.contrib.gis.geos import GEOSGeometry
@@ -54,13 +55,14 @@ from django.utils.translation import gettext_lazy as _, gettext
 
 from functools import partial
 from app.classes.console import Console
+from app.classes.tile_cache import tile_cache
+from app.classes.tile_pyramid import get_pyramid_params
+from app.classes import s3_transfer_pool
+from app.classes.progress_reporter import ProgressReporter
+from app.classes.s3_manifest import s3_manifest
 from app.utils.s3_utils import (
     get_s3_client,
-    list_s3_objects,
-    download_s3_file,
-    get_s3_object_metadata,
     convert_task_path_to_s3,
-    get_object_checksum,
     s3_object_exists,
     split_s3_bucket_prefix,
     calculate_object_checksum,
@@ -509,6 +511,20 @@ class Task(models.Model):
         help_text=_("List of orthophoto bands"),
         verbose_name=_("Orthophoto Bands"),
     )
+    raster_statistics = fields.JSONField(
+        default=dict,
+        blank=True,
+        help_text=_("Statistics and histograms of the rasters, by raster type"),
+        verbose_name=_("Raster Statistics"),
+    )
+    tile_pyramids = fields.JSONField(
+        default=dict,
+        blank=True,
+        help_text=_(
+            "Precomputed tiles of the rasters (parameters and zoom levels), by raster type"
+        ),
+        verbose_name=_("Tile Pyramids"),
+    )
     size = models.FloatField(
         default=0.0,
         blank=True,
@@ -990,27 +1006,6 @@ class Task(models.Model):
         self.downloading_s3_progress = 0.0
         self.save(update_fields=("downloading_s3_progress",))
 
-        class DownloadProgressCallback(object):
-            def __init__(self, task: Task, downloaded_images, total_size):
-                self._size = total_size
-                self._downloaded_bytes = 0.0
-                self._task = task
-                self._downloaded_images = downloaded_images
-                self.console_prints = 0
-
-            def __call__(self, bytes_transferred):
-                self._downloaded_bytes += bytes_transferred
-                progress = self._downloaded_bytes / self._size if self._size > 0 else 0
-                self._task._update_download_progress(self._downloaded_images, progress)
-                self._task.console += (
-                    f"...{self._task.downloading_s3_progress * 100:.2f}%"
-                )
-                self.console_prints += 1
-
-                if self.console_prints >= 10:
-                    self.console_prints = 0
-                    self._task.console += "\n"
-
         try:
             s3_client = get_s3_client()
             downloaded_images = []
@@ -1022,6 +1017,7 @@ class Task(models.Model):
                 )
             else:
                 fotos_s3_dir = self._create_task_s3_download_dir()
+                images = []
 
                 for image in self.s3_images:
                     bucket, image_path = split_s3_bucket_prefix(image)
@@ -1029,37 +1025,23 @@ class Task(models.Model):
                     destiny_image_filename = os.path.join(
                         fotos_s3_dir, original_image_filename
                     )
-
-                    s3_object = get_s3_object_metadata(
-                        bucket=bucket, key=image_path, s3_client=s3_client
+                    images.append((bucket, image_path, destiny_image_filename))
+
+                with ProgressReporter(
+                    self._update_download_progress, self.console.append
+                ) as progress:
+                    results = s3_transfer_pool.S3DownloadPool(s3_client).download(
+                        images,
+                        need_download=self._need_download_asset,
+                        on_progress=progress.update,
                     )
-                    total_size = s3_object.get("ContentLength", 0) if s3_object else 0
 
-                    if total_size <= 0:
+                for (_, _, destiny_image_filename), result in zip(images, results):
+                    if result == s3_transfer_pool.MISSING:
                         continue
 
-                    need_download = self._need_download_asset(
-                        s3_object, destiny_image_filename
-                    )
-
-                    if not need_download:
-                        self._update_download_progress(downloaded_images, total_size)
-                        self.console += "100%\n"
-
+                    if result == s3_transfer_pool.SKIPPED:
                         files_already_downloaded_count += 1
-                    else:
-                        if os.path.exists(destiny_image_filename):
-                            os.remove(destiny_image_filename)
-
-                        download_s3_file(
-                            image_path,
-                            destiny_image_filename,
-                            s3_client,
-                            bucket,
-                            Callback=DownloadProgressCallback(
-                                self, downloaded_images, total_size
-                            ),
-                        )
 
                     downloaded_images.append(destiny_image_filename)
 
@@ -1569,9 +1551,12 @@ class Task(models.Model):
                     "Populated extent field with {} for {}".format(raster_path, self)
                 )
 
-        self.update_available_assets_field()
         self.update_epsg_field()
         self.update_orthophoto_bands_field()
+        self.update_raster_statistics_field()
+        self.update_tile_pyramids_field()
+        # After the tile pyramids, so they are uploaded with the other assets
+        self.update_available_assets_field()
         self.update_size()
         self.potree_scene = {}
         self.running_progress = 1.0
@@ -1586,6 +1571,10 @@ class Task(models.Model):
 
         self.save()
 
+        # Tiles rendered from the previous assets must not be served again
+        tile_cache.invalidate(self.id)
+        s3_manifest.invalidate(self.id)
+
         from app.plugins import signals as plugin_signals
 
         plugin_signals.task_completed.send_robust(
@@ -1765,6 +1754,89 @@ class Task(models.Model):
         if commit:
             self.save(update_fields=("orthophoto_bands",))
 
+    def update_raster_statistics_field(self, commit=False):
+        """
+        Precomputes the statistics of the rasters, served by the metadata endpoint
+        :param commit: when True also saves the model, otherwise the user should manually call save()
+        """
+        from app.raster_statistics import compute_raster_metadata
+
+        raster_statistics = {}
+
+        for tile_type in ["orthophoto", "dsm", "dtm"]:
+            raster_path = self.assets_path(self.ASSETS_MAP[tile_type + ".tif"])
+
+            if not os.path.isfile(raster_path):
+                continue
+
+            try:
+                with COGReader(raster_path) as src:
+                    raster_statistics[tile_type] = compute_raster_metadata(
+                        src, tile_type
+                    )
+            except Exception as e:
+                logger.warning(
+                    f"Cannot compute the statistics of {raster_path}. Original error: {e}"
+                )
+
+        self.raster_statistics = raster_statistics
+        if commit:
+            self.save(update_fields=("raster_statistics",))
+
+    def set_raster_statistics(self, tile_type, metadata):
+        """
+        Stores the statistics of one raster, on a locked fresh copy of the
+        field: the ones of the other rasters, stored by concurrent requests,
+        are kept
+        """
+        with transaction.atomic():
+            raster_statistics = (
+                Task.objects.select_for_update()
+                .values_list("raster_statistics", flat=True)
+                .get(pk=self.pk)
+            )
+            raster_statistics[tile_type] = metadata
+            Task.objects.filter(pk=self.pk).update(raster_statistics=raster_statistics)
+
+        self.raster_statistics = raster_statistics
+
+    def update_tile_pyramids_field(self, commit=False):
+        """
+        Renders the tiles of the default visualizations of the rasters, up to
+        TILE_PYRAMID_MAX_ZOOM, to MBTiles archives stored with the assets
+        :param commit: when True also saves the model, otherwise the user should manually call save()
+        """
+        from app.api.tiler import generate_tile_pyramid, get_raster_path
+
+        tile_pyramids = {}
+
+        if settings.TILE_PYRAMID_MAX_ZOOM > 0:
+            for tile_type in ["orthophoto", "dsm", "dtm"]:
+                statistics = self.raster_statistics.get(tile_type)
+
+                if statistics is None:
+                    continue
+
+                try:
+                    tile_pyramids[tile_type] = generate_tile_pyramid(
+                        get_raster_path(self, tile_type),
+                        tile_type,
+                        self.get_tile_pyramid_path(tile_type),
+                        get_pyramid_params(statistics["info"], tile_type),
+                        settings.TILE_PYRAMID_MAX_ZOOM,
+                    )
+                except Exception as e:
+                    logger.warning(
+                        f"Cannot generate the tile pyramid of {tile_type} for {self}. Original error: {e}"
+                    )
+
+        self.tile_pyramids = tile_pyramids
+        if commit:
+            self.save(update_fields=("tile_pyramids",))
+
+    def get_tile_pyramid_path(self, tile_type):
+        return self.assets_path("tile_pyramids", "{}.mbtiles".format(tile_type))
+
     def delete(self, using=None, keep_parents=False):
         task_id = self.id
         from app.plugins import signals as plugin_signals
@@ -1776,6 +1848,7 @@ class Task(models.Model):
         )
 
         super(Task, self).delete(using, keep_parents)
+        s3_manifest.invalidate(task_id)
 
         # Remove files related to this task
         try:
@@ -1921,8 +1994,7 @@ class Task(models.Model):
                 raise
 
     def scan_s3_assets(self):
-        s3_key = convert_task_path_to_s3(self.task_path())
-        return [obj["Key"] for obj in list_s3_objects(s3_key)]
+        return [obj["Key"] for obj in s3_manifest.objects(self)]
 
     def scan_images(self):
         task_assets = TaskAsset.objects.filter(
@@ -2014,10 +2086,11 @@ class Task(models.Model):
 
     def list_s3_available_assets(self):
         s3_assets_key = convert_task_path_to_s3(self.assets_path())
-        ignore_keys = self._list_s3_root_images()
+        asset_keys = self.scan_s3_assets()
+        ignore_keys = set(self._list_s3_root_images(asset_keys))
         return [
             remove_path_from_path(asset_key, s3_assets_key)
-            for asset_key in self.scan_s3_assets()
+            for asset_key in asset_keys
             if asset_key not in ignore_keys
         ]
 
@@ -2058,30 +2131,6 @@ class Task(models.Model):
             )
             return []
 
-        class UploadProgressCallback(object):
-            def __init__(self, task: Task, uploaded_images, total_size, total_images):
-                self._size = total_size
-                self._uploaded_bytes = 0.0
-                self._task = task
-                self._uploaded_images = uploaded_images
-                self._total_images = total_images
-                self.console_prints = 0
-
-            def __call__(self, bytes_transferred):
-                self._uploaded_bytes += bytes_transferred
-                progress = self._uploaded_bytes / self._size if self._size > 0 else 0
-                self._task._update_upload_progress(
-                    self._uploaded_images, self._total_images, progress
-                )
-                self._task.console += (
-                    f"...{self._task.uploading_s3_progress * 100:.2f}%"
-                )
-                self.console_prints += 1
-
-                if self.console_prints >= 10:
-                    self.console_prints = 0
-                    self._task.console += "\n"
-
         try:
             self.console += "Starting upload assets to S3...\n"
             s3_client = get_s3_client()
@@ -2092,61 +2141,46 @@ class Task(models.Model):
                 )
                 return []
 
+            objects = []
+            objects_assets = {}
+
             for asset_to_upload in assets_to_upload:
                 file_to_upload = asset_to_upload.path()
                 if not os.path.exists(file_to_upload):
                     continue
 
                 if not asset_to_upload.need_upload_to_s3():
-                    self._update_upload_progress(
-                        files_uploadeds, len(assets_to_upload), 1
-                    )
-                    self.console += f"...{self.uploading_s3_progress * 100:.2f}%"
-
                     files_uploadeds.append(file_to_upload)
-
                     continue
 
                 s3_key = remove_path_from_path(file_to_upload, settings.MEDIA_ROOT)
-                try:
-                    checksum = calculate_sha256(file_to_upload)
-                except Exception as e:
-                    asset_to_upload.status = task_asset_status.ERROR
-                    asset_to_upload.save(update_fields=("status",))
-                    raise Exception(
-                        f"Error on calculate SHA256 of {file_to_upload}. Original error: {e}"
-                    )
+                s3_object = (s3_bucket, s3_key, file_to_upload)
+                objects.append(s3_object)
+                objects_assets[s3_object] = asset_to_upload
 
-                if checksum and not self._need_upload_asset(
-                    checksum, s3_key, s3_client
-                ):
-                    self._update_upload_progress(
-                        files_uploadeds, len(assets_to_upload), 1
+            def on_failure(s3_object, error):
+                asset = objects_assets[s3_object]
+                asset.status = task_asset_status.ERROR
+                asset.save(update_fields=("status",))
+
+            upload_pool = s3_transfer_pool.S3UploadPool(s3_client)
+
+            try:
+                with ProgressReporter(
+                    self._update_upload_progress, self.console.append
+                ) as progress:
+                    results = upload_pool.upload(
+                        objects, on_progress=progress.update, on_failure=on_failure
                     )
-                    self.console += f"...{self.uploading_s3_progress * 100:.2f}%"
-                else:
-                    try:
-                        file_size = os.path.getsize(file_to_upload)
-
-                        s3_client.upload_file(
-                            file_to_upload,
-                            s3_bucket,
-                            s3_key,
-                            Callback=UploadProgressCallback(
-                                self, files_uploadeds, file_size, len(assets_to_upload)
-                            ),
-                            ExtraArgs={
-                                "Metadata": {
-                                    "Checksumsha256": checksum,
-                                }
-                            },
-                        )
-                    except Exception as e:
-                        asset_to_upload.status = task_asset_status.ERROR
-                        asset_to_upload.save(update_fields=("status",))
-                        raise e
+            except Exception:
+                s3_manifest.invalidate(self.id)
+                raise
 
-                files_uploadeds.append(file_to_upload)
+            s3_manifest.update(self.id, upload_pool.objects.values())
+
+            for (_, _, file_to_upload), result in zip(objects, results):
+                if result != s3_transfer_pool.MISSING:
+                    files_uploadeds.append(file_to_upload)
 
             self.console += f"\nUploaded {len(files_uploadeds)} files to S3!\n\n"
         except Exception as e:
@@ -2187,28 +2221,17 @@ class Task(models.Model):
         except:
             return []
 
-    def _update_download_progress(self, downloaded_images, progress):
-        self.downloading_s3_progress = self._calculate_progress_of_images(
-            downloaded_images, len(self.s3_images), progress
-        )
+    def _update_download_progress(self, progress):
+        self.downloading_s3_progress = progress
         self.save(update_fields=("downloading_s3_progress",))
 
-    def _update_upload_progress(self, uploaded_images, total_images, progress):
-        self.uploading_s3_progress = self._calculate_progress_of_images(
-            uploaded_images, total_images, progress
-        )
+    def _update_upload_progress(self, progress):
+        self.uploading_s3_progress = progress
         self.save(update_fields=("uploading_s3_progress",))
 
-    def _calculate_progress_of_images(self, succeded_images, total_images, progress):
-        percent_per_image = 1.0 / total_images
-        percent_success = len(succeded_images) * percent_per_image
-        percent_current_progress = progress * percent_per_image
-        return percent_success + percent_current_progress
-
     def _download_all_s3_images(self):
         task_path = self.task_path()
         logger.info('will download images with "{}"'.format(task_path))
-        s3_images = list_s3_objects(task_path)
         s3_client = get_s3_client()
 
         if not s3_client:
@@ -2217,18 +2240,22 @@ class Task(models.Model):
             )
             return
 
+        s3_images = s3_manifest.objects(self)
         logger.info(
             'will download images: "{}"'.format(
                 str([image["Key"] for image in s3_images])
             )
         )
 
+        images = []
         for image in s3_images:
-            image_key = image["Key"]
-            logger.info('start download image: "{}"'.format(image_key))
+            image_path = os.path.join(settings.MEDIA_ROOT, image["Key"])
+            ensure_path_exists(os.path.dirname(image_path))
+            images.append((settings.S3_BUCKET, image["Key"], image_path))
 
-            download_s3_file(image_key, image_key, s3_client)
-            logger.info('downloaded image: "{}"'.format(image_key))
+        s3_transfer_pool.S3DownloadPool(s3_client).download(
+            images, need_download=self._need_download_asset
+        )
 
     def _orthophoto_assets_needs_upload_to_s3(self):
         return [
@@ -2242,12 +2269,11 @@ class Task(models.Model):
             and asset.copy_to_type().need_upload_to_s3()
         ]
 
-    def _list_s3_root_images(self):
+    def _list_s3_root_images(self, keys=None):
         s3_key = convert_task_path_to_s3(self.task_path())
         root_images = []
 
-        for s3_obj in list_s3_objects(s3_key):
-            obj_key = s3_obj["Key"]
+        for obj_key in self.scan_s3_assets() if keys is None else keys:
             obj_filename = get_file_name(obj_key)
             obj_root_key = ensure_sep_at_end(s3_key) + obj_filename
 
@@ -2265,11 +2291,6 @@ class Task(models.Model):
 
         return local_checksum == None or local_checksum != s3_checksum
 
-    def _need_upload_asset(self, current_checksum: str, s3_key: str, s3_client):
-        object_checksum = get_object_checksum(s3_key, s3_client=s3_client)
-
-        return current_checksum != object_checksum
-
     def _increase_node_connection_retry(self):
         self.node_connection_retry += 1
         node = str(self.processing_node)
@@ -0,0 +1,160 @@
+import copy
+import hashlib
+import json
+import logging
+
+import numpy as np
+from django.core.cache import caches
+from rio_tiler.models import ImageStatistics
+from rio_tiler.models import Metadata as RioMetadata
+from rio_tiler.utils import has_alpha_band, _stats as raster_stats
+from app.api.formulas import compile_formula
+from app.classes.cutline_cache import cutline_cache
+from app.utils.s3_utils import open_cog_reader, get_cog_version
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+
+PMIN, PMAX = 2.0, 98.0
+HISTOGRAM_BINS = 255
+
+
+def compute_raster_metadata(
+    src, tile_type: str, expr=None, hrange=None, boundaries_feature=None
+):
+    """
+    Statistics, histograms and info of a raster opened with COGReader, for
+    the given formula expression, histogram range and boundaries
+    """
+    band_count = src.dataset.meta["count"]
+    if boundaries_feature is not None:
+        boundaries_cutline, boundaries_bbox = cutline_cache.get(
+            src.dataset, boundaries_feature
+        )
+    else:
+        boundaries_cutline = None
+        boundaries_bbox = None
+    if has_alpha_band(src.dataset):
+        band_count -= 1
+    nodata = None
+    # Workaround for https://github.com/OpenDroneMap/WebODM/issues/894
+    if tile_type == "orthophoto":
+        nodata = 0
+    histogram_options = {"bins": HISTOGRAM_BINS, "range": hrange}
+    if expr is not None:
+        formula = compile_formula(expr)
+        if boundaries_cutline is not None:
+            data, mask = src.preview(
+                indexes=formula.indexes, vrt_options={"cutline": boundaries_cutline}
+            )
+        else:
+            data, mask = src.preview(indexes=formula.indexes)
+        data = np.ma.array(formula.evaluate(data))
+        data.mask = mask == 0
+        stats = {
+            str(b + 1): raster_stats(
+                data[b], percentiles=(PMIN, PMAX), bins=HISTOGRAM_BINS, range=hrange
+            )
+            for b in range(data.shape[0])
+        }
+        stats = {b: ImageStatistics(**s) for b, s in stats.items()}
+        metadata = RioMetadata(statistics=stats, **src.info().dict())
+    else:
+        if (boundaries_cutline is not None) and (boundaries_bbox is not None):
+            metadata = src.metadata(
+                pmin=PMIN,
+                pmax=PMAX,
+                hist_options=histogram_options,
+                nodata=nodata,
+                bounds=boundaries_bbox,
+                vrt_options={"cutline": boundaries_cutline},
+            )
+        else:
+            metadata = src.metadata(
+                pmin=PMIN,
+                pmax=PMAX,
+                hist_options=histogram_options,
+                nodata=nodata,
+            )
+
+    return {
+        "info": json.loads(metadata.json()),
+        "band_count": band_count,
+        "bounds": {"value": list(src.bounds), "crs": dict(src.dataset.crs)},
+    }
+
+
+def get_raster_metadata(
+    task, url: str, tile_type: str, expr=None, hrange=None, boundaries_feature=None
+):
+    """
+    Metadata of a task raster (see compute_raster_metadata), computed at most
+    once. The default statistics are stored on the task, the ones of formulas,
+    ranges and boundaries are memoized in redis, keyed by the raster version.
+
+    The result is a copy, callers can change it.
+    """
+    is_default = expr is None and hrange is None and boundaries_feature is None
+
+    if is_default and tile_type in task.raster_statistics:
+        return copy.deepcopy(task.raster_statistics[tile_type])
+
+    cache_key = None
+    raster_version = get_cog_version(url)
+
+    if raster_version is not None:
+        cache_key = _get_cache_key(
+            raster_version, tile_type, expr, hrange, boundaries_feature
+        )
+        metadata = _get_cache(cache_key)
+
+        if metadata is not None:
+            return metadata
+
+    with open_cog_reader(url) as src:
+        metadata = compute_raster_metadata(
+            src, tile_type, expr, hrange, boundaries_feature
+        )
+
+    if is_default:
+        # Tasks processed before the statistics were precomputed
+        task.set_raster_statistics(tile_type, metadata)
+    elif cache_key is not None:
+        _set_cache(cache_key, metadata)
+
+    return copy.deepcopy(metadata)
+
+
+def _get_cache_key(raster_version, tile_type, expr, hrange, boundaries_feature):
+    boundaries_hash = None
+    if boundaries_feature is not None:
+        boundaries_hash = hashlib.sha256(
+            json.dumps(boundaries_feature, sort_keys=True).encode()
+        ).hexdigest()
+
+    key_data = json.dumps(
+        [raster_version, tile_type, expr, hrange, boundaries_hash], default=list
+    )
+
+    return "raster_metadata:{}".format(hashlib.sha256(key_data.encode()).hexdigest())
+
+
+def _get_cache(cache_key: str):
+    try:
+        return _get_redis_cache().get(cache_key)
+    except Exception as e:
+        logger.warning(f"Cannot read cached raster metadata. Original error: {e}")
+        return None
+
+
+def _set_cache(cache_key: str, metadata: dict):
+    try:
+        _get_redis_cache().set(
+            cache_key, metadata, timeout=settings.RASTER_STATISTICS_CACHE_TTL_SECONDS
+        )
+    except Exception as e:
+        logger.warning(f"Cannot cache raster metadata. Original error: {e}")
+
+
+def _get_redis_cache():
+    return caches["s3_images_cache"]
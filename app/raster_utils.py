@@ -1,23 +1,33 @@
 import rasterio
-import re
 import logging
 import os
 import subprocess
 import numpy as np
-import numexpr as ne
+import rasterio.shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from rasterio.enums import ColorInterp
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
 from rio_tiler.utils import has_alpha_band, linear_rescale
 from rio_tiler.colormap import cmap as colormap, apply_cmap
 from rio_tiler.errors import InvalidColorMapName
 from app.api.hsvblend import hsv_blend
 from app.api.hillshade import LightSource
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from app.api.formulas import compile_formula
+from rasterio.warp import calculate_default_transform, Resampling
 from app.utils.s3_utils import open_cog_reader
+from webodm import settings
 
 logger = logging.getLogger('app.logger')
 
 ZOOM_EXTRA_LEVELS = 3
 
+# Size of the windows of exports, when the source is not tiled
+EXPORT_BLOCK_SIZE = 512
+
 def extension_for_export_format(export_format):
     extensions = {
         'gtiff': 'tif',
@@ -25,7 +35,115 @@ def extension_for_export_format(export_format):
     }
     return extensions.get(export_format, export_format)
 
-def export_raster(input, output, **opts):
+def get_block_shape(src):
+    """
+    Shape (rows, cols) of the windows to process a raster by: its internal
+    tiles, when they can also be the tiles of a GeoTIFF (not strips)
+    """
+    block_height, block_width = src.block_shapes[0]
+    if block_height == block_width and block_width % 16 == 0:
+        return block_height, block_width
+    else:
+        return EXPORT_BLOCK_SIZE, EXPORT_BLOCK_SIZE
+
+def block_windows(width, height, block_shape):
+    block_height, block_width = block_shape
+    for row in range(0, height, block_height):
+        for col in range(0, width, block_width):
+            yield Window(col, row, min(block_width, width - col), min(block_height, height - row))
+
+def pad_window(window, halo, width, height):
+    """
+    The window grown by halo pixels on each side (within the raster) and
+    the offset (row, col) of the window in it
+    """
+    col_off = max(0, window.col_off - halo)
+    row_off = max(0, window.row_off - halo)
+    col_end = min(width, window.col_off + window.width + halo)
+    row_end = min(height, window.row_off + window.height + halo)
+
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off), \
+           (window.row_off - row_off, window.col_off - col_off)
+
+def process_windows(windows, read, compute, write, workers=1, progress_callback=None):
+    """
+    Run read, compute and write on each window. Reads and writes happen on
+    the calling thread, in the order of the windows (datasets cannot be
+    shared between threads), while compute runs on a pool of workers
+    threads: numpy, numexpr and GDAL release the GIL. At most 2 windows per
+    worker are held in memory.
+
+    progress_callback(done, total) is called after each window is written.
+    """
+    total = len(windows)
+    done = 0
+
+    def finish(window, result):
+        nonlocal done
+        write(window, result)
+        done += 1
+        if progress_callback is not None:
+            progress_callback(done, total)
+
+    if workers <= 1:
+        for window in windows:
+            finish(window, compute(window, read(window)))
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for window in windows:
+            pending.append((window, executor.submit(compute, window, read(window))))
+            if len(pending) >= workers * 2:
+                window, future = pending.popleft()
+                finish(window, future.result())
+
+        while pending:
+            window, future = pending.popleft()
+            finish(window, future.result())
+
+def write_window(dst, window, bands):
+    for band_num, arr in enumerate(bands, start=1):
+        dst.write(arr, band_num, window=window)
+
+@contextmanager
+def open_window_writer(output_raster, profile, block_shape):
+    """
+    Open output_raster to be written by windows. Formats that can only be
+    written at once (JPEG, PNG) go through a temporary tiled GeoTIFF, which
+    is converted at the end, so the whole image is never held in memory.
+    """
+    tiled_profile = profile.copy()
+    tiled_profile.update(driver='GTiff', tiled=True, blockysize=block_shape[0],
+                         blockxsize=block_shape[1], BIGTIFF='IF_SAFER')
+
+    if profile['driver'] == 'GTiff':
+        with rasterio.open(output_raster, 'w', **tiled_profile) as dst:
+            yield dst
+        return
+
+    # Creation options of the output format
+    creation_options = {}
+    if 'quality' in tiled_profile:
+        creation_options['quality'] = tiled_profile.pop('quality')
+    tiled_profile.update(compress='LZW')
+
+    tmp_raster = output_raster + '.tmp.tif'
+    try:
+        with rasterio.open(tmp_raster, 'w', **tiled_profile) as dst:
+            yield dst
+
+        rasterio.shutil.copy(tmp_raster, output_raster, driver=profile['driver'], **creation_options)
+    finally:
+        if os.path.exists(tmp_raster):
+            os.remove(tmp_raster)
+
+def export_raster(input, output, progress_callback=None, **opts):
+    """
+    Export input to output with the given options. Windows of the raster are
+    processed by opts['workers'] threads (EXPORT_RASTER_WORKERS by default),
+    progress_callback(progress) is called with the progress (0 to 1).
+    """
     epsg = opts.get('epsg')
     expression = opts.get('expression')
     export_format = opts.get('format')
@@ -34,6 +152,7 @@ def export_raster(input, output, **opts):
     hillshade = opts.get('hillshade')
     asset_type = opts.get('asset_type')
     name = opts.get('name', 'raster') # KMZ specific
+    workers = opts.get('workers', settings.EXPORT_RASTER_WORKERS)
 
     dem = asset_type in ['dsm', 'dtm']
     
@@ -105,10 +224,9 @@ def export_raster(input, output, **opts):
                                 ci.index(ColorInterp.blue) + 1,
                                 ci.index(ColorInterp.alpha) + 1)
 
+        alpha_band = None
         if ColorInterp.alpha in ci:
-            mask = src.read(ci.index(ColorInterp.alpha) + 1)
-        else:
-            mask = src.dataset_mask()
+            alpha_band = ci.index(ColorInterp.alpha) + 1
 
         cmap = None
         if color_map:
@@ -118,7 +236,7 @@ def export_raster(input, output, **opts):
                 logger.warning("Invalid colormap {}".format(color_map))
 
 
-        def process(arr, skip_rescale=False, skip_alpha=False, skip_type=False):
+        def process(arr, mask, skip_rescale=False, skip_alpha=False, skip_type=False):
             if not skip_rescale and rescale is not None:
                 arr = linear_rescale(arr, in_range=rescale)
             if not skip_alpha and not with_alpha:
@@ -141,8 +259,9 @@ def export_raster(input, output, **opts):
         if dem and rgb and profile.get('nodata') is not None:
             profile.update(nodata=None)
 
-        # Define write band function
-        # Reprojection needed?
+        # Reprojection needed? Windows are then read from a warped VRT,
+        # in the grid of the output
+        warped_vrt = None
         if src.crs is not None and epsg is not None and src.crs.to_epsg() != epsg:
             dst_crs = "EPSG:{}".format(epsg)
 
@@ -156,128 +275,186 @@ def export_raster(input, output, **opts):
                 height=height
             )
 
-            def write_band(arr, dst, band_num):
-                reproject(source=arr, 
-                        destination=rasterio.band(dst, band_num),
-                        src_transform=src.transform,
-                        src_crs=src.crs,
-                        dst_transform=transform,
-                        dst_crs=dst_crs,
-                        resampling=Resampling.nearest)
+            warped_vrt = WarpedVRT(src, crs=dst_crs, transform=transform,
+                                   width=width, height=height,
+                                   resampling=Resampling.nearest)
 
-        else:
-            # No reprojection needed
-            def write_band(arr, dst, band_num):
-                dst.write(arr, band_num)
-
-        if expression is not None:
-            # Apply band math
-            if rgb:
-                profile.update(dtype=rasterio.uint8, count=band_count)
+        reader = warped_vrt if warped_vrt is not None else src
+        block_shape = get_block_shape(src)
+        windows = list(block_windows(profile['width'], profile['height'], block_shape))
+
+        def read_mask(window):
+            if alpha_band is not None:
+                return reader.read(alpha_band, window=window)
             else:
-                profile.update(dtype=rasterio.float32, count=1, nodata=-9999)
-
-            bands_names = ["b{}".format(b) for b in tuple(sorted(set(re.findall(r"b(?P<bands>[0-9]{1,2})", expression))))]
-            rgb_expr = expression.split(",")
-            indexes = tuple([int(b.replace("b", "")) for b in bands_names])
-
-            alpha_index = None
-            if has_alpha_band(src):
-                try:
-                    alpha_index = src.colorinterp.index(ColorInterp.alpha) + 1
-                    indexes += (alpha_index, )
-                except ValueError:
-                    pass
-
-            data = src.read(indexes=indexes, out_dtype=np.float32)
-            arr = dict(zip(bands_names, data))
-            arr = np.array([np.nan_to_num(ne.evaluate(bloc.strip(), local_dict=arr)) for bloc in rgb_expr])
-
-            # Set nodata values
-            index_band = arr[0]
-            if alpha_index is not None:
-                # -1 is the last band = alpha
-                index_band[data[-1] == 0] = -9999
-
-            # Remove infinity values
-            index_band[index_band>1e+30] = -9999
-            index_band[index_band<-1e+30] = -9999
-
-            # Make sure this is float32
-            arr = arr.astype(np.float32)
-
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                # Apply colormap?
-                if rgb and cmap is not None:
-                    rgb_data, _ = apply_cmap(process(arr, skip_alpha=True), cmap)
-
-                    band_num = 1
-                    for b in rgb_data:
-                        write_band(process(b, skip_rescale=True), dst, band_num)
-                        band_num += 1
-
-                    if with_alpha:
-                        write_band(mask, dst, band_num)
-                    
-                    update_rgb_colorinterp(dst)
+                return reader.dataset_mask(window=window)
+
+        # Progress of the export, over all the passes on the windows
+        passes = 1
+        def report_progress(pass_index):
+            if progress_callback is None:
+                return None
+
+            def report(done, total):
+                progress_callback((pass_index * total + done) / (passes * total))
+            return report
+
+        def run(read, compute, write, pass_index=0):
+            process_windows(windows, read, compute, write, workers=workers,
+                            progress_callback=report_progress(pass_index))
+
+        try:
+            if expression is not None:
+                # Apply band math
+                if rgb:
+                    profile.update(dtype=rasterio.uint8, count=band_count)
                 else:
-                    # Raw
-                    write_band(process(arr)[0], dst, 1)
-        elif dem:
-            # Apply hillshading, colormaps to elevation
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                arr = src.read()
-
-                intensity = None
-                if hillshade is not None and hillshade > 0:
+                    profile.update(dtype=rasterio.float32, count=1, nodata=-9999)
+
+                formula = compile_formula(expression)
+                indexes = formula.indexes
+
+                alpha_index = None
+                if has_alpha_band(src):
+                    try:
+                        alpha_index = src.colorinterp.index(ColorInterp.alpha) + 1
+                        indexes += (alpha_index, )
+                    except ValueError:
+                        pass
+
+                def read(window):
+                    return read_mask(window), reader.read(indexes=indexes, window=window, out_dtype=np.float32)
+
+                def compute(window, block):
+                    mask, data = block
+                    arr = formula.evaluate(data[:len(formula.indexes)])
+
+                    # Set nodata values
+                    index_band = arr[0]
+                    if alpha_index is not None:
+                        # -1 is the last band = alpha
+                        index_band[data[-1] == 0] = -9999
+
+                    # Remove infinity values
+                    index_band[index_band>1e+30] = -9999
+                    index_band[index_band<-1e+30] = -9999
+
+                    # Make sure this is float32
+                    arr = arr.astype(np.float32)
+
+                    # Apply colormap?
+                    if rgb and cmap is not None:
+                        rgb_data, _ = apply_cmap(process(arr, mask, skip_alpha=True), cmap)
+                        bands = [process(b, mask, skip_rescale=True) for b in rgb_data]
+
+                        if with_alpha:
+                            bands.append(mask)
+
+                        return bands
+                    else:
+                        # Raw
+                        return [process(arr, mask)[0]]
+
+                with open_window_writer(output_raster, profile, block_shape) as dst:
+                    run(read, compute, partial(write_window, dst))
+
+                    if rgb and cmap is not None:
+                        update_rgb_colorinterp(dst)
+            elif dem:
+                # Apply hillshading, colormaps to elevation
+                ls = LightSource(azdeg=315, altdeg=45)
+                # Hillshading only shows in colored exports
+                hillshading = hillshade is not None and hillshade > 0 and rgb and cmap is not None
+                if hillshading:
+                    passes = 2
                     delta_scale = (ZOOM_EXTRA_LEVELS + 1) * 4
                     dx = src.meta["transform"][0] * delta_scale
                     dy = -src.meta["transform"][4] * delta_scale
-                    ls = LightSource(azdeg=315, altdeg=45)
-                    intensity = ls.hillshade(arr[0], dx=dx, dy=dy, vert_exag=hillshade)
-                    intensity = intensity * 255.0
-
-                # Apply colormap?
-                if rgb and cmap is not None:
-                    rgb_data, _ = apply_cmap(process(arr, skip_alpha=True), cmap)
-
-                    if intensity is not None:
-                        rgb_data = hsv_blend(rgb_data, intensity)
-                        
-                    band_num = 1
-                    for b in rgb_data:
-                        write_band(process(b, skip_rescale=True), dst, band_num)
-                        band_num += 1
-                    
-                    if with_alpha:
-                        write_band(mask, dst, band_num)
-
-                    update_rgb_colorinterp(dst)
-                else:
-                    # Raw
-                    write_band(process(arr)[0], dst, 1)
-        else:
-            # Copy bands as-is
-            with rasterio.open(output_raster, 'w', **profile) as dst:
-                band_num = 1
-                for idx in indexes:
-                    ci = src.colorinterp[idx - 1]
-                    arr = src.read(idx)
-
-                    if ci == ColorInterp.alpha:
+
+                    def read_elevation(window):
+                        # Gradients need the neighbors of the edge pixels of the window
+                        halo_window, (row, col) = pad_window(window, 1, profile['width'], profile['height'])
+                        crop = (slice(row, row + window.height), slice(col, col + window.width))
+
+                        return reader.read(1, window=halo_window), crop
+
+                    def compute_range(window, block):
+                        elevation, crop = block
+                        illumination = ls.illumination(elevation, dx=dx, dy=dy, vert_exag=hillshade)[crop]
+                        return illumination.min(), illumination.max()
+
+                    # The contrast stretch of the hillshade is relative to the
+                    # illumination of the whole raster
+                    ranges = []
+                    run(read_elevation, compute_range, lambda window, r: ranges.append(r))
+                    intensity_range = (np.min([r[0] for r in ranges]), np.max([r[1] for r in ranges]))
+
+                def read(window):
+                    return read_mask(window), reader.read(window=window), \
+                           read_elevation(window) if hillshading else None
+
+                def compute(window, block):
+                    mask, arr, elevation_block = block
+
+                    intensity = None
+                    if elevation_block is not None:
+                        elevation, crop = elevation_block
+                        intensity = ls.hillshade(elevation, dx=dx, dy=dy, vert_exag=hillshade,
+                                                 intensity_range=intensity_range)[crop]
+                        intensity *= 255.0
+
+                    # Apply colormap?
+                    if rgb and cmap is not None:
+                        rgb_data, _ = apply_cmap(process(arr, mask, skip_alpha=True), cmap)
+
+                        if intensity is not None:
+                            rgb_data = hsv_blend(rgb_data, intensity, out=rgb_data)
+
+                        bands = [process(b, mask, skip_rescale=True) for b in rgb_data]
+
                         if with_alpha:
-                            write_band(arr, dst, band_num)
-                            band_num += 1
+                            bands.append(mask)
+
+                        return bands
                     else:
-                        write_band(process(arr), dst, band_num)
-                        band_num += 1
-                
-                new_ci = [src.colorinterp[idx - 1] for idx in indexes]
-                if not with_alpha:
-                    new_ci = [ci for ci in new_ci if ci != ColorInterp.alpha]
-                    
-                dst.colorinterp = new_ci
-                
+                        # Raw
+                        return [process(arr, mask)[0]]
+
+                with open_window_writer(output_raster, profile, block_shape) as dst:
+                    run(read, compute, partial(write_window, dst), pass_index=passes - 1)
+
+                    if rgb and cmap is not None:
+                        update_rgb_colorinterp(dst)
+            else:
+                # Copy bands as-is
+                def read(window):
+                    mask = read_mask(window) if not with_alpha else None
+                    return mask, [reader.read(idx, window=window) for idx in indexes]
+
+                def compute(window, block):
+                    mask, data = block
+                    bands = []
+                    for idx, arr in zip(indexes, data):
+                        if src.colorinterp[idx - 1] == ColorInterp.alpha:
+                            if with_alpha:
+                                bands.append(arr)
+                        else:
+                            bands.append(process(arr, mask))
+
+                    return bands
+
+                with open_window_writer(output_raster, profile, block_shape) as dst:
+                    run(read, compute, partial(write_window, dst))
+
+                    new_ci = [src.colorinterp[idx - 1] for idx in indexes]
+                    if not with_alpha:
+                        new_ci = [ci for ci in new_ci if ci != ColorInterp.alpha]
+
+                    dst.colorinterp = new_ci
+        finally:
+            if warped_vrt is not None:
+                warped_vrt.close()
+
         if kmz:
             subprocess.check_output(["gdal_translate", "-of", "KMLSUPEROVERLAY", 
                                         "-co", "Name={}".format(name),
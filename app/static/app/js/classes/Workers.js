@@ -1,6 +1,6 @@
 import $ from 'jquery';
 
-const waitForCompletion = (celery_task_id, cb, checkUrl = "/api/workers/check/") => {
+const waitForCompletion = (celery_task_id, cb, checkUrl = "/api/workers/check/", progressCb = null) => {
     let errorCount = 0;
     let url = checkUrl + celery_task_id;
 
@@ -14,6 +14,8 @@ const waitForCompletion = (celery_task_id, cb, checkUrl = "/api/workers/check/")
             }else if (result.ready){
             cb();
             }else{
+            if (progressCb && result.progress !== undefined) progressCb(result.progress);
+
             // Retry
             setTimeout(() => check(), 2000);
             }
@@ -4,7 +4,6 @@ import AssetDownloads from '../classes/AssetDownloads';
 import PropTypes from 'prop-types';
 import ExportAssetDialog from './ExportAssetDialog';
 import { _ } from '../classes/gettext';
-import Workers from '../classes/Workers';
 
 class AssetDownloadButtons extends React.Component {
     static defaultProps = {
@@ -47,23 +46,15 @@ class AssetDownloadButtons extends React.Component {
     }
 
     downloadZip = (url) => {
-        $.ajax({
-            type: 'GET',
-            url
-        }).done(result => {
-            if (result.celery_task_id) {
-                Workers.waitForCompletion(result.celery_task_id, error => {
-                    if (error) {
-                        console.error(error)
-                    } else {
-                        Workers.downloadFile(result.celery_task_id, result.filename);
-                    }
-                });
-            }
-        }).fail(error => {
-            error = (error.responseJSON || {})[0] || JSON.stringify(error);
-            console.error(error)
-        });
+        // The archive is streamed while it is written. A download link keeps the
+        // app loaded when the request fails (the browser reports the failed download)
+        const link = document.createElement('a');
+        link.href = `${url}?stream=true`;
+        link.download = "";
+        link.style.display = "none";
+        document.body.appendChild(link);
+        link.click();
+        document.body.removeChild(link);
     }
 
     render() {
@@ -119,7 +119,7 @@ export default class ExportAssetPanel extends React.Component {
 
     return (cb) => {
       const { task } = this.props;
-      this.setState({ exporting: true, error: "" });
+      this.setState({ exporting: true, progress: null, error: "" });
       const data = this.getExportParams(format);
 
       if (this.state.epsg === "custom") Storage.setItem("last_export_custom_epsg", data.epsg);
@@ -139,7 +139,7 @@ export default class ExportAssetPanel extends React.Component {
               Workers.downloadFile(result.celery_task_id, result.filename);
               if (cb !== undefined) cb();
             }
-          });
+          }, undefined, progress => this.setState({ progress }));
         } else if (result.url) {
           // Simple download
           this.setState({ exporting: false });
@@ -169,7 +169,7 @@ export default class ExportAssetPanel extends React.Component {
   }
 
   render() {
-    const { epsg, customEpsg, exporting, format } = this.state;
+    const { epsg, customEpsg, exporting, format, progress } = this.state;
     const { exportFormats } = this.props;
     const utmEPSG = this.props.task.epsg;
 
@@ -213,7 +213,7 @@ export default class ExportAssetPanel extends React.Component {
           <div className={"btn-group " + (this.props.dropUp ? "dropup" : "")}>
             <button onClick={this.handleExport(exportFormats[0])}
               disabled={disabled} type="button" className="btn btn-sm btn-primary btn-export">
-              {exporting ? <i className="fa fa-spin fa-circle-notch" /> : <i className={this.efInfo[exportFormats[0]].icon + " fa-fw"} />} {exporting ? _("Exporting...") : this.efInfo[exportFormats[0]].label}
+              {exporting ? <i className="fa fa-spin fa-circle-notch" /> : <i className={this.efInfo[exportFormats[0]].icon + " fa-fw"} />} {exporting ? _("Exporting...") + (progress ? ` ${Math.round(progress)}%` : "") : this.efInfo[exportFormats[0]].label}
             </button>
             <button disabled={disabled} type="button" className="btn btn-sm dropdown-toggle btn-primary" data-toggle="dropdown"><span className="caret"></span></button>
             <ul className="dropdown-menu pull-right">
@@ -0,0 +1,283 @@
+import hashlib
+import os
+import sys
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+# Minimal MinIO-style S3 server used by tests and benchmarks.
+# Objects are files under the root directory: <root>/<bucket>/<key>
+# Usage: python simple_s3_server.py <port> <root dir> [latency ms]
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    root = '.'
+    latency = 0.0
+    metadata = {}
+    uploads = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parse(self):
+        parsed = urlparse(self.path)
+        parts = unquote(parsed.path).lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 else ''
+        query = {k: v[0] for k, v in parse_qs(parsed.query, keep_blank_values=True).items()}
+        return bucket, key, query
+
+    def _object_path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _etag(self, path):
+        st = os.stat(path)
+        return '"{}"'.format(hashlib.md5("{}:{}:{}".format(path, st.st_size, st.st_mtime_ns).encode()).hexdigest())
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length > 0 else b''
+
+    def _send(self, code, body=b'', content_type='application/xml', headers={}):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _not_found(self):
+        self._send(404, b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>NoSuchKey</Code></Error>')
+
+    def _object_headers(self, bucket, key, path):
+        st = os.stat(path)
+        headers = {
+            'ETag': self._etag(path),
+            'Last-Modified': self.date_time_string(st.st_mtime),
+            'Accept-Ranges': 'bytes',
+        }
+        # Like MinIO, metadata names are sent back in canonical header form
+        for k, v in self.metadata.get((bucket, key), {}).items():
+            headers['X-Amz-Meta-' + '-'.join(p.capitalize() for p in k.split('-'))] = v
+        return headers
+
+    def do_HEAD(self):
+        sleep(self.latency)
+        bucket, key, _ = self._parse()
+        path = self._object_path(bucket, key)
+        if not key or not os.path.isfile(path):
+            return self._not_found()
+
+        headers = self._object_headers(bucket, key, path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def do_GET(self):
+        sleep(self.latency)
+        bucket, key, query = self._parse()
+
+        if not key:
+            return self._list_objects(bucket, query)
+
+        path = self._object_path(bucket, key)
+        if not os.path.isfile(path):
+            return self._not_found()
+
+        size = os.path.getsize(path)
+        headers = self._object_headers(bucket, key, path)
+        start, end, code = 0, size - 1, 200
+
+        if_match = self.headers.get('If-Match')
+        if if_match and if_match != headers['ETag']:
+            return self._send(412, b'<?xml version="1.0" encoding="UTF-8"?><Error><Code>PreconditionFailed</Code></Error>')
+
+        byte_range = self.headers.get('Range')
+        if byte_range and byte_range.startswith('bytes='):
+            first, last = byte_range[len('bytes='):].split(',')[0].split('-')
+            if first == '':
+                start = max(0, size - int(last))
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            code = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+
+        self._send(code, body, 'application/octet-stream', headers)
+
+    def do_PUT(self):
+        sleep(self.latency)
+        bucket, key, query = self._parse()
+        body = self._read_body()
+
+        if 'uploadId' in query:
+            with self.lock:
+                parts = self.uploads.get(query['uploadId'])
+                if parts is None:
+                    return self._not_found()
+                parts[int(query['partNumber'])] = body
+            return self._send(200, headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+        path = self._object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        copy_source = self.headers.get('x-amz-copy-source')
+        if copy_source:
+            source_bucket, source_key = unquote(copy_source).lstrip('/').split('/', 1)
+            source_path = self._object_path(source_bucket, source_key)
+            if not os.path.isfile(source_path):
+                return self._not_found()
+
+            with open(source_path, 'rb') as f:
+                body = f.read()
+            with open(path, 'wb') as f:
+                f.write(body)
+
+            if self.headers.get('x-amz-metadata-directive') == 'REPLACE':
+                self._store_metadata(bucket, key)
+            else:
+                with self.lock:
+                    self.metadata[(bucket, key)] = dict(self.metadata.get((source_bucket, source_key), {}))
+
+            body = ('<?xml version="1.0" encoding="UTF-8"?><CopyObjectResult>'
+                    '<LastModified>2020-01-01T00:00:00.000Z</LastModified><ETag>{}</ETag>'
+                    '</CopyObjectResult>').format(escape(self._etag(path)))
+            return self._send(200, body.encode())
+
+        with open(path, 'wb') as f:
+            f.write(body)
+
+        self._store_metadata(bucket, key)
+        self._send(200, headers={'ETag': self._etag(path)})
+
+    def do_POST(self):
+        sleep(self.latency)
+        bucket, key, query = self._parse()
+        self._read_body()
+
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            with self.lock:
+                self.uploads[upload_id] = {}
+            self._store_metadata(bucket, key)
+            body = ('<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                    '<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'
+                    '</InitiateMultipartUploadResult>').format(escape(bucket), escape(key), upload_id)
+            return self._send(200, body.encode())
+
+        if 'uploadId' in query:
+            with self.lock:
+                parts = self.uploads.pop(query['uploadId'], None)
+            if parts is None:
+                return self._not_found()
+
+            path = self._object_path(bucket, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                for part_number in sorted(parts):
+                    f.write(parts[part_number])
+
+            body = ('<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                    '<Bucket>{}</Bucket><Key>{}</Key><ETag>{}</ETag>'
+                    '</CompleteMultipartUploadResult>').format(escape(bucket), escape(key), escape(self._etag(path)))
+            return self._send(200, body.encode())
+
+        self._send(400)
+
+    def do_DELETE(self):
+        sleep(self.latency)
+        bucket, key, _ = self._parse()
+        path = self._object_path(bucket, key)
+        if os.path.isfile(path):
+            os.remove(path)
+        with self.lock:
+            self.metadata.pop((bucket, key), None)
+        self._send(204)
+
+    def _store_metadata(self, bucket, key):
+        meta = {k[len('x-amz-meta-'):]: v for k, v in self.headers.items() if k.lower().startswith('x-amz-meta-')}
+        with self.lock:
+            self.metadata[(bucket, key)] = {k.lower(): v for k, v in meta.items()}
+
+    def _list_objects(self, bucket, query):
+        bucket_dir = os.path.join(self.root, bucket)
+        prefix = query.get('prefix', '')
+        max_keys = int(query.get('max-keys', 1000))
+        token = query.get('continuation-token') or query.get('start-after') or ''
+
+        keys = []
+        for dp, dn, filenames in os.walk(bucket_dir):
+            for f in filenames:
+                k = os.path.relpath(os.path.join(dp, f), bucket_dir).replace(os.sep, '/')
+                if k.startswith(prefix) and k > token:
+                    keys.append(k)
+        keys.sort()
+
+        page = keys[:max_keys]
+        truncated = len(keys) > max_keys
+
+        contents = ''
+        for k in page:
+            path = self._object_path(bucket, k)
+            st = os.stat(path)
+            contents += ('<Contents><Key>{}</Key><LastModified>2020-01-01T00:00:00.000Z</LastModified>'
+                         '<ETag>{}</ETag><Size>{}</Size><StorageClass>STANDARD</StorageClass></Contents>').format(
+                escape(k), escape(self._etag(path)), st.st_size)
+
+        body = ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                '<Name>{}</Name><Prefix>{}</Prefix><KeyCount>{}</KeyCount><MaxKeys>{}</MaxKeys>'
+                '<IsTruncated>{}</IsTruncated>{}{}</ListBucketResult>').format(
+            escape(bucket), escape(prefix), len(page), max_keys,
+            'true' if truncated else 'false',
+            '<NextContinuationToken>{}</NextContinuationToken>'.format(escape(page[-1])) if truncated else '',
+            contents)
+
+        self._send(200, body.encode())
+
+
+class WebServer(threading.Thread):
+    def __init__(self):
+        super().__init__()
+        self.host = "0.0.0.0"
+        self.port = int(sys.argv[1]) if len(sys.argv) >= 2 else 9100
+        S3Handler.root = sys.argv[2] if len(sys.argv) >= 3 else os.getcwd()
+        S3Handler.latency = float(sys.argv[3]) / 1000.0 if len(sys.argv) >= 4 else 0.0
+        self.ws = ThreadingHTTPServer((self.host, self.port), S3Handler)
+        self.ws.daemon_threads = True
+
+    def run(self):
+        print("S3 server started at Port:", self.port, "serving", S3Handler.root)
+        self.ws.serve_forever()
+
+    def shutdown(self):
+        print('Shutting down server.')
+        self.ws.shutdown()
+        print('Closing server.')
+        self.ws.server_close()
+        self.join()
+
+if __name__=='__main__':
+    webServer = WebServer()
+    webServer.start()
+    while True:
+        try:
+            sleep(0.5)
+        except KeyboardInterrupt:
+            print('Keyboard Interrupt sent.')
+            webServer.shutdown()
+            exit(0)
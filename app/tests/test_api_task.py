@@ -504,6 +504,10 @@ class TestApiTask(BootTransactionTestCase):
             # Address key is removed
             self.assertFalse('address' in metadata)
 
+            # Statistics were computed when the task completed
+            task.refresh_from_db()
+            self.assertTrue('orthophoto' in task.raster_statistics)
+
             # Scheme is xyz
             self.assertEqual(metadata['scheme'], 'xyz')
 
@@ -0,0 +1,93 @@
+from django.test import TestCase
+from worker.utils.cache_eviction import (
+    CacheEntry,
+    LruEvictionPolicy,
+    GdsfEvictionPolicy,
+    PinHotCogsEvictionPolicy,
+    evict,
+    get_eviction_policy,
+)
+
+MB = 1024 * 1024
+
+
+class TestCacheEviction(TestCase):
+    def setUp(self):
+        # Oldest access first, like the cache index
+        self.entries = [
+            CacheEntry('/media/1/dsm.tif', 1, 800 * MB, hits=2),
+            CacheEntry('/media/2/orthophoto.tif', 2, 10 * MB, hits=50),
+            CacheEntry('/media/3/orthophoto.tif', 3, 5 * MB, hits=30),
+            CacheEntry('/media/4/report.pdf', 4, 1 * MB, hits=1),
+        ]
+
+    def _files(self, entries):
+        return [entry.file for entry in entries]
+
+    def test_lru(self):
+        selected = LruEvictionPolicy().select(self.entries, 805 * MB)
+        self.assertEqual(self._files(selected), ['/media/1/dsm.tif', '/media/2/orthophoto.tif'])
+
+    def test_gdsf(self):
+        # The large, rarely read DEM goes before small and frequently read files
+        selected = GdsfEvictionPolicy().select(list(reversed(self.entries)), 1)
+        self.assertEqual(self._files(selected), ['/media/1/dsm.tif'])
+
+        selected = GdsfEvictionPolicy().select(self.entries, 801 * MB)
+        self.assertEqual(self._files(selected), ['/media/1/dsm.tif', '/media/4/report.pdf'])
+
+    def test_pin_hot_cogs(self):
+        policy = PinHotCogsEvictionPolicy(min_hits=10, max_pinned_size=12 * MB)
+        self.assertEqual(policy.pinned(self.entries), {'/media/2/orthophoto.tif'})
+
+        selected = policy.select(self.entries, 2000 * MB)
+        self.assertNotIn('/media/2/orthophoto.tif', self._files(selected))
+        self.assertEqual(len(selected), 3)
+
+    def test_evict_in_samples(self):
+        entries = list(self.entries)
+        removed = []
+
+        def load_entries(start, count):
+            return entries[start:start + count]
+
+        def remove_entries(selected):
+            for entry in selected:
+                entries.remove(entry)
+                removed.append(entry.file)
+
+        # Pinned entries at the head of the index do not stop the eviction
+        policy = PinHotCogsEvictionPolicy(min_hits=1, max_pinned_size=1000 * MB)
+        freed = evict(policy, load_entries, remove_entries, 1 * MB, sample_size=2)
+
+        self.assertEqual(freed, 1 * MB)
+        self.assertEqual(removed, ['/media/4/report.pdf'])
+
+    def test_pin_budget_across_samples(self):
+        # Hot COGs spread over several pages, more than the budget in total
+        entries = [CacheEntry('/media/{}/orthophoto.tif'.format(i), i, 10 * MB, hits=50) for i in range(6)]
+        entries.append(CacheEntry('/media/6/report.pdf', 6, 1 * MB, hits=1))
+        removed = []
+
+        def load_entries(start, count):
+            return entries[start:start + count]
+
+        def remove_entries(selected):
+            for entry in selected:
+                entries.remove(entry)
+                removed.append(entry.file)
+
+        # One budget for the whole eviction, not one for each page
+        policy = PinHotCogsEvictionPolicy(min_hits=10, max_pinned_size=25 * MB)
+        freed = evict(policy, load_entries, remove_entries, 30 * MB, sample_size=2)
+
+        # With a budget for each page, all the COGs would stay and only the report could go
+        self.assertEqual(freed, 30 * MB)
+        self.assertEqual(removed, ['/media/2/orthophoto.tif', '/media/3/orthophoto.tif',
+                                   '/media/4/orthophoto.tif'])
+
+    def test_get_eviction_policy(self):
+        self.assertIsInstance(get_eviction_policy('lru'), LruEvictionPolicy)
+        self.assertIsInstance(get_eviction_policy('gdsf'), GdsfEvictionPolicy)
+        self.assertIsInstance(get_eviction_policy('pin_hot_cogs', 100 * MB), PinHotCogsEvictionPolicy)
+        self.assertIsInstance(get_eviction_policy('unknown'), LruEvictionPolicy)
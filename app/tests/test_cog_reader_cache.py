@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+from django.test import TestCase
+from app.classes import cog_reader_cache
+from app.classes.cog_reader_cache import CogReaderCache
+from webodm import settings
+
+
+class TestCogReaderCache(TestCase):
+    def setUp(self):
+        self.raster = os.path.join(settings.BASE_DIR, "app", "fixtures", "orthophoto.tif")
+
+    def test_reuse_handles(self):
+        cache = CogReaderCache(max_open=2, idle_seconds=300)
+
+        with cache.reader(self.raster, "v1") as src:
+            first = src
+        with cache.reader(self.raster, "v1") as src:
+            self.assertIs(src, first)
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["idle"], 1)
+
+        # Concurrent leases never share a handle
+        with cache.reader(self.raster, "v1") as a:
+            with cache.reader(self.raster, "v1") as b:
+                self.assertIsNot(a, b)
+
+        # Cap on open handles
+        with cache.reader(self.raster, "v1"):
+            with cache.reader(self.raster, "v1"):
+                with cache.reader(self.raster, "v1"):
+                    pass
+        self.assertLessEqual(cache.stats()["idle"], 2)
+
+        cache.clear()
+        self.assertEqual(cache.stats()["idle"], 0)
+
+    def test_version_change(self):
+        cache = CogReaderCache(max_open=4, idle_seconds=300)
+
+        with cache.reader(self.raster, "v1") as src:
+            first = src
+        with cache.reader(self.raster, "v2") as src:
+            self.assertIsNot(src, first)
+
+        # Old version handle was dropped
+        self.assertEqual(cache.stats()["idle"], 1)
+
+    def test_idle_eviction(self):
+        cache = CogReaderCache(max_open=4, idle_seconds=0)
+
+        with cache.reader(self.raster, "v1"):
+            pass
+        with cache.reader(self.raster, "v1"):
+            pass
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 0)
+        self.assertEqual(stats["misses"], 2)
+        self.assertGreaterEqual(stats["evictions"], 1)
+
+    def test_file_changes(self):
+        tmp_dir = tempfile.mkdtemp()
+        raster = os.path.join(tmp_dir, "orthophoto.tif")
+        shutil.copy(self.raster, raster)
+        cache = CogReaderCache(max_open=4, idle_seconds=300)
+
+        try:
+            with cache.reader(raster, "v1") as src:
+                first = src
+
+            # Replaced with the same version (e.g. a download keeping the mtime)
+            shutil.copy(self.raster, raster + ".tmp")
+            os.replace(raster + ".tmp", raster)
+            with cache.reader(raster, "v1") as src:
+                self.assertIsNot(src, first)
+                self.assertTrue(src.dataset.count > 0)
+            self.assertEqual(cache.stats()["idle"], 1)
+            self.assertEqual(cache.stats()["hits"], 0)
+
+            # Deleted, the handle is closed without waiting for it to be idle for long
+            os.remove(raster)
+            with mock.patch.object(cog_reader_cache, "FILES_CHECK_SECONDS", 0):
+                with cache.reader(self.raster, "v1"):
+                    pass
+            self.assertEqual(cache.stats()["idle"], 1)
+            self.assertEqual(cache.stats()["evictions"], 2)
+        finally:
+            cache.clear()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def test_disabled(self):
+        cache = CogReaderCache(max_open=0, idle_seconds=300)
+
+        with cache.reader(self.raster, "v1") as src:
+            self.assertTrue(src.dataset.count > 0)
+
+        self.assertEqual(cache.stats()["idle"], 0)
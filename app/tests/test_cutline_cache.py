@@ -0,0 +1,49 @@
+import os
+import rasterio
+from django.test import TestCase
+from rasterio.crs import CRS
+from rasterio.features import bounds as featureBounds
+from rasterio.warp import transform_bounds
+from rio_tiler.utils import create_cutline
+from app.classes.cutline_cache import CutlineCache
+from webodm import settings
+
+
+class TestCutlineCache(TestCase):
+    def setUp(self):
+        self.raster = os.path.join(settings.BASE_DIR, "app", "fixtures", "orthophoto.tif")
+
+    def _feature(self, src, shrink, properties=None):
+        west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+        dx, dy = (east - west) * shrink, (north - south) * shrink
+        ring = [[west + dx, south + dy], [east - dx, south + dy], [east - dx, north - dy],
+                [west + dx, north - dy], [west + dx, south + dy]]
+        return {"type": "Feature", "properties": properties or {},
+                "geometry": {"type": "Polygon", "coordinates": [ring]}}
+
+    def test_cutlines(self):
+        cache = CutlineCache(max_entries=2)
+
+        with rasterio.open(self.raster) as src:
+            feature = self._feature(src, 0.1)
+            cutline, bbox = cache.get(src, feature)
+
+            self.assertEqual(cutline, create_cutline(src, feature, CRS.from_string("EPSG:4326")))
+            self.assertEqual(bbox, featureBounds(feature))
+
+            # Same geometry, with other properties or as a plain geometry
+            self.assertIs(cache.get(src, self._feature(src, 0.1, {"name": "field"}))[0], cutline)
+            self.assertIs(cache.get(src, feature["geometry"])[0], cutline)
+            self.assertEqual(cache.stats()["hits"], 2)
+            self.assertEqual(cache.stats()["misses"], 1)
+
+            # Bounded
+            cache.get(src, self._feature(src, 0.2))
+            cache.get(src, self._feature(src, 0.3))
+            self.assertEqual(cache.stats()["entries"], 2)
+            cache.get(src, feature)
+            self.assertEqual(cache.stats()["misses"], 4)
+
+            # Invalid geometries are not cached
+            self.assertRaises(Exception, cache.get, src, {"type": "Point", "coordinates": [0, 0]})
+            self.assertEqual(cache.stats()["entries"], 2)
@@ -0,0 +1,132 @@
+import os
+import tempfile
+from unittest import mock
+from django.test import TestCase, RequestFactory
+from django.utils.http import http_date
+from webodm import settings
+from app.api.tasks import download_file_stream
+from app.classes import task_assets_manager
+from app.classes.task_assets_manager import LocalAssetSource, S3AssetSource, get_chunk_size
+
+
+class TestDownloadRanges(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.data = os.urandom(5000)
+        fd, self.path = tempfile.mkstemp(suffix='.laz')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _get(self, **headers):
+        source = LocalAssetSource(self.path)
+        return download_file_stream(self.factory.get('/', **headers), source, 'attachment', 'model.laz')
+
+    def _body(self, res):
+        return b''.join(res.streaming_content)
+
+    def test_full_download(self):
+        res = self._get()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res['Content-Length'], str(len(self.data)))
+        self.assertEqual(res['Accept-Ranges'], 'bytes')
+        self.assertTrue(res.has_header('ETag'))
+        self.assertTrue(res.has_header('Last-Modified'))
+        self.assertEqual(self._body(res), self.data)
+
+    def test_ranges(self):
+        res = self._get(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res['Content-Range'], 'bytes 100-199/5000')
+        self.assertEqual(res['Content-Length'], '100')
+        self.assertEqual(self._body(res), self.data[100:200])
+
+        res = self._get(HTTP_RANGE='bytes=-10')
+        self.assertEqual(self._body(res), self.data[-10:])
+
+        res = self._get(HTTP_RANGE='bytes=0-9,4000-4009')
+        self.assertEqual(res.status_code, 206)
+        self.assertTrue(res['Content-Type'].startswith('multipart/byteranges'))
+        body = self._body(res)
+        self.assertEqual(len(body), int(res['Content-Length']))
+        self.assertIn(b'Content-Range: bytes 4000-4009/5000', body)
+        self.assertIn(self.data[4000:4010], body)
+
+        res = self._get(HTTP_RANGE='bytes=6000-')
+        self.assertEqual(res.status_code, 416)
+        self.assertEqual(res['Content-Range'], 'bytes */5000')
+
+        # The whole file is sent once, not once per range
+        res = self._get(HTTP_RANGE='bytes=' + ','.join(['0-'] * 100))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(self._body(res), self.data)
+
+    def test_conditional(self):
+        etag = self._get()['ETag']
+
+        res = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res['ETag'], etag)
+
+        self.assertEqual(self._get(HTTP_IF_NONE_MATCH='"other"').status_code, 200)
+
+        res = self._get(HTTP_IF_MODIFIED_SINCE=http_date(os.stat(self.path).st_mtime + 60))
+        self.assertEqual(res.status_code, 304)
+
+        res = self._get(HTTP_IF_MODIFIED_SINCE=http_date(os.stat(self.path).st_mtime - 60))
+        self.assertEqual(res.status_code, 200)
+
+        # A stale If-Range sends the whole file
+        self.assertEqual(self._get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 206)
+        self.assertEqual(self._get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"').status_code, 200)
+
+    def test_x_accel_redirect(self):
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        fd, media_path = tempfile.mkstemp(suffix='.laz', dir=settings.MEDIA_ROOT)
+        os.close(fd)
+
+        try:
+            with mock.patch.object(settings, 'DOWNLOADS_X_ACCEL_REDIRECT', True):
+                source = LocalAssetSource(media_path)
+                res = download_file_stream(self.factory.get('/'), source, 'attachment', 'model.laz')
+                self.assertEqual(res['X-Accel-Redirect'], '/internal-media/' + os.path.basename(media_path))
+                self.assertEqual(res.content, b'')
+
+                # Files outside of the media directory are sent by the application
+                res = self._get()
+                self.assertFalse(res.has_header('X-Accel-Redirect'))
+                self.assertEqual(self._body(res), self.data)
+        finally:
+            os.remove(media_path)
+
+    def test_s3_cache_on_read(self):
+        on_read = mock.Mock()
+        s3_object = {'ContentLength': 5000, 'LastModified': mock.Mock(), 'ETag': '"abc"'}
+        source = S3AssetSource('model.laz', 'test', s3_object, on_read=on_read)
+
+        def get_s3_object(key, bucket=None, byte_range=None, if_match=None):
+            body = mock.Mock()
+            body.iter_chunks.return_value = [b'data']
+            return {'Body': body}
+
+        with mock.patch.object(task_assets_manager, 'get_s3_object', side_effect=get_s3_object):
+            # Probes of the header do not bring the file to the cache
+            list(source.stream(0, 1023))
+            list(source.stream(4000, 4999))
+            self.assertEqual(on_read.call_count, 0)
+
+            # The whole file, or most of it, does
+            list(source.stream())
+            self.assertEqual(on_read.call_count, 1)
+            list(source.stream(1000, 4999))
+            self.assertEqual(on_read.call_count, 2)
+
+    def test_chunk_size(self):
+        mb = 1024 * 1024
+        self.assertEqual(get_chunk_size(0), mb)
+        self.assertEqual(get_chunk_size(100 * mb), mb)
+        self.assertEqual(get_chunk_size(1024 * mb), 4 * mb)
+        self.assertEqual(get_chunk_size(2048 * mb), 8 * mb)
+        self.assertEqual(get_chunk_size(100 * 1024 * mb), 8 * mb)
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import uuid
+from django.test import TestCase
+from app.classes import export_registry as registry_module
+from app.classes.export_registry import ExportRegistry
+from worker.tasks import TestSafeAsyncResult
+
+
+class TestExportRegistry(TestCase):
+    def setUp(self):
+        self.registry = ExportRegistry(3600)
+        self.key = self.registry.make_key(uuid.uuid4(), 'dsm', 'v1', {'format': 'png', 'hillshade': 6})
+        self.started = []
+
+    def tearDown(self):
+        registry_module._get_redis_client().delete(registry_module.REGISTRY_KEY.format(self.key))
+
+    def start(self, celery_task_id):
+        self.started.append(celery_task_id)
+
+    def test_make_key(self):
+        task_id = uuid.uuid4()
+        key = self.registry.make_key(task_id, 'dsm', 'v1', {'format': 'png', 'epsg': None})
+
+        self.assertEqual(key, self.registry.make_key(task_id, 'dsm', 'v1', {'epsg': None, 'format': 'png'}))
+        self.assertNotEqual(key, self.registry.make_key(task_id, 'dsm', 'v2', {'format': 'png', 'epsg': None}))
+        self.assertNotEqual(key, self.registry.make_key(task_id, 'dtm', 'v1', {'format': 'png', 'epsg': None}))
+        self.assertNotEqual(key, self.registry.make_key(task_id, 'dsm', 'v1', {'format': 'jpg', 'epsg': None}))
+
+    def test_get_or_start(self):
+        # Identical requests attach to the export in progress
+        celery_task_id = self.registry.get_or_start(self.key, self.start)
+        self.assertEqual(self.registry.get_or_start(self.key, self.start), celery_task_id)
+        self.assertEqual(self.started, [celery_task_id])
+
+        # and reuse its result
+        fd, file = tempfile.mkstemp()
+        os.close(fd)
+        TestSafeAsyncResult.set(celery_task_id, {'file': file})
+        self.assertEqual(self.registry.get_or_start(self.key, self.start), celery_task_id)
+        self.assertEqual(len(self.started), 1)
+
+        # until it is removed
+        os.remove(file)
+        new_celery_task_id = self.registry.get_or_start(self.key, self.start)
+        self.assertNotEqual(new_celery_task_id, celery_task_id)
+        self.assertEqual(self.started, [celery_task_id, new_celery_task_id])
+
+    def test_failed_export(self):
+        celery_task_id = self.registry.get_or_start(self.key, self.start)
+        TestSafeAsyncResult.set(celery_task_id, {'error': 'failed'})
+
+        self.assertNotEqual(self.registry.get_or_start(self.key, self.start), celery_task_id)
+        self.assertEqual(len(self.started), 2)
+
+    def test_start_failure(self):
+        def failing_start(celery_task_id):
+            raise Exception('broker down')
+
+        with self.assertRaises(Exception):
+            self.registry.get_or_start(self.key, failing_start)
+
+        # Not attached to an export that never ran, nor started twice
+        self.assertIsNone(registry_module._get_redis_client().get(registry_module.REGISTRY_KEY.format(self.key)))
+        celery_task_id = self.registry.get_or_start(self.key, self.start)
+        self.assertEqual(self.started, [celery_task_id])
+
+    def test_lost_export(self):
+        # Celery reports unknown (lost) tasks as pending forever
+        registry = ExportRegistry(3600, pending_timeout=0)
+        celery_task_id = registry.get_or_start(self.key, self.start)
+
+        new_celery_task_id = registry.get_or_start(self.key, self.start)
+        self.assertNotEqual(new_celery_task_id, celery_task_id)
+        self.assertEqual(self.started, [celery_task_id, new_celery_task_id])
+
+        # Kept for the ttl once started
+        ttl = registry_module._get_redis_client().ttl(registry_module.REGISTRY_KEY.format(self.key))
+        self.assertTrue(ttl > registry_module.START_CLAIM_SECONDS)
+
+    def test_disabled(self):
+        registry = ExportRegistry(0)
+
+        self.assertNotEqual(registry.get_or_start(self.key, self.start),
+                            registry.get_or_start(self.key, self.start))
+        self.assertEqual(len(self.started), 2)
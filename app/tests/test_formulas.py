@@ -1,6 +1,8 @@
 import re
+import numpy as np
 from django.test import TestCase
-from app.api.formulas import lookup_formula, get_algorithm_list, get_camera_filters_for, algos, get_auto_bands
+from app.api.formulas import lookup_formula, get_algorithm_list, get_camera_filters_for, algos, get_auto_bands, \
+    compile_formula
 
 class TestFormulas(TestCase):
     def setUp(self):
@@ -25,6 +27,32 @@ class TestFormulas(TestCase):
         self.assertTrue(lookup_formula("_TESTFUNC", "RGB")[0] == "b1+(sqrt(b3))")
         self.assertTrue(lookup_formula("_TESTFUNC", "RGB")[1] == None)
 
+    def test_compile_formula(self):
+        expr, _ = lookup_formula("NDVI", "RGBN")
+        formula = compile_formula(expr)
+
+        # Compiled once
+        self.assertIs(formula, compile_formula(expr))
+        self.assertEqual(formula.indexes, (1, 4))
+
+        # Evaluated on the bands of indexes, in float32
+        data = np.array([[[10, 0]], [[30, 0]]], dtype=np.uint8)
+        result = formula.evaluate(data)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.shape, (1, 1, 2))
+        self.assertAlmostEqual(float(result[0, 0, 0]), 0.5)
+
+        # NaN values are replaced
+        self.assertEqual(float(result[0, 0, 1]), 0)
+
+        # Multiple blocks
+        formula = compile_formula("b3,b1*2")
+        self.assertEqual(formula.indexes, (1, 3))
+        self.assertEqual(formula.evaluate(data).tolist(), [[[30, 0]], [[20, 0]]])
+
+        self.assertRaises(ValueError, compile_formula, "b1 +* b2")
+        self.assertRaises(ValueError, compile_formula, "b1 + x")
+
     def test_algo_list(self):
         al = get_algorithm_list()
 
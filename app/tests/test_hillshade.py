@@ -0,0 +1,46 @@
+import numpy as np
+from django.test import TestCase
+from app.api.hillshade import LightSource
+from app.api.hsvblend import hsv_blend, hsv_blend_legacy
+
+
+class TestHillshade(TestCase):
+    def setUp(self):
+        rnd = np.random.default_rng(42)
+        self.elevation = np.cumsum(np.cumsum(rnd.normal(size=(288, 288)), axis=0), axis=1).astype(np.float32)
+        self.rgb = rnd.integers(0, 256, size=(3, 288, 288), dtype=np.uint8)
+        self.rgb[:, 0:10, 0:10] = 0
+
+    def test_hillshade(self):
+        ls = LightSource(azdeg=315, altdeg=45)
+
+        for vert_exag in [1, 3.5]:
+            intensity = ls.hillshade(self.elevation, vert_exag=vert_exag, dx=0.3, dy=0.3)
+            reference = ls.hillshade_normals(self.elevation.astype(np.float64), vert_exag=vert_exag, dx=0.3, dy=0.3)
+
+            self.assertEqual(intensity.dtype, np.float32)
+            self.assertTrue(np.allclose(intensity, reference, atol=1e-5))
+
+        # Results can be written to a buffer
+        out = np.empty(self.elevation.shape, dtype=np.float32)
+        self.assertIs(ls.hillshade(self.elevation, out=out), out)
+
+        # Flat surfaces are evenly lit
+        flat = ls.hillshade(np.ones((20, 20), dtype=np.float32))
+        self.assertTrue(np.allclose(flat, ls.hillshade_normals(np.ones((20, 20)))))
+
+    def test_hsv_blend(self):
+        intensity = LightSource().hillshade(self.elevation) * 255.0
+        expected = hsv_blend_legacy(self.rgb, intensity)
+
+        blended = hsv_blend(self.rgb, intensity)
+        self.assertEqual(blended.dtype, np.uint8)
+        self.assertLessEqual(np.abs(blended.astype(np.int16) - expected.astype(np.int16)).max(), 1)
+
+        # Black pixels take the intensity
+        self.assertTrue(np.array_equal(blended[:, 0:10, 0:10], expected[:, 0:10, 0:10]))
+
+        # In place
+        rgb = self.rgb.copy()
+        self.assertIs(hsv_blend(rgb, intensity, out=rgb), rgb)
+        self.assertTrue(np.array_equal(rgb, blended))
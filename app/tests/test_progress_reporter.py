@@ -0,0 +1,61 @@
+import threading
+import time
+from django.test import TestCase
+from app.classes.progress_reporter import ProgressReporter
+
+
+class TestProgressReporter(TestCase):
+    def test_coalesce(self):
+        saved = []
+        console = []
+
+        with ProgressReporter(saved.append, console.append, interval=60, min_percent=10) as reporter:
+            lock = threading.Lock()
+            transferred = [0]
+
+            def transfer():
+                for i in range(1000):
+                    with lock:
+                        transferred[0] += 1
+                        reporter.update(transferred[0] / 4000)
+
+            threads = [threading.Thread(target=transfer) for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        # Saved when the progress moved enough, and the last value when closed
+        self.assertLessEqual(len(saved), 12)
+        self.assertEqual(saved[-1], 1.0)
+        for previous, value in zip(saved, saved[1:-1]):
+            self.assertGreaterEqual(abs(value - previous), 0.1)
+
+        self.assertEqual(len(console), len(saved))
+        self.assertEqual(console[-1].strip(), "...100.00%")
+        self.assertEqual(sum(text.count("\n") for text in console), len(saved) // 10)
+
+    def test_interval(self):
+        saved = []
+
+        with ProgressReporter(saved.append, interval=0.05, min_percent=100) as reporter:
+            reporter.update(0.1)
+            reporter.update(0.2)
+            time.sleep(0.3)
+            self.assertIn(0.2, saved)
+
+            # No saves without changes
+            count = len(saved)
+            time.sleep(0.2)
+            self.assertEqual(len(saved), count)
+
+        self.assertEqual(len(saved), count)
+
+    def test_save_errors(self):
+        def save(value):
+            raise Exception("Database is down")
+
+        with ProgressReporter(save, interval=0.01) as reporter:
+            reporter.update(0.5)
+
+        self.assertEqual(reporter.saves, 1)
@@ -0,0 +1,85 @@
+import os
+from contextlib import contextmanager
+from unittest import mock
+from django.contrib.auth.models import User
+from django.test import TestCase
+from rio_tiler.io import COGReader
+from app import raster_statistics
+from app.models import Project, Task
+from app.raster_statistics import compute_raster_metadata, get_raster_metadata
+
+ORTHOPHOTO = os.path.join(os.path.dirname(__file__), '..', 'fixtures', 'orthophoto.tif')
+
+
+class FakeTask:
+    def __init__(self):
+        self.raster_statistics = {}
+        self.saves = 0
+
+    def set_raster_statistics(self, tile_type, metadata):
+        self.raster_statistics[tile_type] = metadata
+        self.saves += 1
+
+
+class TestRasterStatistics(TestCase):
+    def setUp(self):
+        self.opened = 0
+
+    @contextmanager
+    def _open_cog_reader(self, url):
+        self.opened += 1
+        with COGReader(ORTHOPHOTO) as src:
+            yield src
+
+    def test_compute_raster_metadata(self):
+        with COGReader(ORTHOPHOTO) as src:
+            metadata = compute_raster_metadata(src, 'orthophoto')
+
+        self.assertTrue(metadata['band_count'] > 0)
+        self.assertEqual(len(metadata['bounds']['value']), 4)
+        self.assertTrue('1' in metadata['info']['statistics'])
+        self.assertEqual(len(metadata['info']['statistics']['1']['histogram'][0]), 255)
+
+    def test_get_raster_metadata(self):
+        task = FakeTask()
+        raster_statistics._get_redis_cache().clear()
+
+        with mock.patch.object(raster_statistics, 'open_cog_reader', self._open_cog_reader), \
+             mock.patch.object(raster_statistics, 'get_cog_version', return_value='v1'):
+            # Default statistics are stored on the task
+            metadata = get_raster_metadata(task, 'orthophoto.tif', 'orthophoto')
+            self.assertTrue('orthophoto' in task.raster_statistics)
+            self.assertEqual(task.saves, 1)
+
+            # And returned as copies
+            metadata['info']['changed'] = True
+            metadata = get_raster_metadata(task, 'orthophoto.tif', 'orthophoto')
+            self.assertFalse('changed' in metadata['info'])
+            self.assertEqual(self.opened, 1)
+
+            # Formula statistics are memoized
+            expr = '(b1 - b2) / (b1 + b2)'
+            metadata = get_raster_metadata(task, 'orthophoto.tif', 'orthophoto', expr, (-1, 1))
+            self.assertEqual(len(metadata['info']['statistics']), 1)
+            get_raster_metadata(task, 'orthophoto.tif', 'orthophoto', expr, (-1, 1))
+            self.assertEqual(self.opened, 2)
+
+            # Another range is computed again
+            get_raster_metadata(task, 'orthophoto.tif', 'orthophoto', expr, (0, 1))
+            self.assertEqual(self.opened, 3)
+            self.assertEqual(task.saves, 1)
+
+    def test_set_raster_statistics(self):
+        user = User.objects.create_user(username='statsuser', password='test1234')
+        project = Project.objects.create(owner=user, name='test project')
+        task = Task.objects.create(project=project)
+
+        # Two requests with their own copy of the task store different rasters
+        Task.objects.get(pk=task.pk).set_raster_statistics('orthophoto', {'band_count': 3})
+        stale_task = Task.objects.get(pk=task.pk)
+        Task.objects.get(pk=task.pk).set_raster_statistics('dsm', {'band_count': 1})
+        stale_task.set_raster_statistics('dtm', {'band_count': 1})
+
+        task.refresh_from_db()
+        self.assertEqual(sorted(task.raster_statistics.keys()), ['dsm', 'dtm', 'orthophoto'])
+        self.assertEqual(stale_task.raster_statistics, task.raster_statistics)
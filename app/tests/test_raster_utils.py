@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import rasterio
+from django.test import TestCase
+from rasterio.windows import Window
+from rio_tiler.io import COGReader
+from app import raster_utils
+from app.raster_utils import block_windows, pad_window, process_windows, export_raster
+
+ORTHOPHOTO = os.path.join(os.path.dirname(__file__), '..', 'fixtures', 'orthophoto.tif')
+
+
+class TestRasterUtils(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_block_windows(self):
+        windows = list(block_windows(100, 70, (32, 32)))
+        self.assertEqual(len(windows), 4 * 3)
+        self.assertEqual(windows[-1], Window(96, 64, 4, 6))
+        self.assertEqual(sum(w.width * w.height for w in windows), 100 * 70)
+
+    def test_pad_window(self):
+        self.assertEqual(pad_window(Window(32, 32, 32, 32), 1, 100, 70),
+                         (Window(31, 31, 34, 34), (1, 1)))
+
+        # Clipped at the edges of the raster
+        self.assertEqual(pad_window(Window(0, 64, 32, 6), 1, 100, 70),
+                         (Window(0, 63, 33, 7), (1, 0)))
+
+    def test_export_windows(self):
+        # Exports do not depend on the size of the windows they are processed by
+        with mock.patch.object(raster_utils, 'open_cog_reader', COGReader):
+            for fmt, ext, opts in [('gtiff', 'tif', {}),
+                                   ('png', 'png', {'rescale': [0, 255]}),
+                                   ('jpg', 'jpg', {'expression': '(b1 - b2) / (b1 + b2)', 'rescale': [-1, 1], 'color_map': 'rdylgn'})]:
+                outputs = []
+
+                for block_shape in [(512, 512), (32, 32)]:
+                    output = os.path.join(self.tmp_dir, '{}_{}.{}'.format(fmt, block_shape[0], ext))
+                    with mock.patch.object(raster_utils, 'get_block_shape', return_value=block_shape):
+                        export_raster(ORTHOPHOTO, output, format=fmt, asset_type='orthophoto', **opts)
+
+                    with rasterio.open(output) as f:
+                        outputs.append(f.read())
+
+                self.assertTrue(np.array_equal(outputs[0], outputs[1]), fmt)
+
+            # No temporary files are left
+            self.assertFalse(any('.tmp.' in f for f in os.listdir(self.tmp_dir)))
+
+    def test_process_windows(self):
+        windows = list(block_windows(100, 70, (16, 16)))
+
+        for workers in [1, 4]:
+            written = []
+            progress = []
+            process_windows(windows, lambda w: w.col_off, lambda w, col: col * 2,
+                            lambda w, result: written.append((w, result)),
+                            workers=workers, progress_callback=lambda done, total: progress.append((done, total)))
+
+            # Windows are written in order, whatever the number of workers
+            self.assertEqual(written, [(w, w.col_off * 2) for w in windows])
+            self.assertEqual(progress[-1], (len(windows), len(windows)))
+
+    def test_export_workers(self):
+        with mock.patch.object(raster_utils, 'open_cog_reader', COGReader), \
+             mock.patch.object(raster_utils, 'get_block_shape', return_value=(32, 32)):
+            outputs = []
+
+            for workers in [1, 4]:
+                progress = []
+                output = os.path.join(self.tmp_dir, 'workers_{}.png'.format(workers))
+                export_raster(ORTHOPHOTO, output, format='png', asset_type='orthophoto',
+                              expression='(b1 - b2) / (b1 + b2)', rescale=[-1, 1], color_map='rdylgn',
+                              workers=workers, progress_callback=progress.append)
+
+                self.assertEqual(progress, sorted(progress))
+                self.assertEqual(progress[-1], 1)
+
+                with rasterio.open(output) as f:
+                    outputs.append(f.read())
+
+            self.assertTrue(np.array_equal(outputs[0], outputs[1]))
@@ -0,0 +1,144 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from django.test import TestCase
+from webodm import settings
+from worker.utils import redis_file_cache
+from worker.cache_files import add_local_file_to_redis_cache, reconcile_file_cache_size
+
+
+class TestRedisFileCache(TestCase):
+    def setUp(self):
+        self._clear_index()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.files = []
+
+        for i, size in enumerate([10, 20, 30]):
+            path = os.path.join(self.tmp_dir, "file_{}".format(i))
+            with open(path, "wb") as f:
+                f.write(b"0" * size)
+            self.files.append(path)
+
+    def tearDown(self):
+        self._clear_index()
+
+        for f in self.files:
+            if os.path.exists(f):
+                os.remove(f)
+        os.rmdir(self.tmp_dir)
+
+    def _clear_index(self):
+        redis_file_cache._get_redis_client().delete(*redis_file_cache._index_keys)
+
+    def test_index(self):
+        a, b, c = self.files
+
+        redis_file_cache.update_files_in_cache({a: 1, b: 2, c: 3})
+        self.assertEqual(redis_file_cache.get_files_in_cache(), [c, b, a])
+        self.assertEqual(redis_file_cache.get_files_with_old_accessed_first(), [a, b, c])
+        self.assertTrue(redis_file_cache.has_file_in_cache(b))
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 60)
+
+        # Touch moves a file to the most recent position
+        redis_file_cache.update_file_in_cache(a)
+        self.assertEqual(redis_file_cache.get_files_in_cache()[0], a)
+        self.assertEqual(redis_file_cache.get_oldest_files_in_cache(2), [(b, 20), (c, 30)])
+
+        # Removing is idempotent and keeps sizes consistent
+        self.assertEqual(redis_file_cache.remove_file_from_cache(b), 1)
+        self.assertEqual(redis_file_cache.remove_file_from_cache(b), 0)
+        self.assertFalse(redis_file_cache.has_file_in_cache(b))
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 40)
+
+    def test_batched_accesses(self):
+        a, b, c = self.files
+
+        redis_file_cache.record_file_access(a)
+        redis_file_cache.record_file_access(c)
+        redis_file_cache.record_file_access(c)
+        redis_file_cache.record_file_access(os.path.join(self.tmp_dir, "missing"))
+
+        self.assertEqual(redis_file_cache.flush_file_accesses(), 2)
+        self.assertEqual(sorted(redis_file_cache.get_files_in_cache()), sorted([a, c]))
+        self.assertEqual(redis_file_cache.flush_file_accesses(), 0)
+
+        # Hits are counted per access, not per flush
+        hits = {file: file_hits for file, _, _, file_hits in redis_file_cache.get_cache_entries(0, 10)}
+        self.assertEqual(hits, {a: 1, c: 2})
+
+    def test_size_counter(self):
+        a, b, c = self.files
+
+        redis_file_cache.update_files_in_cache({a: 1, b: 2})
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 30)
+
+        # Updating a known file only applies the size difference
+        redis_file_cache.update_file_in_cache(a, 15)
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 35)
+
+        redis_file_cache.remove_files_from_cache([a, c])
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 20)
+
+        # A lost counter is rebuilt from the sizes
+        redis_file_cache._get_redis_client().delete(redis_file_cache.cache_files_total_size_key)
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 20)
+
+    def test_reservations(self):
+        a, b, c = self.files
+
+        redis_file_cache.update_files_in_cache({a: 1})
+
+        # Admitted files count in the size before they are written
+        self.assertTrue(redis_file_cache.reserve_cache_space(b, 20, 40))
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 30)
+        self.assertFalse(redis_file_cache.reserve_cache_space(c, 30, 40))
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 30)
+
+        # Adding the file turns its reservation into its size
+        redis_file_cache.update_file_in_cache(b, 20)
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 30)
+        self.assertFalse(redis_file_cache.release_cache_space(b))
+
+        # Failed additions give their space back
+        self.assertTrue(redis_file_cache.reserve_cache_space(c, 10, 40))
+        self.assertTrue(redis_file_cache.release_cache_space(c))
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 30)
+
+        # Reservations in progress survive a rebuild of the counter
+        self.assertTrue(redis_file_cache.reserve_cache_space(c, 10, 40))
+        redis_file_cache._get_redis_client().delete(redis_file_cache.cache_files_total_size_key)
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 40)
+
+    def test_concurrent_admissions(self):
+        files = []
+        for i in range(10):
+            path = os.path.join(self.tmp_dir, "large_{}".format(i))
+            with open(path, "wb") as f:
+                f.write(b"0" * 300 * 1024)
+            files.append(path)
+        self.files += files
+
+        # All of them see room for one more file, only 3 of them fit
+        with mock.patch.object(settings, 'S3_CACHE_MAX_SIZE_MB', 1), ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(add_local_file_to_redis_cache, files))
+
+        self.assertEqual(len(redis_file_cache.get_files_in_cache()), 3)
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 3 * 300 * 1024)
+        self.assertEqual(len([f for f in files if os.path.exists(f)]), 3)
+
+    def test_reconcile(self):
+        a, b, c = self.files
+
+        redis_file_cache.update_files_in_cache({a: 1, b: 2, c: 3})
+        redis_file_cache._get_redis_client().set(redis_file_cache.cache_files_total_size_key, 999)
+
+        os.remove(b)
+        with open(c, "wb") as f:
+            f.write(b"0" * 50)
+
+        reconcile_file_cache_size()
+
+        self.assertEqual(redis_file_cache.get_files_with_old_accessed_first(), [a, c])
+        self.assertEqual(redis_file_cache.get_oldest_files_in_cache(2), [(a, 10), (c, 50)])
+        self.assertEqual(redis_file_cache.get_current_cache_size(), 60)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from django.test import TestCase
+from app.classes.s3_block_cache import S3BlockCache
+from app.utils import s3_utils
+from app.utils.http_range import parse_range_header
+from app.tests.utils import start_s3_test_server
+
+
+class TestS3BlockCache(TestCase):
+    def setUp(self):
+        self.s3_root = tempfile.mkdtemp()
+        self.cache_root = tempfile.mkdtemp()
+        self.bucket = 'test'
+        self.key = 'project/task/assets/data.bin'
+        self.data = os.urandom(10000)
+
+        os.makedirs(os.path.join(self.s3_root, self.bucket, os.path.dirname(self.key)))
+        with open(os.path.join(self.s3_root, self.bucket, self.key), 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        s3_utils.reset_s3_sessions()
+        shutil.rmtree(self.s3_root, ignore_errors=True)
+        shutil.rmtree(self.cache_root, ignore_errors=True)
+
+    def _blocks(self, cache):
+        return sorted(entry.file for entry in cache._scan())
+
+    def test_read_range(self):
+        cache = S3BlockCache(self.cache_root, 1024, 1024 * 1024)
+
+        with start_s3_test_server(self.s3_root):
+            etag = s3_utils.get_s3_object_metadata(self.key, self.bucket)['ETag']
+
+            data = b''.join(cache.read_range(self.bucket, self.key, etag, len(self.data), 1500, 3100))
+            self.assertEqual(data, self.data[1500:3101])
+
+            # Only the blocks touched by the range are stored
+            self.assertEqual(len(self._blocks(cache)), 3)
+
+            # The proxy answers single and multiple ranges from the blocks
+            url = cache.reader_path(self.bucket, self.key, etag, len(self.data))[len('/vsicurl/'):]
+            request = urllib.request.Request(url, headers={'Range': 'bytes=1024-2047'})
+            with urllib.request.urlopen(request) as response:
+                self.assertEqual(response.status, 206)
+                self.assertEqual(response.read(), self.data[1024:2048])
+
+            request = urllib.request.Request(url, headers={'Range': 'bytes=0-9,9990-'})
+            with urllib.request.urlopen(request) as response:
+                body = response.read()
+                self.assertTrue(response.headers['Content-Type'].startswith('multipart/byteranges'))
+                self.assertIn(self.data[0:10], body)
+                self.assertIn(self.data[9990:], body)
+
+            # Paths without the token of the process are not served
+            port = url.split('/')[2]
+            path = url.split('/', 4)[4]
+            for other_url in ['http://{}/{}'.format(port, path), 'http://{}/wrong/{}'.format(port, path)]:
+                with self.assertRaises(urllib.error.HTTPError) as e:
+                    urllib.request.urlopen(other_url)
+                self.assertEqual(e.exception.code, 404)
+
+        # Cached blocks are served without S3
+        data = b''.join(cache.read_range(self.bucket, self.key, etag, len(self.data), 1024, 3071))
+        self.assertEqual(data, self.data[1024:3072])
+
+    def test_evict(self):
+        cache = S3BlockCache(self.cache_root, 1024, 1024 * 1024)
+
+        with start_s3_test_server(self.s3_root):
+            etag = s3_utils.get_s3_object_metadata(self.key, self.bucket)['ETag']
+            b''.join(cache.read_range(self.bucket, self.key, etag, len(self.data), 0, len(self.data) - 1))
+
+        self.assertEqual(len(self._blocks(cache)), 10)
+        self.assertEqual(cache.evict(), 0)
+
+        # Evicts down to the low-water mark, in whole blocks
+        cache.max_size = 4096
+        self.assertEqual(cache.evict(), 7 * 1024)
+        self.assertEqual(len(self._blocks(cache)), 3)
+        self.assertEqual(cache.evict(), 0)
+
+    def test_evict_on_insert(self):
+        cache = S3BlockCache(self.cache_root, 1024, 4096)
+
+        with start_s3_test_server(self.s3_root):
+            etag = s3_utils.get_s3_object_metadata(self.key, self.bucket)['ETag']
+
+            b''.join(cache.read_range(self.bucket, self.key, etag, len(self.data), 0, len(self.data) - 1))
+
+        # Evicted by the evictor thread, without the periodic eviction
+        for _ in range(50):
+            if sum(entry.size for entry in cache._scan()) <= 4096:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(len(self._blocks(cache)), 3)
+        self.assertEqual(cache.evict(), 0)
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), [(0, 99)])
+        self.assertEqual(parse_range_header('bytes=900-', 1000), [(900, 999)])
+        self.assertEqual(parse_range_header('bytes=-100', 1000), [(900, 999)])
+        self.assertEqual(parse_range_header('bytes=0-1,5-9', 1000), [(0, 1), (5, 9)])
+        self.assertEqual(parse_range_header('bytes=990-2000', 1000), [(990, 999)])
+        self.assertEqual(parse_range_header('bytes=1000-', 1000), [])
+        self.assertIsNone(parse_range_header(None, 1000))
+        self.assertIsNone(parse_range_header('bytes=5-1', 1000))
+        self.assertIsNone(parse_range_header('items=0-1', 1000))
+
+        # Overlapping and adjacent ranges are merged, in order
+        self.assertEqual(parse_range_header('bytes=500-599,0-9,10-19,550-649', 1000), [(0, 19), (500, 649)])
+
+        # Too many ranges, or more bytes than the content, get the whole content
+        self.assertIsNone(parse_range_header('bytes=' + ','.join(['0-0'] * 17), 1000))
+        self.assertIsNone(parse_range_header('bytes=0-,0-', 1000))
+        self.assertIsNone(parse_range_header('bytes=0-599,400-999', 1000))
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import types
+import uuid
+from unittest import mock
+from django.test import TestCase
+from webodm import settings
+from app.classes import s3_manifest as manifest_module
+from app.classes.s3_manifest import S3Manifest
+from app.utils import s3_utils
+from app.tests.utils import start_s3_test_server
+
+
+class TestS3Manifest(TestCase):
+    def setUp(self):
+        self.s3_root = tempfile.mkdtemp()
+        task_id = uuid.uuid4()
+        self.task = types.SimpleNamespace(
+            id=task_id, task_path=lambda: os.path.join(settings.MEDIA_ROOT, 'project', '1', 'task', str(task_id)))
+        self.prefix = 'project/1/task/{}/'.format(task_id)
+
+        # More than a page of list_objects_v2
+        self.keys = ['{}images/{:04d}.jpg'.format(self.prefix, i) for i in range(1001)]
+        self.keys.append(self.prefix + 'assets/odm_orthophoto/odm_orthophoto.tif')
+        # Another task with the same prefix
+        self.keys.append('project/1/task/{}0/images/0000.jpg'.format(task_id))
+
+        for key in self.keys:
+            path = os.path.join(self.s3_root, 'test', key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x' * (len(key) % 7 + 1))
+
+    def tearDown(self):
+        s3_utils.reset_s3_sessions()
+        shutil.rmtree(self.s3_root, ignore_errors=True)
+        client = manifest_module._get_redis_client()
+        client.delete(manifest_module.MANIFEST_KEY.format(self.task.id),
+                      manifest_module.VERSION_KEY.format(self.task.id))
+
+    def test_objects(self):
+        with start_s3_test_server(self.s3_root, S3_BUCKET='test'):
+            manifest = S3Manifest(3600)
+            task_keys = [key for key in self.keys if key.startswith(self.prefix)]
+
+            # All the pages of the listing
+            self.assertEqual([obj['Key'] for obj in s3_utils.iter_s3_objects(self.prefix, bucket='test')],
+                             sorted(task_keys))
+
+            objects = manifest.objects(self.task)
+            self.assertEqual([obj['Key'] for obj in objects], sorted(task_keys))
+            self.assertEqual(objects[0]['Size'], len(objects[0]['Key']) % 7 + 1)
+            self.assertIsNotNone(objects[0]['ETag'])
+            self.assertIsNone(objects[0]['Checksum'])
+
+            # Served by the manifest
+            os.remove(os.path.join(self.s3_root, 'test', task_keys[0]))
+            self.assertEqual(manifest.objects(self.task), objects)
+            self.assertEqual([obj['Key'] for obj in manifest.objects(self.task, self.prefix + 'assets')],
+                             [self.prefix + 'assets/odm_orthophoto/odm_orthophoto.tif'])
+
+            # Uploads update it
+            uploaded = {'Key': self.prefix + 'assets/all.zip', 'Size': 10, 'ETag': '"etag"', 'Checksum': 'checksum'}
+            manifest.update(self.task.id, [uploaded])
+            self.assertIn(uploaded, manifest.objects(self.task))
+
+            # until it is invalidated
+            manifest.invalidate(self.task.id)
+            self.assertEqual([obj['Key'] for obj in manifest.objects(self.task)], sorted(task_keys[1:]))
+
+            # Updates do not create partial manifests
+            manifest.invalidate(self.task.id)
+            manifest.update(self.task.id, [uploaded])
+            self.assertEqual(len(manifest.objects(self.task)), len(task_keys) - 1)
+
+            # Disabled, the bucket is listed every time
+            os.remove(os.path.join(self.s3_root, 'test', task_keys[1]))
+            self.assertEqual(len(S3Manifest(0).objects(self.task)), len(task_keys) - 2)
+
+            # Failed listings are errors, not empty listings, and are not stored
+            manifest.invalidate(self.task.id)
+            with mock.patch.object(manifest_module, 'iter_s3_objects', side_effect=IOError('listing failed')):
+                with self.assertRaises(IOError):
+                    manifest.objects(self.task)
+            self.assertEqual(len(manifest.objects(self.task)), len(task_keys) - 2)
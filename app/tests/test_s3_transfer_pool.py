@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from django.test import TestCase
+from app.classes.s3_transfer_pool import S3DownloadPool, S3UploadPool, DOWNLOADED, UPLOADED, SKIPPED, MISSING
+from app.utils import s3_utils
+from app.utils.file_utils import calculate_sha256
+from app.tests.utils import start_s3_test_server
+
+
+class TestS3TransferPool(TestCase):
+    def setUp(self):
+        self.s3_root = tempfile.mkdtemp()
+        self.download_dir = tempfile.mkdtemp()
+        self.bucket = 'test'
+        self.files = {}
+
+        os.makedirs(os.path.join(self.s3_root, self.bucket, 'images'))
+        for i in range(20):
+            key = 'images/{}.jpg'.format(i)
+            # Some of them large enough for ranged downloads
+            self.files[key] = os.urandom(300 * 1024 if i % 5 == 0 else 1000 + i)
+            with open(os.path.join(self.s3_root, self.bucket, key), 'wb') as f:
+                f.write(self.files[key])
+
+        open(os.path.join(self.s3_root, self.bucket, 'images', 'empty.jpg'), 'wb').close()
+
+    def tearDown(self):
+        s3_utils.reset_s3_sessions()
+        shutil.rmtree(self.s3_root, ignore_errors=True)
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+
+    def _objects(self, keys):
+        return [(self.bucket, key, os.path.join(self.download_dir, os.path.basename(key))) for key in keys]
+
+    def _pool(self, client, pool_class=S3DownloadPool, **kwargs):
+        config = TransferConfig(multipart_threshold=100 * 1024, multipart_chunksize=64 * 1024, max_concurrency=4)
+        return pool_class(client, max_workers=4, retry_backoff_seconds=0.01, transfer_config=config, **kwargs)
+
+    def test_download(self):
+        with start_s3_test_server(self.s3_root) as client:
+            keys = sorted(self.files.keys())
+            objects = self._objects(keys + ['images/missing.jpg', 'images/empty.jpg'])
+            progress = []
+
+            results = self._pool(client).download(objects, on_progress=progress.append, progress_interval=0.01)
+
+            self.assertEqual(results, [DOWNLOADED] * len(keys) + [MISSING, MISSING])
+            for key, (_, _, path) in zip(keys, objects):
+                with open(path, 'rb') as f:
+                    self.assertEqual(f.read(), self.files[key])
+
+            self.assertEqual(progress[-1], 1.0)
+            self.assertEqual(progress, sorted(progress))
+
+            # Files that do not need to be downloaded again
+            need_download = lambda s3_object, path: not path.endswith('0.jpg')
+            results = self._pool(client).download(objects[:len(keys)], need_download=need_download)
+            self.assertEqual(results, [SKIPPED if k.endswith('0.jpg') else DOWNLOADED for k in keys])
+
+            # Transient errors are retried
+            head_object = client.head_object
+            failures = []
+
+            def flaky_head_object(**kwargs):
+                if kwargs['Key'] not in failures:
+                    failures.append(kwargs['Key'])
+                    raise ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}},
+                                      'HeadObject')
+                return head_object(**kwargs)
+
+            with mock.patch.object(client, 'head_object', side_effect=flaky_head_object):
+                results = self._pool(client).download(objects[:3])
+                self.assertEqual(results, [DOWNLOADED] * 3)
+
+                # Until the retries are exhausted
+                failures.clear()
+                self.assertRaises(ClientError, self._pool(client, retries=0).download, objects[:3])
+
+    def test_upload(self):
+        with start_s3_test_server(self.s3_root) as client:
+            keys = sorted(self.files.keys())
+            objects = []
+
+            for key in keys:
+                path = os.path.join(self.download_dir, os.path.basename(key))
+                with open(path, 'wb') as f:
+                    f.write(self.files[key])
+                objects.append((self.bucket, 'assets/' + key, path))
+
+            objects.append((self.bucket, 'assets/images/missing.jpg', os.path.join(self.download_dir, 'missing.jpg')))
+            progress = []
+
+            pool = self._pool(client, S3UploadPool)
+            results = pool.upload(objects, on_progress=progress.append, progress_interval=0.01)
+
+            self.assertEqual(results, [UPLOADED] * len(keys) + [MISSING])
+            self.assertEqual(progress[-1], 1.0)
+            for key, (bucket, s3_key, path) in zip(keys, objects):
+                with open(os.path.join(self.s3_root, bucket, s3_key), 'rb') as f:
+                    self.assertEqual(f.read(), self.files[key])
+
+                # Multipart uploads included
+                s3_object = client.head_object(Bucket=bucket, Key=s3_key)
+                self.assertEqual(s3_utils.calculate_object_checksum(s3_object), calculate_sha256(path))
+                self.assertEqual(pool.objects[(bucket, s3_key)]['Checksum'], calculate_sha256(path))
+
+            # Files already uploaded are skipped, changed files uploaded again
+            with open(objects[0][2], 'wb') as f:
+                f.write(os.urandom(len(self.files[keys[0]])))
+            os.remove(os.path.join(self.s3_root, self.bucket, objects[1][1]))
+
+            results = self._pool(client, S3UploadPool).upload(objects[:len(keys)])
+            self.assertEqual(results, [UPLOADED, UPLOADED] + [SKIPPED] * (len(keys) - 2))
+            s3_object = client.head_object(Bucket=self.bucket, Key=objects[0][1])
+            self.assertEqual(s3_utils.calculate_object_checksum(s3_object), calculate_sha256(objects[0][2]))
+
+            # Failed uploads are reported
+            failures = []
+            with mock.patch.object(client, 'put_object', side_effect=ClientError(
+                    {'Error': {'Code': 'AccessDenied'}, 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'PutObject')):
+                self.assertRaises(ClientError, self._pool(client, S3UploadPool).upload,
+                                  [(self.bucket, 'assets/new.jpg', objects[1][2])],
+                                  on_failure=lambda obj, e: failures.append(obj))
+            self.assertEqual(failures, [(self.bucket, 'assets/new.jpg', objects[1][2])])
@@ -0,0 +1,102 @@
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from unittest import mock
+from django.test import TestCase
+from app.classes.s3_zip_stream import S3ZipStream
+from app.utils import s3_utils
+from app.tests.utils import start_s3_test_server
+
+
+class TestS3ZipStream(TestCase):
+    def setUp(self):
+        self.s3_root = tempfile.mkdtemp()
+        self.local_dir = tempfile.mkdtemp()
+        self.bucket = 'test'
+        self.files = {}
+        self.members = []
+
+        os.makedirs(os.path.join(self.s3_root, self.bucket, 'tiles', '1'))
+        for i in range(30):
+            name = 'tiles/1/{}.png'.format(i)
+            # One of them read when its turn comes, not in memory ahead
+            self.files[name] = os.urandom(1500 * 1024 if i == 10 else 1000 + i)
+            with open(os.path.join(self.s3_root, self.bucket, name), 'wb') as f:
+                f.write(self.files[name])
+
+            self.members.append({'n': name, 'bucket': self.bucket, 'key': name,
+                                 'size': len(self.files[name]), 'etag': None})
+
+        self.files['tiles/empty.png'] = b''
+        open(os.path.join(self.s3_root, self.bucket, 'tiles', 'empty.png'), 'wb').close()
+        self.members.append({'n': 'tiles/empty.png', 'bucket': self.bucket, 'key': 'tiles/empty.png',
+                             'size': 0, 'etag': None})
+
+        self.files['data/backup.json'] = b'{"name": "test"}'
+        with open(os.path.join(self.local_dir, 'backup.json'), 'wb') as f:
+            f.write(self.files['data/backup.json'])
+        self.members.insert(5, {'n': 'data/backup.json', 'fs': os.path.join(self.local_dir, 'backup.json')})
+
+    def tearDown(self):
+        s3_utils.reset_s3_sessions()
+        shutil.rmtree(self.s3_root, ignore_errors=True)
+        shutil.rmtree(self.local_dir, ignore_errors=True)
+
+    def _assert_archive(self, data):
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist(), [member['n'] for member in self.members])
+            for name, content in self.files.items():
+                self.assertEqual(zf.read(name), content)
+
+    def test_stream(self):
+        with start_s3_test_server(self.s3_root) as client:
+
+            zip_stream = S3ZipStream(self.members, client, prefetch=4, prefetch_max_size=1024 * 1024,
+                                     chunksize=64 * 1024)
+
+            with mock.patch.object(client, 'get_object', wraps=client.get_object) as get_object:
+                chunks = iter(zip_stream)
+
+                # The first bytes come out while only the first member and the next 4 are requested
+                first_chunk = next(chunks)
+                self.assertTrue(get_object.call_count <= 5)
+
+                self._assert_archive(first_chunk + b''.join(chunks))
+                self.assertEqual(get_object.call_count, 31)
+
+            # Stopped before the end
+            chunks = iter(S3ZipStream(self.members, client, prefetch=4))
+            next(chunks)
+            chunks.close()
+
+    def test_replaced_objects(self):
+        with start_s3_test_server(self.s3_root) as client:
+            # Listed with other ETags (rewritten since), small and large members
+            for member in self.members:
+                if member.get('key') in ['tiles/1/3.png', 'tiles/1/10.png']:
+                    member['etag'] = '"stale"'
+
+            zip_stream = S3ZipStream(self.members, client, prefetch=4, prefetch_max_size=1024 * 1024)
+            self._assert_archive(b''.join(zip_stream))
+
+            # With another size, the archive fails before the member
+            self.members[3]['size'] += 1
+            data = b''
+            with self.assertRaises(IOError):
+                for chunk in S3ZipStream(self.members, client, prefetch=4):
+                    data += chunk
+            self.assertNotIn(b'tiles/1/3.png', data)
+
+    def test_upload(self):
+        with start_s3_test_server(self.s3_root,
+                                  S3_TRANSFER_MULTIPART_THRESHOLD_MB=1,
+                                  S3_TRANSFER_MULTIPART_CHUNKSIZE_MB=1) as client:
+
+            # Written in parts
+            S3ZipStream(self.members, client).upload(self.bucket, 'zips/all.zip')
+
+            with open(os.path.join(self.s3_root, self.bucket, 'zips', 'all.zip'), 'rb') as f:
+                self._assert_archive(f.read())
@@ -0,0 +1,122 @@
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from django.test import TestCase, RequestFactory
+from app.api.tiler import tile_response
+from app.classes.tile_cache import TileCache, get_tile_etag
+
+
+class TestTileCache(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.task_id = uuid.uuid4()
+        self.params = {'tile_type': 'dsm', 'z': 18, 'x': 1, 'y': 2, 'hillshade': '6', 'ext': 'png'}
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_get_set(self):
+        cache = TileCache(self.root, 1024 * 1024, 3600)
+        key = cache.make_key(self.task_id, 'v1', self.params)
+
+        self.assertIsNone(cache.get(self.task_id, key))
+
+        tile = cache.set(self.task_id, key, b'tile data', 'image/png')
+        self.assertEqual(tile.etag, get_tile_etag(b'tile data'))
+
+        cached = cache.get(self.task_id, key)
+        self.assertEqual(cached.content, b'tile data')
+        self.assertEqual(cached.content_type, 'image/png')
+        self.assertEqual(cached.etag, tile.etag)
+
+        # Any change of parameters or raster version is a different tile
+        self.assertNotEqual(key, cache.make_key(self.task_id, 'v2', self.params))
+        self.assertNotEqual(key, cache.make_key(self.task_id, 'v1', {**self.params, 'hillshade': '3'}))
+        self.assertEqual(key, cache.make_key(self.task_id, 'v1', dict(reversed(list(self.params.items())))))
+
+    def test_invalidate(self):
+        cache = TileCache(self.root, 1024 * 1024, 3600)
+        key = cache.make_key(self.task_id, 'v1', self.params)
+        cache.set(self.task_id, key, b'tile data', 'image/png')
+
+        cache.invalidate(self.task_id)
+
+        self.assertIsNone(cache.get(self.task_id, key))
+        self.assertNotEqual(key, cache.make_key(self.task_id, 'v1', self.params))
+
+    def test_ttl(self):
+        cache = TileCache(self.root, 1024 * 1024, 60)
+        key = cache.make_key(self.task_id, 'v1', self.params)
+        cache.set(self.task_id, key, b'tile data', 'image/png')
+
+        path = cache._tile_path(self.task_id, key)
+        os.utime(path, (time.time(), time.time() - 120))
+
+        self.assertIsNone(cache.get(self.task_id, key))
+        self.assertFalse(os.path.exists(path))
+
+    def test_evict(self):
+        cache = TileCache(self.root, 10 * 1024, 3600)
+        keys = []
+
+        for i in range(20):
+            key = cache.make_key(self.task_id, 'v1', {**self.params, 'x': i})
+            cache.set(self.task_id, key, os.urandom(1024), 'image/png')
+            path = cache._tile_path(self.task_id, key)
+            os.utime(path, (1000 + i, time.time()))
+            keys.append(key)
+
+        self.assertGreater(cache.evict(), 0)
+
+        # The least recently read tiles are evicted down to the low-water mark
+        remaining = [key for key in keys if os.path.exists(cache._tile_path(self.task_id, key))]
+        self.assertEqual(remaining, keys[-len(remaining):])
+        self.assertLessEqual(sum(e.size for e in cache._scan()), 10 * 1024 * 0.9)
+
+    def test_tile_response(self):
+        cache = TileCache(self.root, 1024 * 1024, 3600)
+        key = cache.make_key(self.task_id, 'v1', self.params)
+        tile = cache.set(self.task_id, key, b'tile data', 'image/png')
+
+        res = tile_response(RequestFactory().get('/'), tile, cache_status='HIT')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, b'tile data')
+        self.assertEqual(res['ETag'], tile.etag)
+        self.assertEqual(res['X-Tile-Cache'], 'HIT')
+
+        res = tile_response(RequestFactory().get('/', HTTP_IF_NONE_MATCH=tile.etag), tile)
+        self.assertEqual(res.status_code, 304)
+
+    def test_lock(self):
+        cache = TileCache(self.root, 1024 * 1024, 3600)
+        key = cache.make_key(self.task_id, 'v1', {**self.params, 'metatile': 4})
+
+        # Only one request renders a metatile
+        token = cache.lock(key, 10)
+        self.assertIsNotNone(token)
+        self.assertIsNone(cache.lock(key, 10))
+
+        start = time.monotonic()
+        cache.wait_unlock(key, 0.2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+        cache.unlock(key, token)
+
+        start = time.monotonic()
+        cache.wait_unlock(key, 10)
+        self.assertLess(time.monotonic() - start, 1)
+
+        # A render that outlived its lock does not release the next claim
+        token = cache.lock(key, 1)
+        time.sleep(1.1)
+        other_token = cache.lock(key, 10)
+        self.assertIsNotNone(other_token)
+        cache.unlock(key, token)
+        self.assertIsNone(cache.lock(key, 10))
+        cache.unlock(key, other_token)
+
+        token = cache.lock(key, 10)
+        self.assertIsNotNone(token)
+        cache.unlock(key, token)
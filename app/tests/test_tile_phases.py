@@ -0,0 +1,58 @@
+from django.test import TestCase
+from rest_framework import exceptions
+from app.api.tiler import parse_tile_params
+from app.classes.tile_phases import record_tile_phases, tile_phase
+
+
+class TestTilePhases(TestCase):
+    def test_record(self):
+        with tile_phase('read'):
+            pass
+
+        with record_tile_phases() as samples:
+            with tile_phase('read'):
+                pass
+            with tile_phase('read'):
+                with tile_phase('encode'):
+                    pass
+
+            try:
+                with tile_phase('hillshade'):
+                    raise ValueError()
+            except ValueError:
+                pass
+
+        # Only the phases within the block, including the failed ones
+        self.assertEqual(sorted(samples.keys()), ['encode', 'hillshade', 'read'])
+        self.assertEqual(len(samples['read']), 2)
+        self.assertTrue(samples['read'][1] >= samples['encode'][0])
+
+        with tile_phase('read'):
+            pass
+        self.assertEqual(len(samples['read']), 2)
+
+    def test_parse_tile_params(self):
+        z, params = parse_tile_params({}, 'dsm', 18)
+        self.assertEqual(z, 18)
+        self.assertEqual(params, {
+            'expr': None,
+            'rescale': '0,1000',
+            'color_map': 'gray',
+            'hillshade': None,
+            'tilesize': 256,
+            'nodata': None,
+            'boundaries_feature': None,
+        })
+
+        z, params = parse_tile_params({'size': '512', 'hillshade': '6', 'color_map': 'viridis'}, 'dtm', 18, 2)
+        self.assertEqual(z, 17)
+        self.assertEqual(params['tilesize'], 1024)
+        self.assertEqual(params['hillshade'], '6')
+        self.assertEqual(params['color_map'], 'viridis')
+
+        z, params = parse_tile_params({'formula': 'NDVI', 'bands': 'RGN'}, 'orthophoto', 18)
+        self.assertIsNotNone(params['expr'])
+        self.assertEqual(params['color_map'], 'gray')
+
+        self.assertRaises(exceptions.ValidationError, parse_tile_params, {'size': '300'}, 'dsm', 18)
+        self.assertRaises(exceptions.ValidationError, parse_tile_params, {'boundaries': '{'}, 'dsm', 18)
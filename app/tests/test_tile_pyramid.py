@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from django.test import TestCase
+from app.classes.tile_pyramid import (
+    get_pyramid_params,
+    get_pyramid_tile,
+    get_tile_format,
+    matches_pyramid_params,
+    write_tile_pyramid,
+)
+
+
+class TestTilePyramid(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_write_read(self):
+        path = os.path.join(self.tmp_dir, 'pyramids', 'dsm.mbtiles')
+        tiles = [(z, x, y, '{}/{}/{}'.format(z, x, y).encode()) for z in range(3) for x in range(2 ** z) for y in range(2 ** z)]
+
+        self.assertEqual(write_tile_pyramid(path, iter(tiles), {'name': 'dsm', 'minzoom': '0'}), len(tiles))
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+        for z, x, y, content in tiles:
+            self.assertEqual(get_pyramid_tile(path, z, x, y), content)
+
+        self.assertIsNone(get_pyramid_tile(path, 5, 0, 0))
+        self.assertIsNone(get_pyramid_tile(os.path.join(self.tmp_dir, 'missing.mbtiles'), 0, 0, 0))
+
+        # A new archive is read after it replaces the previous one
+        write_tile_pyramid(path, iter([(0, 0, 0, b'new')]), {})
+        os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1000))
+        self.assertEqual(get_pyramid_tile(path, 0, 0, 0), b'new')
+
+    def test_params(self):
+        info = {'statistics': {'1': {'min': 10.5, 'max': 120}, '2': {'min': 0, 'max': 255}}}
+
+        params = get_pyramid_params(info, 'orthophoto')
+        self.assertEqual(params['rescale'], [0, 255])
+        self.assertTrue(matches_pyramid_params(params, '0,255', None, None, 512))
+        self.assertFalse(matches_pyramid_params(params, '0,255', None, None, 256))
+        self.assertFalse(matches_pyramid_params(params, '0,200', None, None, 512))
+
+        params = get_pyramid_params({'statistics': {'1': {'min': 10.5, 'max': 120}}}, 'dsm')
+        self.assertTrue(matches_pyramid_params(params, '10.5,120', 'viridis', '6', 512))
+        self.assertFalse(matches_pyramid_params(params, '10.5,120', 'jet', '6', 512))
+        self.assertFalse(matches_pyramid_params(params, '10.5,120', 'viridis', None, 512))
+        self.assertFalse(matches_pyramid_params(params, 'invalid', 'viridis', '6', 512))
+
+    def test_tile_format(self):
+        self.assertEqual(get_tile_format(b'\x89PNG\r\n'), 'png')
+        self.assertEqual(get_tile_format(b'\xff\xd8\xff'), 'jpg')
+        self.assertEqual(get_tile_format(b'RIFF\x00\x00\x00\x00WEBPVP8'), 'webp')
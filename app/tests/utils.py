@@ -35,6 +35,33 @@ def start_simple_auth_server(args = []):
     s.terminate()
     time.sleep(1)  # Wait for the server to stop
 
+@contextmanager
+def start_simple_s3_server(root_dir, port=9100, latency_ms=0):
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    s = subprocess.Popen(['python', 'simple_s3_server.py', str(port), root_dir, str(latency_ms)], shell=False,
+                                cwd=os.path.join(current_dir, "scripts"))
+    time.sleep(2)  # Wait for the server to launch
+    yield "http://localhost:{}".format(port)
+    s.terminate()
+    time.sleep(1)  # Wait for the server to stop
+
+@contextmanager
+def start_s3_test_server(root_dir, **settings_overrides):
+    """Start the simple S3 server on root_dir, with the S3 settings (and the other
+    settings given) pointing to it, and yield an S3 client of it."""
+    from app.utils import s3_utils
+
+    with start_simple_s3_server(root_dir) as endpoint, \
+         mock.patch.multiple(settings,
+                             S3_DOWNLOAD_ENDPOINT=endpoint,
+                             S3_DOWNLOAD_ACCESS_KEY='test',
+                             S3_DOWNLOAD_SECRET_KEY='test',
+                             **settings_overrides):
+        s3_utils.reset_s3_sessions()
+        yield s3_utils.get_s3_client()
+
+    s3_utils.reset_s3_sessions()
+
 # We need to clear previous media_root content
 # This points to the test directory, but just in case
 # we double check that the directory is indeed a test directory
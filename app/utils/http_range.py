@@ -0,0 +1,109 @@
+import re
+import uuid
+
+CRLF = "\r\n"
+
+_range_spec = re.compile(r"^\s*(\d*)\s*-\s*(\d*)\s*$")
+
+# Ranges answered in one response, requests with more get the whole content
+MAX_RANGES = 16
+
+
+def parse_range_header(range_header: str, size: int):
+    """
+    Byte ranges (first, last inclusive) requested by an HTTP Range header
+    for content of the given size.
+
+    Overlapping and adjacent ranges are merged, in ascending order. Returns
+    None when the header is missing or malformed, or asks for more than
+    MAX_RANGES ranges or more bytes than the content has (RFC 7233 6.1), in
+    which case the whole content should be sent, and an empty list when none
+    of the ranges can be satisfied.
+    """
+    if not range_header or not range_header.strip().startswith("bytes="):
+        return None
+
+    specs = range_header.strip()[len("bytes=") :].split(",")
+
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges = []
+
+    for spec in specs:
+        match = _range_spec.match(spec)
+
+        if not match or (match.group(1) == "" and match.group(2) == ""):
+            return None
+
+        first, last = match.group(1), match.group(2)
+
+        if first == "":
+            # Suffix range, the last N bytes
+            length = int(last)
+
+            if length == 0:
+                continue
+
+            ranges.append((max(0, size - length), size - 1))
+            continue
+
+        first = int(first)
+
+        if last != "" and int(last) < first:
+            return None
+
+        if first >= size:
+            continue
+
+        ranges.append((first, size - 1 if last == "" else min(int(last), size - 1)))
+
+    if sum(last - first + 1 for first, last in ranges) > size:
+        return None
+
+    merged = []
+
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+
+    return merged
+
+
+def format_content_range(first: int, last: int, size: int):
+    return f"bytes {first}-{last}/{size}"
+
+
+def multipart_byteranges(ranges, size: int, content_type: str, read_range):
+    """
+    Body of a multipart/byteranges response. read_range(first, last) must
+    yield the bytes of one range.
+
+    Returns the response content type, its length and an iterator over it.
+    """
+    boundary = uuid.uuid4().hex
+    part_headers = [
+        (
+            f"{'' if i == 0 else CRLF}--{boundary}{CRLF}"
+            f"Content-Type: {content_type}{CRLF}"
+            f"Content-Range: {format_content_range(first, last, size)}{CRLF}{CRLF}"
+        ).encode()
+        for i, (first, last) in enumerate(ranges)
+    ]
+    closing = f"{CRLF}--{boundary}--{CRLF}".encode()
+    length = (
+        sum(len(header) for header in part_headers)
+        + sum(last - first + 1 for first, last in ranges)
+        + len(closing)
+    )
+
+    def body():
+        for header, (first, last) in zip(part_headers, ranges):
+            yield header
+            yield from read_range(first, last)
+
+        yield closing
+
+    return f"multipart/byteranges; boundary={boundary}", length, body()
@@ -3,6 +3,8 @@ import logging
 import rasterio
 import re
 import os
+import threading
+import time
 import worker.cache_files as worker_cache_files_tasks
 from botocore.config import Config
 from botocore.client import BaseClient
@@ -10,8 +12,10 @@ from webodm import settings
 from contextlib import contextmanager
 from rasterio.errors import RasterioIOError
 from rasterio.session import AWSSession
-from rio_tiler.io import COGReader
 from rest_framework import exceptions
+from app.classes.cog_reader_cache import cog_reader_cache
+from app.classes.s3_block_cache import s3_block_cache
+from worker.utils.redis_file_cache import record_file_access
 from app.utils.file_utils import (
     remove_path_from_path,
     ensure_sep_at_end,
@@ -19,31 +23,127 @@ from app.utils.file_utils import (
 )
 from django.utils.translation import gettext_lazy as _
 
-
 logger = logging.getLogger("app.logger")
 
 
+_s3_sessions_lock = threading.Lock()
+_s3_client = None
+_rasterio_aws_session = None
+_s3_sessions_pid = None
+_s3_object_versions = {}
+
+
 def get_s3_client():
     endpoint_url = settings.S3_DOWNLOAD_ENDPOINT
     access_key = settings.S3_DOWNLOAD_ACCESS_KEY
     secret_key = settings.S3_DOWNLOAD_SECRET_KEY
-    timeout = settings.S3_TIMEOUT
 
     if not endpoint_url or not access_key or not secret_key:
         return None
 
+    global _s3_client
+
+    with _s3_sessions_lock:
+        _reset_s3_sessions_after_fork()
+
+        if _s3_client is None:
+            _s3_client = _create_s3_client(endpoint_url, access_key, secret_key)
+
+        return _s3_client
+
+
+def reset_s3_sessions():
+    global _s3_client, _rasterio_aws_session
+
+    with _s3_sessions_lock:
+        _s3_client = None
+        _rasterio_aws_session = None
+
+
+def _create_s3_client(endpoint_url: str, access_key: str, secret_key: str):
+    timeout = settings.S3_TIMEOUT
+    config_options = {
+        "signature_version": "s3v4",
+        "connect_timeout": timeout,
+        "read_timeout": timeout,
+        "max_pool_connections": settings.S3_MAX_POOL_CONNECTIONS,
+    }
+
+    # tcp_keepalive is only known by newer botocore releases
+    if "tcp_keepalive" in Config.OPTION_DEFAULTS:
+        config_options["tcp_keepalive"] = settings.S3_TCP_KEEPALIVE
+
     return boto3.client(
         "s3",
         endpoint_url=endpoint_url,
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_key,
-        config=Config(
-            signature_version="s3v4", connect_timeout=timeout, read_timeout=timeout
-        ),
+        config=Config(**config_options),
     )
 
 
-def get_s3_object(key: str, bucket=settings.S3_BUCKET, s3_client=None):
+def _get_rasterio_aws_session(endpoint_url: str, access_key: str, secret_key: str):
+    global _rasterio_aws_session
+
+    with _s3_sessions_lock:
+        _reset_s3_sessions_after_fork()
+
+        if _rasterio_aws_session is None:
+            # Set AWS credentials
+            boto3_session = boto3.Session(
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+
+            # Create a rasterio AWSSession with the boto3 session and your MinIO endpoint
+            _rasterio_aws_session = AWSSession(
+                boto3_session,
+                endpoint_url=endpoint_url,
+                region_name="us-east-1",  # Adjust if needed
+                profile_name=None,
+            )
+
+        return _rasterio_aws_session
+
+
+def _get_rasterio_env_options(endpoint_url: str):
+    options = {
+        "AWS_VIRTUAL_HOSTING": False,  # Important for MinIO
+        "AWS_S3_ENDPOINT": endpoint_url,
+        "SSL": False,
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+        "GDAL_HTTP_MULTIPLEX": "YES",
+        "GDAL_HTTP_TCP_KEEPALIVE": "YES" if settings.S3_TCP_KEEPALIVE else "NO",
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": settings.S3_GDAL_VSI_CACHE_SIZE_MB * 1024 * 1024,
+    }
+
+    if settings.S3_DOWNLOAD_ENDPOINT.startswith("http://"):
+        options["AWS_HTTPS"] = "NO"
+
+    return options
+
+
+def _reset_s3_sessions_after_fork():
+    global _s3_client, _rasterio_aws_session, _s3_sessions_pid
+
+    # Connection pools must not be shared between forked workers
+    current_pid = os.getpid()
+
+    if _s3_sessions_pid != current_pid:
+        _s3_client = None
+        _rasterio_aws_session = None
+        _s3_sessions_pid = current_pid
+
+
+def get_s3_object(
+    key: str,
+    bucket=settings.S3_BUCKET,
+    s3_client=None,
+    byte_range: str = None,
+    if_match: str = None,
+):
     try:
         if not bucket:
             logger.error(
@@ -56,7 +156,15 @@ def get_s3_object(key: str, bucket=settings.S3_BUCKET, s3_client=None):
         if not valid_s3_client:
             return None
 
-        s3_object = valid_s3_client.get_object(Bucket=bucket, Key=key)
+        options = {}
+
+        if byte_range:
+            options["Range"] = byte_range
+
+        if if_match:
+            options["IfMatch"] = if_match
+
+        s3_object = valid_s3_client.get_object(Bucket=bucket, Key=key, **options)
         s3_object_exists = "DeleteMarker" not in s3_object
 
         if s3_object_exists:
@@ -67,28 +175,27 @@ def get_s3_object(key: str, bucket=settings.S3_BUCKET, s3_client=None):
     return None
 
 
-def list_s3_objects(key_to_contains: str, s3_client=None, bucket=settings.S3_BUCKET):
-    try:
-        if not bucket:
-            logger.error(
-                "Could not list any object from s3, because is missing some s3 configuration variable"
-            )
-            return []
-
-        valid_s3_client = _get_valid_s3_client(s3_client)
+def iter_s3_objects(prefix: str, s3_client=None, bucket=settings.S3_BUCKET):
+    """
+    Objects of the bucket with keys starting with prefix, yielded page by
+    page (list_objects_v2 returns up to 1000 keys per request). Errors of the
+    requests are raised, a listing is never silently truncated.
+    """
+    if not bucket:
+        logger.error(
+            "Could not list any object from s3, because is missing some s3 configuration variable"
+        )
+        return
 
-        if not valid_s3_client:
-            return None
+    valid_s3_client = _get_valid_s3_client(s3_client)
 
-        response = valid_s3_client.list_objects_v2(
-            Bucket=bucket, Prefix=key_to_contains
-        )
+    if not valid_s3_client:
+        return
 
-        return response["Contents"] if response else []
-    except Exception as e:
-        logger.error(str(e))
+    paginator = valid_s3_client.get_paginator("list_objects_v2")
 
-    return []
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
 
 
 @contextmanager
@@ -106,10 +213,12 @@ def open_cog_reader(url: str):
 
     local_path = os.path.join(settings.MEDIA_ROOT, remove_s3_bucket_prefix(url))
     if os.path.isfile(local_path):
-        with COGReader(local_path) as source:
+        with cog_reader_cache.reader(
+            local_path, str(os.stat(local_path).st_mtime_ns)
+        ) as source:
             yield source
 
-        worker_cache_files_tasks.refresh_file_in_cache.delay(url)
+        record_file_access(local_path)
 
         return
 
@@ -123,27 +232,29 @@ def open_cog_reader(url: str):
         raise exceptions.NotFound(_("Unable to read the data from S3"))
 
     try:
-        # Set AWS credentials
-        boto3_session = boto3.Session(
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-        )
+        if s3_block_cache.enabled:
+            etag, size = _get_s3_object_version_and_size(url)
 
-        # Create a rasterio AWSSession with the boto3 session and your MinIO endpoint
-        aws_session = AWSSession(
-            boto3_session,
-            endpoint_url=endpoint_url,
-            region_name="us-east-1",  # Adjust if needed
-            profile_name=None,
-        )
+            if not etag:
+                raise exceptions.NotFound(_("Unable to read the data from S3"))
+
+            bucket, key = split_s3_bucket_prefix(url)
+
+            # Only the byte ranges read are fetched and cached, no whole file download
+            with rasterio.Env(**_get_block_cache_env_options()):
+                with cog_reader_cache.reader(
+                    s3_block_cache.reader_path(bucket, key, etag, size), etag
+                ) as source:
+                    yield source
+
+            return
+
+        aws_session = _get_rasterio_aws_session(endpoint_url, access_key, secret_key)
 
         with rasterio.Env(
-            session=aws_session,
-            AWS_VIRTUAL_HOSTING=False,  # Important for MinIO
-            AWS_S3_ENDPOINT=endpoint_url,
-            SSL=False,
+            session=aws_session, **_get_rasterio_env_options(endpoint_url)
         ):
-            with COGReader(url) as source:
+            with cog_reader_cache.reader(url, _get_s3_object_version(url)) as source:
                 yield source
 
         worker_cache_files_tasks.download_and_add_to_cache.delay(url)
@@ -157,6 +268,63 @@ def open_cog_reader(url: str):
         raise e
 
 
+def get_cog_version(url: str):
+    """
+    Version of a raster opened with open_cog_reader (file mtime and size, or
+    S3 ETag), without opening it. None when it cannot be found.
+    """
+    local_path = os.path.join(settings.MEDIA_ROOT, remove_s3_bucket_prefix(url))
+
+    try:
+        stat = os.stat(local_path)
+        return f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+    except OSError:
+        pass
+
+    if not has_s3_prefix(url) or not get_s3_client():
+        return None
+
+    return _get_s3_object_version(url)
+
+
+def _get_s3_object_version(url: str):
+    return _get_s3_object_version_and_size(url)[0]
+
+
+def _get_s3_object_version_and_size(url: str):
+    now = time.monotonic()
+    cached = _s3_object_versions.get(url)
+
+    if cached and cached[2] > now:
+        return cached[0], cached[1]
+
+    bucket, key = split_s3_bucket_prefix(url)
+    s3_object = get_s3_object_metadata(key, bucket)
+    etag = s3_object.get("ETag") if s3_object else None
+    size = s3_object.get("ContentLength") if s3_object else None
+
+    if etag:
+        if len(_s3_object_versions) > 1024:
+            _s3_object_versions.clear()
+
+        _s3_object_versions[url] = (
+            etag,
+            size,
+            now + settings.COG_READER_CACHE_VERSION_TTL_SECONDS,
+        )
+
+    return etag, size
+
+
+def _get_block_cache_env_options():
+    return {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES",
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": settings.S3_GDAL_VSI_CACHE_SIZE_MB * 1024 * 1024,
+    }
+
+
 def sanitize_s3_endpoint(s3_endpoint: str):
     without_last_slash = s3_endpoint[0:-1] if s3_endpoint[-1] == "/" else s3_endpoint
     return re.sub(r"(http|https)://", "", without_last_slash)
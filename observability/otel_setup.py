@@ -1,10 +1,13 @@
 import logging
 
-from opentelemetry import trace
+from opentelemetry import metrics, trace
 from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+from opentelemetry.sdk.metrics import MeterProvider
+from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
 from opentelemetry.instrumentation.django import DjangoInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 from opentelemetry.instrumentation.psycopg2 import Psycopg2Instrumentor
@@ -25,6 +28,7 @@ def setup_otel():
     logger.info("Starting Open Telemetry observers...")
 
     _setup_trace_provider("webapp")
+    _setup_meter_provider("webapp")
     _add_django_base_instrumentors()
     _setup_logs_provider("webapp")
 
@@ -37,6 +41,7 @@ def setup_otel_celery():
     logger.info("Starting Open Telemetry celery observers...")
 
     _setup_trace_provider("worker")
+    _setup_meter_provider("worker")
     CeleryInstrumentor().instrument()
     _add_django_base_instrumentors()
     _setup_logs_provider("worker")
@@ -91,6 +96,21 @@ def _setup_trace_provider(service_name: str):
     tracer_provider.add_span_processor(span_processor)
 
 
+def _setup_meter_provider(service_name: str):
+    resource = Resource.create(
+        attributes={
+            "service.name": service_name,
+        }
+    )
+
+    reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(endpoint=f"{settings.OTEL_ENDPOINT}/v1/metrics")
+    )
+    metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=[reader])
+    )
+
+
 def _need_add_otel():
     return settings.OTEL_ENABLED and not settings.MIGRATING and not settings.FLUSHING
 
@@ -469,10 +469,135 @@ S3_DOWNLOAD_ACCESS_KEY = os.environ.get("WO_S3_DOWNLOAD_ACCESS_KEY", None)
 S3_DOWNLOAD_SECRET_KEY = os.environ.get("WO_S3_DOWNLOAD_SECRET_KEY", None)
 S3_BUCKET = os.environ.get("WO_S3_BUCKET", None)
 S3_TIMEOUT = 360
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get("WO_S3_MAX_POOL_CONNECTIONS", "50"))
+S3_TCP_KEEPALIVE = os.environ.get("WO_S3_TCP_KEEPALIVE", "YES") == "YES"
+S3_GDAL_VSI_CACHE_SIZE_MB = int(os.environ.get("WO_S3_GDAL_VSI_CACHE_SIZE_MB", "25"))
+# Transfers of S3 objects: images checked and downloaded at the same time by S3
+# imports, assets uploaded at the same time, concurrent requests of the
+# transfers (the parts of multipart transfers included) and retries of the
+# failed transfers
+S3_IMPORT_MAX_WORKERS = int(os.environ.get("WO_S3_IMPORT_MAX_WORKERS", "16"))
+S3_UPLOAD_MAX_WORKERS = int(os.environ.get("WO_S3_UPLOAD_MAX_WORKERS", "8"))
+S3_TRANSFER_MAX_CONCURRENCY = int(os.environ.get("WO_S3_TRANSFER_MAX_CONCURRENCY", "16"))
+S3_TRANSFER_MULTIPART_THRESHOLD_MB = int(
+    os.environ.get("WO_S3_TRANSFER_MULTIPART_THRESHOLD_MB", "16")
+)
+S3_TRANSFER_MULTIPART_CHUNKSIZE_MB = int(
+    os.environ.get("WO_S3_TRANSFER_MULTIPART_CHUNKSIZE_MB", "16")
+)
+S3_TRANSFER_RETRIES = int(os.environ.get("WO_S3_TRANSFER_RETRIES", "3"))
+S3_TRANSFER_RETRY_BACKOFF_SECONDS = float(
+    os.environ.get("WO_S3_TRANSFER_RETRY_BACKOFF_SECONDS", "1")
+)
+# Progress of the S3 transfers, saved to the task at most every
+# S3_PROGRESS_SAVE_SECONDS or once it moved by S3_PROGRESS_SAVE_MIN_PERCENT
+S3_PROGRESS_SAVE_SECONDS = float(os.environ.get("WO_S3_PROGRESS_SAVE_SECONDS", "2"))
+S3_PROGRESS_SAVE_MIN_PERCENT = float(
+    os.environ.get("WO_S3_PROGRESS_SAVE_MIN_PERCENT", "5")
+)
+# Listings of the S3 objects of the tasks are kept in redis for this long (0
+# lists the bucket every time), uploads of the tasks update them
+S3_MANIFEST_TTL_SECONDS = int(os.environ.get("WO_S3_MANIFEST_TTL_SECONDS", "3600"))
+# Zip archives read their S3 members while they are written, requesting the next
+# S3_ZIP_PREFETCH_OBJECTS ahead (the ones up to S3_ZIP_PREFETCH_MAX_SIZE_MB are
+# read in memory ahead). When S3 is configured, archives built by the workers are
+# uploaded under S3_ZIP_UPLOAD_PREFIX instead of MEDIA_TMP, and deleted after 24
+# hours like the files of MEDIA_TMP (empty writes them in MEDIA_TMP)
+S3_ZIP_PREFETCH_OBJECTS = int(os.environ.get("WO_S3_ZIP_PREFETCH_OBJECTS", "8"))
+S3_ZIP_PREFETCH_MAX_SIZE_MB = int(
+    os.environ.get("WO_S3_ZIP_PREFETCH_MAX_SIZE_MB", "4")
+)
+S3_ZIP_UPLOAD_PREFIX = os.environ.get("WO_S3_ZIP_UPLOAD_PREFIX", "tmp/zips/")
 S3_CACHE_MAX_SIZE_MB = int(os.environ.get("WO_S3_CACHE_MAX_SIZE_MB", "0"))
 S3_IMAGES_CACHE_KEYS_REFRESH_SECONDS = int(
     os.environ.get("WO_S3_IMAGES_CACHE_KEYS_REFRESH_SECONDS", "30")
 )
+S3_CACHE_ACCESS_FLUSH_SECONDS = int(
+    os.environ.get("WO_S3_CACHE_ACCESS_FLUSH_SECONDS", "5")
+)
+S3_CACHE_RECONCILE_SECONDS = int(
+    os.environ.get("WO_S3_CACHE_RECONCILE_SECONDS", "600")
+)
+# One of lru, gdsf (size and frequency aware) or pin_hot_cogs (gdsf that keeps
+# frequently read COG rasters)
+S3_CACHE_EVICTION_POLICY = os.environ.get("WO_S3_CACHE_EVICTION_POLICY", "lru")
+S3_CACHE_EVICTION_LOW_WATER_PERCENT = int(
+    os.environ.get("WO_S3_CACHE_EVICTION_LOW_WATER_PERCENT", "90")
+)
+S3_CACHE_EVICTION_SAMPLE_SIZE = int(
+    os.environ.get("WO_S3_CACHE_EVICTION_SAMPLE_SIZE", "1000")
+)
+S3_CACHE_PIN_MIN_HITS = int(os.environ.get("WO_S3_CACHE_PIN_MIN_HITS", "10"))
+S3_CACHE_PIN_MAX_PERCENT = int(os.environ.get("WO_S3_CACHE_PIN_MAX_PERCENT", "50"))
+# Append cache accesses to this file, to replay them with benchmark_cache_eviction
+S3_CACHE_ACCESS_TRACE_FILE = os.environ.get("WO_S3_CACHE_ACCESS_TRACE_FILE", None)
+# Cache of the byte ranges of S3 rasters read by the tiler (0 disables it,
+# and rasters read from S3 are downloaded whole into the file cache instead)
+S3_BLOCK_CACHE_MAX_SIZE_MB = int(os.environ.get("WO_S3_BLOCK_CACHE_MAX_SIZE_MB", "0"))
+S3_BLOCK_CACHE_BLOCK_SIZE_KB = int(
+    os.environ.get("WO_S3_BLOCK_CACHE_BLOCK_SIZE_KB", "512")
+)
+S3_BLOCK_CACHE_DIR = os.environ.get(
+    "WO_S3_BLOCK_CACHE_DIR", os.path.join(MEDIA_ROOT, "CACHE", "s3_blocks")
+)
+S3_BLOCK_CACHE_EVICTION_SECONDS = int(
+    os.environ.get("WO_S3_BLOCK_CACHE_EVICTION_SECONDS", "60")
+)
+COG_READER_CACHE_MAX_OPEN = int(os.environ.get("WO_COG_READER_CACHE_MAX_OPEN", "64"))
+COG_READER_CACHE_IDLE_SECONDS = int(
+    os.environ.get("WO_COG_READER_CACHE_IDLE_SECONDS", "300")
+)
+COG_READER_CACHE_VERSION_TTL_SECONDS = int(
+    os.environ.get("WO_COG_READER_CACHE_VERSION_TTL_SECONDS", "30")
+)
+# Boundary cutlines kept by each process (0 disables the cache)
+CUTLINE_CACHE_MAX_ENTRIES = int(os.environ.get("WO_CUTLINE_CACHE_MAX_ENTRIES", "256"))
+# Cache of rendered tiles (0 disables it). Tiles are also kept in redis, shared
+# by all the webapp instances, when WO_TILE_CACHE_REDIS_TTL_SECONDS is set
+TILE_CACHE_MAX_SIZE_MB = int(os.environ.get("WO_TILE_CACHE_MAX_SIZE_MB", "0"))
+TILE_CACHE_TTL_SECONDS = int(os.environ.get("WO_TILE_CACHE_TTL_SECONDS", "604800"))
+TILE_CACHE_DIR = os.environ.get(
+    "WO_TILE_CACHE_DIR", os.path.join(MEDIA_ROOT, "CACHE", "tiles")
+)
+TILE_CACHE_REDIS_TTL_SECONDS = int(
+    os.environ.get("WO_TILE_CACHE_REDIS_TTL_SECONDS", "0")
+)
+TILE_CACHE_REDIS_MAX_TILE_KB = int(
+    os.environ.get("WO_TILE_CACHE_REDIS_MAX_TILE_KB", "128")
+)
+TILE_CACHE_EVICTION_SECONDS = int(
+    os.environ.get("WO_TILE_CACHE_EVICTION_SECONDS", "300")
+)
+# On a miss of the tile cache, the NxN block of tiles around a tile is rendered
+# with a single read of the raster and stored in the cache (1 disables it)
+TILE_METATILE_SIZE = int(os.environ.get("WO_TILE_METATILE_SIZE", "4"))
+# Tiles of the default map visualizations are rendered to MBTiles archives when
+# tasks complete, up to this zoom level of 512px tiles (0 disables them)
+TILE_PYRAMID_MAX_ZOOM = int(os.environ.get("WO_TILE_PYRAMID_MAX_ZOOM", "0"))
+# Statistics of rasters for formulas, ranges and boundaries are kept this long
+RASTER_STATISTICS_CACHE_TTL_SECONDS = int(
+    os.environ.get("WO_RASTER_STATISTICS_CACHE_TTL_SECONDS", "2592000")
+)
+# Threads processing the windows of a raster export, in each worker process
+EXPORT_RASTER_WORKERS = int(
+    os.environ.get("WO_EXPORT_RASTER_WORKERS", str(min(4, os.cpu_count() or 1)))
+)
+# Identical export requests reuse the export in progress, or its result for
+# this long (0 disables it). Must be shorter than the cleanup of MEDIA_TMP (24h)
+EXPORT_REGISTRY_TTL_SECONDS = int(
+    os.environ.get("WO_EXPORT_REGISTRY_TTL_SECONDS", "43200")
+)
+# Exports not picked up by a worker in this long (lost, or never queued) are
+# started again by identical requests
+EXPORT_REGISTRY_PENDING_TIMEOUT_SECONDS = int(
+    os.environ.get("WO_EXPORT_REGISTRY_PENDING_TIMEOUT_SECONDS", "900")
+)
+# Let nginx send local asset downloads (see the /internal-media location of
+# the nginx config), the application only authorizes them
+DOWNLOADS_X_ACCEL_REDIRECT = (
+    os.environ.get("WO_DOWNLOADS_X_ACCEL_REDIRECT", "NO") == "YES"
+)
+DOWNLOADS_X_ACCEL_PREFIX = "/internal-media/"
 DYNAMODB_SECRET_KEY = os.environ.get("WO_DYNAMODB_SECRET_KEY", None)
 DYNAMODB_ACCESS_KEY = os.environ.get("WO_DYNAMODB_ACCESS_KEY", None)
 DYNAMODB_TABLE = os.environ.get("WO_DYNAMODB_TABLE", None)
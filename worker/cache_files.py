@@ -1,5 +1,6 @@
 import os
 import shutil
+import time
 
 from celery.utils.log import get_task_logger
 from django.db.models import Q
@@ -16,19 +17,32 @@ from app.utils.file_utils import (
 from worker.utils.redis_file_cache import (
     get_max_cache_size,
     get_current_cache_size,
-    get_files_with_old_accessed_first,
+    get_cache_entries,
     update_file_in_cache,
+    update_files_in_cache,
     refresh_cache,
     has_file_in_cache,
     get_files_in_cache,
-    remove_file_from_cache,
+    remove_files_from_cache,
+    reconcile_cache_size,
+    reserve_cache_space,
+    release_cache_space,
     s3_cache_lock,
+    s3_cache_file_lock,
+)
+from worker.utils.cache_eviction import (
+    CacheEntry,
+    evict,
+    get_eviction_policy,
+    get_eviction_target_size,
 )
 from nodeodm import status_codes
 from webodm import settings
 
 logger = get_task_logger("app.logger")
 
+RECONCILE_PAGE_SIZE = 1000
+
 
 @app.task()
 def download_and_add_to_cache(file: str, destiny_path: str = None):
@@ -39,22 +53,20 @@ def download_and_add_to_cache(file: str, destiny_path: str = None):
     )
 
     try:
-        with s3_cache_lock():
-            logger.debug(f"Start to add {file} in cache")
-            s3_path = remove_s3_bucket_prefix(file)
+        logger.debug(f"Start to add {file} in cache")
+        s3_path = remove_s3_bucket_prefix(file)
+        download_path = destiny_path or s3_path
+        filename = get_file_name(download_path)
+        file_dir = os.path.join(settings.MEDIA_ROOT, download_path.replace(filename, ""))
+        filepath = os.path.join(file_dir, filename)
+
+        with s3_cache_file_lock(filepath):
             s3_object = get_s3_object_metadata(s3_path)
 
             if not s3_object:
                 logger.debug(f"Not found {s3_path} aborting download and add to cache")
                 return
 
-            download_path = destiny_path or s3_path
-            filename = get_file_name(download_path)
-            file_dir = os.path.join(
-                settings.MEDIA_ROOT, download_path.replace(filename, "")
-            )
-            filepath = os.path.join(file_dir, filename)
-
             if has_file_in_cache(filepath) and _s3_file_is_equals_to_cache_file(
                 s3_path, filepath
             ):
@@ -63,7 +75,7 @@ def download_and_add_to_cache(file: str, destiny_path: str = None):
 
             file_size = s3_object.get("ContentLength", 0)
 
-            can_add_to_cache = _check_cache_has_space(file_size)
+            can_add_to_cache = _reserve_cache_space(filepath, file_size)
 
             if not can_add_to_cache:
                 logger.debug(
@@ -71,14 +83,18 @@ def download_and_add_to_cache(file: str, destiny_path: str = None):
                 )
                 return
 
-            ensure_path_exists(file_dir)
+            try:
+                ensure_path_exists(file_dir)
 
-            file_already_exists = os.path.isfile(filepath)
+                file_already_exists = os.path.isfile(filepath)
 
-            if not file_already_exists:
-                download_s3_file(s3_path, filepath)
+                if not file_already_exists:
+                    download_s3_file(s3_path, filepath)
 
-            update_file_in_cache(filepath)
+                update_file_in_cache(filepath, file_size)
+            except Exception:
+                release_cache_space(filepath)
+                raise
 
             logger.debug(f"Added {file} to cache with success!")
     except Exception as e:
@@ -96,8 +112,7 @@ def refresh_file_in_cache(file: str):
     filepath = os.path.join(file_dir, filename)
 
     if os.path.exists(filepath):
-        with s3_cache_lock():
-            update_file_in_cache(filepath)
+        update_file_in_cache(filepath)
 
 
 @app.task()
@@ -113,7 +128,7 @@ def move_file_and_add_in_cache(file_s3: str, file_to_move):
         file_stat = os.stat(file_to_move)
         file_size = file_stat.st_size
 
-        can_add_to_cache = _check_cache_has_space(file_size)
+        can_add_to_cache = _reserve_cache_space(filepath, file_size)
 
         if not can_add_to_cache:
             logger.debug(
@@ -121,19 +136,22 @@ def move_file_and_add_in_cache(file_s3: str, file_to_move):
             )
             return
 
-        ensure_path_exists(file_dir)
+        try:
+            ensure_path_exists(file_dir)
 
-        is_source_on_temp = settings.MEDIA_TMP in file_to_move
+            is_source_on_temp = settings.MEDIA_TMP in file_to_move
 
-        if is_source_on_temp:
-            shutil.copy2(file_to_move, filepath)
-        else:
-            shutil.move(file_to_move, filepath)
+            if is_source_on_temp:
+                shutil.copy2(file_to_move, filepath)
+            else:
+                shutil.move(file_to_move, filepath)
 
-        with s3_cache_lock():
-            new_cache = update_file_in_cache(filepath)
+            update_file_in_cache(filepath, file_size)
+        except Exception:
+            release_cache_space(filepath)
+            raise
 
-        logger.debug(f"Added {new_cache} on cache with success!")
+        logger.debug(f"Added {filepath} on cache with success!")
     except Exception as e:
         logger.error(
             f"Error on move {file_s3} and add to cache. Original error: {str(e)}"
@@ -149,62 +167,132 @@ def refresh_file_cache_keys():
     refresh_cache()
 
     try:
-        with s3_cache_lock():
-            completed_tasks = Task.objects.filter(
-                Q(status=status_codes.COMPLETED)
-            ).values_list("pk", flat=True)
-            downloaded_files = get_all_files_in_dir(downloads_root)
-            tasks_by_project: dict[int, list[int]] = {}
-            tasks_downloaded_files = []
-
-            for file in downloaded_files:
-                splited_path = [
-                    entry
-                    for entry in file.replace(downloads_root, "").split(os.sep)
-                    if len(entry) > 0
-                ]
+        completed_tasks = Task.objects.filter(
+            Q(status=status_codes.COMPLETED)
+        ).values_list("pk", flat=True)
+        downloaded_files = get_all_files_in_dir(downloads_root)
+        tasks_by_project: dict[int, list[int]] = {}
+        tasks_downloaded_files = []
+
+        for file in downloaded_files:
+            splited_path = [
+                entry
+                for entry in file.replace(downloads_root, "").split(os.sep)
+                if len(entry) > 0
+            ]
 
-                if len(splited_path) < 2:
-                    continue
+            if len(splited_path) < 2:
+                continue
 
-                project_entry = splited_path[0]
-                task_entry = splited_path[1]
+            project_entry = splited_path[0]
+            task_entry = splited_path[1]
 
-                if (
-                    project_entry in tasks_by_project
-                    and task_entry in tasks_by_project.get(project_entry)
-                ):
-                    tasks_downloaded_files.append(
-                        {"path": file, "project": project_entry, "task": task_entry}
-                    )
+            if (
+                project_entry in tasks_by_project
+                and task_entry in tasks_by_project.get(project_entry)
+            ):
+                tasks_downloaded_files.append(
+                    {"path": file, "project": project_entry, "task": task_entry}
+                )
 
-            files_to_add_cache = [
-                file["path"]
-                for file in tasks_downloaded_files
-                if file["task"] in completed_tasks
-            ]
+        files_to_add_cache = [
+            file["path"]
+            for file in tasks_downloaded_files
+            if file["task"] in completed_tasks
+        ]
 
-            for file_to_add in files_to_add_cache:
-                update_file_in_cache(file_to_add)
+        update_files_in_cache({file: time.time() for file in files_to_add_cache})
 
-            logger.info(
-                f"Found all these files need to be in cache: {str(files_to_add_cache)}"
-            )
+        logger.info(
+            f"Found all these files need to be in cache: {str(files_to_add_cache)}"
+        )
 
-            removeds_from_cache = []
-            for file in get_files_in_cache():
-                if not os.path.exists(file):
-                    remove_file_from_cache(file)
-                    removeds_from_cache.append(file)
+        removeds_from_cache = [
+            file for file in get_files_in_cache() if not os.path.exists(file)
+        ]
+        remove_files_from_cache(removeds_from_cache)
 
-        cache_available_size, max_cache_size = get_cache_sizes()
+        cache_available_size, max_cache_size, _ = get_cache_sizes()
         logger.info(
-            f"\n**Cache available space: {cache_available_size} / {human_readable_size(max_cache_size)}\n"
+            f"\n**Cache available space: {cache_available_size} / {max_cache_size}\n"
         )
     except:
         pass
 
 
+@app.task()
+def reconcile_file_cache_size():
+    """
+    Repair drift between the cache index and the files on disk (files removed
+    or rewritten outside of the cache tasks) and rebuild the running size counter.
+    """
+    missing_files = []
+    resized_files = {}
+    accessed_at_by_file = {}
+    start = 0
+
+    while True:
+        entries = get_cache_entries(start, RECONCILE_PAGE_SIZE)
+
+        if len(entries) == 0:
+            break
+
+        for cache_file, accessed_at, cached_size, _ in entries:
+            try:
+                file_size = os.stat(cache_file).st_size
+            except OSError:
+                missing_files.append(cache_file)
+                continue
+
+            if file_size != cached_size:
+                resized_files[cache_file] = file_size
+                accessed_at_by_file[cache_file] = accessed_at
+
+        start += len(entries)
+
+    remove_files_from_cache(missing_files)
+    update_files_in_cache(accessed_at_by_file, resized_files)
+
+    cache_size, previous_cache_size = reconcile_cache_size()
+
+    if (
+        len(missing_files) > 0
+        or len(resized_files) > 0
+        or cache_size != previous_cache_size
+    ):
+        logger.info(
+            f"Reconciled cache size from {human_readable_size(previous_cache_size)} "
+            f"to {human_readable_size(cache_size)} ({len(missing_files)} missing files, "
+            f"{len(resized_files)} resized files)"
+        )
+
+
+@app.task()
+def evict_s3_block_cache():
+    from app.classes.s3_block_cache import s3_block_cache
+
+    if not s3_block_cache.enabled:
+        return
+
+    freed = s3_block_cache.evict()
+
+    if freed > 0:
+        logger.info(f"Evicted {human_readable_size(freed)} of S3 blocks from cache")
+
+
+@app.task()
+def evict_tile_cache():
+    from app.classes.tile_cache import tile_cache
+
+    if not tile_cache.enabled:
+        return
+
+    freed = tile_cache.evict()
+
+    if freed > 0:
+        logger.info(f"Evicted {human_readable_size(freed)} of tiles from cache")
+
+
 @app.task()
 def seek_and_populate_redis_cache():
     import shutil
@@ -272,14 +360,17 @@ def add_local_file_to_redis_cache(file_path: str):
         file_stat = os.stat(file_path)
         file_size = file_stat.st_size
 
-        can_add_to_cache = _check_cache_has_space(file_size)
+        can_add_to_cache = _reserve_cache_space(file_path, file_size)
 
         if not can_add_to_cache:
             delete_path(file_path)
             return
 
-        with s3_cache_lock():
-            update_file_in_cache(file_path)
+        try:
+            update_file_in_cache(file_path, file_size)
+        except Exception:
+            release_cache_space(file_path)
+            raise
     except Exception as e:
         logger.error(f"Error on set file({file_path}) on redis cache. Error: {str(e)}")
 
@@ -295,40 +386,52 @@ def get_cache_sizes():
     )
 
 
-def _check_cache_has_space(space_need: int):
+def _reserve_cache_space(file: str, space_need: int):
+    """
+    Admit a file in the cache, evicting other files when it is full. Its size
+    is counted from now on (see reserve_cache_space): release_cache_space
+    when it cannot be added after all.
+    """
     max_cache_size = get_max_cache_size()
 
     if max_cache_size < space_need:
         return False
 
-    cache_available_size = max_cache_size - get_current_cache_size()
-
-    if cache_available_size >= space_need:
+    if reserve_cache_space(file, space_need, max_cache_size):
         return True
 
-    files_to_remove = []
+    with s3_cache_lock(timeout=60):
+        # Another worker may have evicted while we waited for the lock
+        if reserve_cache_space(file, space_need, max_cache_size):
+            return True
 
-    for cache_file in get_files_with_old_accessed_first():
-        if not os.path.exists(cache_file):
-            remove_file_from_cache(cache_file)
-            continue
+        bytes_to_free = get_current_cache_size() - get_eviction_target_size(
+            max_cache_size, space_need
+        )
+        freed = evict(
+            get_eviction_policy(max_cache_size=max_cache_size),
+            _load_cache_entries,
+            _remove_cache_entries,
+            bytes_to_free,
+        )
+        logger.info(
+            f"Evicted {human_readable_size(freed)} from cache to add {human_readable_size(space_need)}"
+        )
 
-        file_stat = os.stat(cache_file)
-        cache_available_size += file_stat.st_size
-        files_to_remove.append(cache_file)
+        return reserve_cache_space(file, space_need, max_cache_size)
 
-        if cache_available_size >= space_need:
-            break
 
-    for file_to_remove in files_to_remove:
-        remove_file_from_cache(file_to_remove)
+def _load_cache_entries(start: int, count: int):
+    return [CacheEntry(*entry) for entry in get_cache_entries(start, count)]
 
-        if os.path.exists(file_to_remove):
-            delete_path(file_to_remove)
 
-    cache_available_size = max_cache_size - get_current_cache_size()
+def _remove_cache_entries(entries: list[CacheEntry]):
+    files_to_remove = [entry.file for entry in entries]
+    remove_files_from_cache(files_to_remove)
 
-    return cache_available_size >= space_need
+    for file_to_remove in files_to_remove:
+        if os.path.exists(file_to_remove):
+            delete_path(file_to_remove)
 
 
 def _s3_file_is_equals_to_cache_file(s3_key: str, cache_filepath: str):
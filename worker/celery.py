@@ -52,6 +52,11 @@ app.conf.beat_schedule = {
         "schedule": 3600,
         "options": {"expires": 1799, "retry": False},
     },
+    "cleanup-s3-zips": {
+        "task": "worker.tasks.cleanup_s3_zips",
+        "schedule": 3600,
+        "options": {"expires": 1799, "retry": False},
+    },
     "process-pending-tasks": {
         "task": "worker.tasks.process_pending_tasks",
         "schedule": 5,
@@ -82,6 +87,21 @@ app.conf.beat_schedule = {
         "schedule": settings.S3_IMAGES_CACHE_KEYS_REFRESH_SECONDS,
         "options": {"expires": 2, "retry": False},
     },
+    "evict-s3-block-cache": {
+        "task": "worker.cache_files.evict_s3_block_cache",
+        "schedule": settings.S3_BLOCK_CACHE_EVICTION_SECONDS,
+        "options": {"expires": 30, "retry": False, "priority": 2},
+    },
+    "evict-tile-cache": {
+        "task": "worker.cache_files.evict_tile_cache",
+        "schedule": settings.TILE_CACHE_EVICTION_SECONDS,
+        "options": {"expires": 120, "retry": False, "priority": 2},
+    },
+    "reconcile-file-cache-size": {
+        "task": "worker.cache_files.reconcile_file_cache_size",
+        "schedule": settings.S3_CACHE_RECONCILE_SECONDS,
+        "options": {"expires": 60, "retry": False, "priority": 2},
+    },
 }
 
 
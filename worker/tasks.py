@@ -16,11 +16,11 @@ from django.db.models import Q
 from app import pending_actions
 from app.models import Profile
 from app.models import Project, Task
-from app.vendor import zipfly
-from app.utils.s3_utils import list_s3_objects, convert_task_path_to_s3
-from app.utils.file_utils import ensure_path_exists
+from app.utils.file_utils import ensure_path_exists, ensure_sep_at_end
 from app.classes.task_files_uploader import TaskFilesUploader
 from app.classes.task_assets_manager import TaskAssetsManager
+from app.classes.s3_zip_stream import S3ZipStream, zip_members
+from app.utils.s3_utils import get_s3_client, iter_s3_objects
 from nodeodm import status_codes
 from nodeodm.models import ProcessingNode
 from webodm import settings
@@ -106,6 +106,38 @@ def cleanup_tmp_directory():
             logger.info("Cleaned up: %s (%s)" % (f, modified))
 
 
+@app.task(ignore_result=True)
+def cleanup_s3_zips():
+    # Delete the zip archives uploaded to S3 that are
+    # older than 24 hours, like the ones of the tmp directory
+    s3_client = get_s3_client()
+
+    if not _uploads_zips_to_s3(s3_client):
+        return
+
+    time_limit = 60 * 60 * 24
+    now = time.time()
+    old_zips = [
+        {"Key": s3_object["Key"]}
+        for s3_object in iter_s3_objects(
+            ensure_sep_at_end(settings.S3_ZIP_UPLOAD_PREFIX),
+            s3_client,
+            settings.S3_BUCKET,
+        )
+        if s3_object["LastModified"].timestamp() < now - time_limit
+    ]
+
+    # Up to 1000 keys per request
+    for i in range(0, len(old_zips), 1000):
+        s3_client.delete_objects(
+            Bucket=settings.S3_BUCKET,
+            Delete={"Objects": old_zips[i : i + 1000], "Quiet": True},
+        )
+
+    if old_zips:
+        logger.info(f"Cleaned up {len(old_zips)} zips from S3")
+
+
 # Based on https://stackoverflow.com/questions/22498038/improve-current-implementation-of-a-setinterval-python/22498708#22498708
 def setInterval(interval, func, *args):
     stopped = Event()
@@ -223,6 +255,28 @@ def manage_processing_nodes():
     ProcessingNodesManager(logger).improve_processing_nodes_performance()
 
 
+def _progress_reporter(task, min_interval=1.0):
+    """
+    Callback reporting the progress (0 to 1) of a bound task in its state,
+    at most every min_interval seconds
+    """
+    last_update = 0
+
+    def report(progress):
+        nonlocal last_update
+        now = time.time()
+
+        if settings.TESTING or (now - last_update < min_interval and progress < 1):
+            return
+
+        last_update = now
+        task.update_state(
+            state="PROGRESS", meta={"progress": round(progress * 100, 1)}
+        )
+
+    return report
+
+
 @app.task(bind=True)
 def export_raster(self, input, **opts):
     try:
@@ -235,7 +289,9 @@ def export_raster(self, input, **opts):
             ),
             dir=settings.MEDIA_TMP,
         )
-        export_raster_sync(input, tmpfile, **opts)
+        export_raster_sync(
+            input, tmpfile, progress_callback=_progress_reporter(self), **opts
+        )
         result = {"file": tmpfile}
 
         if settings.TESTING:
@@ -451,40 +507,27 @@ def clear_old_tasks_from_files_db():
 
 def _generate_zip_from_dir(task, zip_dir, exclude_files=tuple([])):
     try:
-        tmpfile = tempfile.mktemp(".zip", dir=settings.MEDIA_TMP)
+        members = zip_members(task, zip_dir, exclude_files)
+        if len(members) == 0:
+            raise FileNotFoundError("No files available for download")
 
-        s3_dir = convert_task_path_to_s3(zip_dir)
+        logger.info(f"creating zip of {zip_dir} with {len(members)} files")
+        zip_stream = S3ZipStream(members)
 
-        s3_objects = list_s3_objects(s3_dir)
-        s3_keys = [s3_object["Key"] for s3_object in s3_objects]
+        if _uploads_zips_to_s3(get_s3_client()):
+            s3_prefix = ensure_sep_at_end(settings.S3_ZIP_UPLOAD_PREFIX)
+            s3_key = f"{s3_prefix}{uuid.uuid4()}.zip"
 
-        logger.info(f"Found these files to add in zip: {s3_keys}")
-        task_assets_manager = TaskAssetsManager(task)
-        for s3_key in s3_keys:
-            local_path = os.path.join(settings.MEDIA_ROOT, s3_key)
-            task_assets_manager.download_asset_to_temp(local_path)
-
-        logger.info("downloaded all files")
-        paths = [
-            {
-                "n": os.path.relpath(os.path.join(dp, f), zip_dir),
-                "fs": os.path.join(dp, f),
-            }
-            for dp, dn, filenames in os.walk(zip_dir)
-            for f in filenames
-        ]
-        if isinstance(exclude_files, tuple):
-            paths = [p for p in paths if os.path.basename(p["fs"]) not in exclude_files]
-        if len(paths) == 0:
-            raise FileNotFoundError("No files available for download")
+            logger.info(f"uploading zip to {s3_key}")
+            zip_stream.upload(settings.S3_BUCKET, s3_key)
 
-        logger.info(f"creating zip with {paths}")
-        zip_stream = zipfly.ZipStream(paths)
+            return {"s3_file": f"s3://{settings.S3_BUCKET}/{s3_key}"}
+
+        tmpfile = tempfile.mktemp(".zip", dir=settings.MEDIA_TMP)
 
         logger.info(f"writing zip in {tmpfile}")
         with open(tmpfile, "wb") as zip_file:
-            zip_stream.lazy_load(1024)
-            for zip_data in zip_stream.generator:
+            for zip_data in zip_stream:
                 zip_file.write(zip_data)
 
         result = {"file": tmpfile}
@@ -496,6 +539,10 @@ def _generate_zip_from_dir(task, zip_dir, exclude_files=tuple([])):
         return {"error": str(e)}
 
 
+def _uploads_zips_to_s3(s3_client):
+    return bool(settings.S3_ZIP_UPLOAD_PREFIX and settings.S3_BUCKET and s3_client)
+
+
 def _create_upload_heartbeat(task_id: str):
     return redis_file_cache.create_heartbeat(
         f"upload_file_for_task_{task_id}", settings.UPLOADING_HEARTBEAT_INTERVAL_SECONDS
@@ -0,0 +1,194 @@
+import logging
+
+from webodm import settings
+
+logger = logging.getLogger("app.logger")
+
+COG_EXTENSIONS = (".tif", ".tiff")
+
+
+class CacheEntry:
+    def __init__(self, file: str, accessed_at: float, size: int, hits: int = 0):
+        self.file = file
+        self.accessed_at = accessed_at
+        self.size = size
+        self.hits = hits
+
+
+class EvictionPolicy:
+    """
+    Orders cache entries for eviction: entries with the lowest priority are
+    evicted first and pinned entries are never evicted.
+    """
+
+    name = None
+
+    def priority(self, entry: CacheEntry):
+        raise NotImplementedError
+
+    def pinned(self, entries: list[CacheEntry], pinned_size: int = 0) -> set[str]:
+        """
+        Files of the entries never to evict, given the bytes already pinned in
+        the previous samples of the same eviction
+        """
+        return set()
+
+    def select(
+        self, entries: list[CacheEntry], bytes_to_free: int, pinned: set[str] = None
+    ):
+        if pinned is None:
+            pinned = self.pinned(entries)
+
+        candidates = sorted(
+            [entry for entry in entries if entry.file not in pinned],
+            key=self.priority,
+        )
+
+        selected = []
+        freed = 0
+
+        for entry in candidates:
+            if freed >= bytes_to_free:
+                break
+
+            selected.append(entry)
+            freed += entry.size
+
+        return selected
+
+
+class LruEvictionPolicy(EvictionPolicy):
+    """
+    Least recently accessed files go first
+    """
+
+    name = "lru"
+
+    def priority(self, entry: CacheEntry):
+        return entry.accessed_at
+
+
+class GdsfEvictionPolicy(EvictionPolicy):
+    """
+    Greedy-Dual-Size-Frequency: files with the fewest hits per byte go first,
+    so one large and rarely viewed raster is evicted before many small and
+    frequently used files. Aging comes from ranking only the least recently
+    used sample of the cache and from hit counts being halved periodically.
+    """
+
+    name = "gdsf"
+
+    def priority(self, entry: CacheEntry):
+        return ((entry.hits + 1) / max(entry.size, 1), entry.accessed_at)
+
+
+class PinHotCogsEvictionPolicy(GdsfEvictionPolicy):
+    """
+    GDSF that never evicts hot COG rasters (the files tiles, and their
+    overviews, are read from), up to a share of the cache size for the whole
+    cache (not for each sample).
+    """
+
+    name = "pin_hot_cogs"
+
+    def __init__(self, min_hits: int, max_pinned_size: int):
+        self.min_hits = min_hits
+        self.max_pinned_size = max_pinned_size
+
+    def pinned(self, entries: list[CacheEntry], pinned_size: int = 0) -> set[str]:
+        hot_cogs = sorted(
+            [
+                entry
+                for entry in entries
+                if entry.hits >= self.min_hits
+                and entry.file.lower().endswith(COG_EXTENSIONS)
+            ],
+            key=lambda entry: entry.hits,
+            reverse=True,
+        )
+
+        pinned = set()
+
+        for entry in hot_cogs:
+            if pinned_size + entry.size > self.max_pinned_size:
+                continue
+
+            pinned.add(entry.file)
+            pinned_size += entry.size
+
+        return pinned
+
+
+def get_eviction_policy(name: str = None, max_cache_size: int = None):
+    name = name or settings.S3_CACHE_EVICTION_POLICY
+
+    if name == GdsfEvictionPolicy.name:
+        return GdsfEvictionPolicy()
+
+    if name == PinHotCogsEvictionPolicy.name:
+        if max_cache_size is None:
+            max_cache_size = settings.S3_CACHE_MAX_SIZE_MB * 1024 * 1024
+
+        return PinHotCogsEvictionPolicy(
+            settings.S3_CACHE_PIN_MIN_HITS,
+            max_cache_size * settings.S3_CACHE_PIN_MAX_PERCENT // 100,
+        )
+
+    if name != LruEvictionPolicy.name:
+        logger.warning(f"Unknown cache eviction policy {name}, using lru")
+
+    return LruEvictionPolicy()
+
+
+def get_eviction_target_size(max_cache_size: int, space_need: int):
+    """
+    Cache size to evict down to before admitting space_need bytes. Evicting
+    to the low-water mark leaves room for the next admissions, so evictions
+    happen in batches instead of on every admission.
+    """
+    low_water_size = (
+        max_cache_size * settings.S3_CACHE_EVICTION_LOW_WATER_PERCENT // 100
+    )
+
+    return max(0, low_water_size - space_need)
+
+
+def evict(
+    policy: EvictionPolicy,
+    load_entries,
+    remove_entries,
+    bytes_to_free: int,
+    sample_size: int = None,
+):
+    """
+    Evict at least bytes_to_free bytes, when possible.
+
+    load_entries(start, count) returns a page of CacheEntry ordered by last
+    access, oldest first, and remove_entries(entries) evicts them. The policy
+    ranks one page (a sample of the least recently used files) at a time; the
+    files it pins count against one budget for all the pages.
+    """
+    sample_size = sample_size or settings.S3_CACHE_EVICTION_SAMPLE_SIZE
+    freed = 0
+    start = 0
+    pinned_size = 0
+
+    while freed < bytes_to_free:
+        entries = load_entries(start, sample_size)
+
+        if len(entries) == 0:
+            break
+
+        pinned = policy.pinned(entries, pinned_size)
+        pinned_size += sum(entry.size for entry in entries if entry.file in pinned)
+
+        selected = policy.select(entries, bytes_to_free - freed, pinned)
+
+        if len(selected) > 0:
+            remove_entries(selected)
+            freed += sum(entry.size for entry in selected)
+
+        # Entries kept by the policy stay at the head of the index, skip them
+        start += len(entries) - len(selected)
+
+    return freed
@@ -1,87 +1,381 @@
+import atexit
 import json
+import logging
 import os
 import threading
+import time
 
 
 from django.core.cache import caches
+from django_redis import get_redis_connection
 
 from webodm import settings
 from time import sleep
 from contextlib import contextmanager
-from app.utils import file_utils
 
-cache_files_queue_key = "s3_cache_files_queue"
+cache_files_index_key = "s3_cache_files_index"
+cache_files_sizes_key = "s3_cache_files_sizes"
+cache_files_total_size_key = "s3_cache_files_total_size"
+cache_files_hits_key = "s3_cache_files_hits"
+cache_files_reserved_key = "s3_cache_files_reserved"
 cache_files_lock_key = "s3_cache_files_lock"
 
+logger = logging.getLogger("app.logger")
+
+_pending_accesses: dict[str, list] = {}
+_pending_accesses_lock = threading.Lock()
+_access_flusher_pid = None
+
+
+# Cache index:
+#  - a sorted set of cached file paths scored by their last access time
+#  - a hash of cached file path -> size in bytes
+#  - a running total of the sizes in the hash, so reading the cache size is O(1)
+#  - a hash of cached file path -> hit count, used by frequency aware eviction
+#  - a hash of file path -> "size reserved_at" of the files being added, their
+#    bytes are in the running total from the moment they are admitted
+# All mutations run as lua scripts, so they are atomic without a global lock
+ADD_FILES_SCRIPT = """
+local added = 0
+local delta = 0
+for i = 1, #ARGV - 1, 4 do
+    local file = ARGV[i]
+    if redis.call('ZADD', KEYS[1], ARGV[i + 1], file) == 1 then
+        added = added + 1
+    end
+    local previous = tonumber(redis.call('HGET', KEYS[2], file) or 0)
+    redis.call('HSET', KEYS[2], file, ARGV[i + 2])
+    delta = delta + tonumber(ARGV[i + 2]) - previous
+    local reserved = redis.call('HGET', KEYS[5], file)
+    if reserved then
+        redis.call('HDEL', KEYS[5], file)
+        delta = delta - tonumber(string.match(reserved, '^%S+'))
+    end
+    if tonumber(ARGV[i + 3]) > 0 then
+        redis.call('HINCRBY', KEYS[4], file, ARGV[i + 3])
+    end
+end
+redis.call('INCRBY', KEYS[3], delta)
+for i = 1, #KEYS do
+    redis.call('EXPIRE', KEYS[i], ARGV[#ARGV])
+end
+return added
+"""
+
+REMOVE_FILES_SCRIPT = """
+local removed = 0
+local delta = 0
+for i = 1, #ARGV do
+    if redis.call('ZREM', KEYS[1], ARGV[i]) == 1 then
+        removed = removed + 1
+    end
+    redis.call('HDEL', KEYS[4], ARGV[i])
+    local previous = redis.call('HGET', KEYS[2], ARGV[i])
+    if previous then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        delta = delta + tonumber(previous)
+    end
+end
+if delta > 0 then
+    redis.call('DECRBY', KEYS[3], delta)
+end
+return removed
+"""
+
+# Adds the bytes of a file to the running total before it is written, unless
+# the cache would grow over the limit. A reservation left by a previous attempt
+# is replaced. Returns -1 when there is no running total to check against.
+RESERVE_SCRIPT = """
+local total = redis.call('GET', KEYS[3])
+if not total then
+    return -1
+end
+total = tonumber(total)
+local previous = redis.call('HGET', KEYS[5], ARGV[1])
+if previous then
+    redis.call('HDEL', KEYS[5], ARGV[1])
+    local previous_size = tonumber(string.match(previous, '^%S+'))
+    redis.call('DECRBY', KEYS[3], previous_size)
+    total = total - previous_size
+end
+if total + tonumber(ARGV[2]) > tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('HSET', KEYS[5], ARGV[1], ARGV[2] .. ' ' .. ARGV[4])
+redis.call('INCRBY', KEYS[3], ARGV[2])
+redis.call('EXPIRE', KEYS[5], ARGV[5])
+return 1
+"""
+
+RELEASE_SCRIPT = """
+local reserved = redis.call('HGET', KEYS[5], ARGV[1])
+if not reserved then
+    return 0
+end
+redis.call('HDEL', KEYS[5], ARGV[1])
+redis.call('DECRBY', KEYS[3], tonumber(string.match(reserved, '^%S+')))
+return 1
+"""
+
+# Rebuilds the running total from the sizes hash and the reservations, dropping
+# sizes of files that are no longer indexed and reservations older than
+# ARGV[2] (of workers that died). Hit counts are halved, so old popularity fades.
+RECONCILE_SIZE_SCRIPT = """
+local total = 0
+local sizes = redis.call('HGETALL', KEYS[2])
+for i = 1, #sizes, 2 do
+    if redis.call('ZSCORE', KEYS[1], sizes[i]) then
+        total = total + tonumber(sizes[i + 1])
+    else
+        redis.call('HDEL', KEYS[2], sizes[i])
+    end
+end
+local reservations = redis.call('HGETALL', KEYS[5])
+for i = 1, #reservations, 2 do
+    local size, reserved_at = string.match(reservations[i + 1], '^(%S+) (%S+)$')
+    if tonumber(reserved_at) < tonumber(ARGV[2]) then
+        redis.call('HDEL', KEYS[5], reservations[i])
+    else
+        total = total + tonumber(size)
+    end
+end
+local hits = redis.call('HGETALL', KEYS[4])
+for i = 1, #hits, 2 do
+    local decayed = math.floor(tonumber(hits[i + 1]) / 2)
+    if decayed > 0 and redis.call('ZSCORE', KEYS[1], hits[i]) then
+        redis.call('HSET', KEYS[4], hits[i], decayed)
+    else
+        redis.call('HDEL', KEYS[4], hits[i])
+    end
+end
+local previous = tonumber(redis.call('GET', KEYS[3]) or 0)
+redis.call('SET', KEYS[3], total)
+redis.call('EXPIRE', KEYS[3], ARGV[1])
+return {total, previous}
+"""
+
+_index_keys = [
+    cache_files_index_key,
+    cache_files_sizes_key,
+    cache_files_total_size_key,
+    cache_files_hits_key,
+    cache_files_reserved_key,
+]
+
+# Reservations of files not added after this long are dropped by the reconcile
+CACHE_RESERVATION_TIMEOUT_SECONDS = 3600
+
+_scripts = {}
+
+
+def get_files_in_cache() -> list[str]:
+    return [
+        _decode(file)
+        for file in _get_redis_client().zrevrange(cache_files_index_key, 0, -1)
+    ]
+
+
+def has_file_in_cache(file: str):
+    return _get_redis_client().zscore(cache_files_index_key, file) is not None
 
-def set_files_in_cache(files: list[str]):
-    redis_cache = _get_redis_cache()
 
-    files_cache_str = json.dumps(files)
-    redis_cache.set(
-        cache_files_queue_key,
-        files_cache_str,
-        timeout=settings.S3_IMAGES_CACHE_KEYS_REFRESH_SECONDS + 1,
+def update_file_in_cache(file: str, size: int = None):
+    update_files_in_cache(
+        {file: time.time()}, {file: size} if size else None, {file: 1}
     )
 
+    return file
 
-def get_files_in_cache() -> list[str]:
-    redis_cache = _get_redis_cache()
 
-    files_in_cache = redis_cache.get(cache_files_queue_key)
+def update_files_in_cache(
+    accesses: dict[str, float],
+    sizes: dict[str, int] = None,
+    hits: dict[str, int] = None,
+):
+    """
+    Mark files as accessed at the given timestamps, adding them to the cache
+    index if needed. Sizes not provided are read from disk, hits not provided
+    leave the hit count untouched.
+    """
+    if len(accesses) == 0:
+        return 0
+
+    sizes = sizes or {}
+    hits = hits or {}
+    args = []
+
+    for file, accessed_at in accesses.items():
+        size = sizes.get(file)
+
+        if size is None:
+            try:
+                size = os.stat(file).st_size
+            except OSError:
+                continue
+
+        args += [file, accessed_at, size, hits.get(file, 0)]
+
+    if len(args) == 0:
+        return 0
+
+    if settings.S3_CACHE_ACCESS_TRACE_FILE and len(hits) > 0:
+        _write_access_trace(args)
+
+    return _run_script(ADD_FILES_SCRIPT, _index_keys, args + [_index_ttl()])
+
+
+def get_oldest_files_in_cache(count: int) -> list[tuple[str, int]]:
+    """
+    Least recently accessed files and their sizes, oldest first
+    """
+    return [(file, size) for file, _, size, _ in get_cache_entries(0, count)]
+
 
-    if not files_in_cache:
+def get_cache_entries(start: int, count: int) -> list[tuple[str, float, int, int]]:
+    """
+    A page of (file, last access time, size, hits) entries, oldest access first
+    """
+    redis_client = _get_redis_client()
+    entries = redis_client.zrange(
+        cache_files_index_key, start, start + count - 1, withscores=True
+    )
+
+    if len(entries) == 0:
         return []
 
-    return json.loads(files_in_cache)
+    files = [_decode(file) for file, _ in entries]
+    sizes = redis_client.hmget(cache_files_sizes_key, files)
+    hits = redis_client.hmget(cache_files_hits_key, files)
 
+    return [
+        (file, accessed_at, int(size or 0), int(file_hits or 0))
+        for file, (_, accessed_at), size, file_hits in zip(files, entries, sizes, hits)
+    ]
 
-def has_file_in_cache(file: str):
-    files = get_files_in_cache()
-    return file in files
 
+def record_file_access(file: str):
+    """
+    Remember that a cached file was read. Accesses are kept in memory and
+    written to redis in batches by a background thread, so the request path
+    never talks to the broker.
+    """
+    with _pending_accesses_lock:
+        access = _pending_accesses.get(file)
+
+        if access is None:
+            _pending_accesses[file] = [time.time(), 1]
+        else:
+            access[0] = time.time()
+            access[1] += 1
+
+        _ensure_access_flusher()
+
+
+def flush_file_accesses():
+    with _pending_accesses_lock:
+        accesses = dict(_pending_accesses)
+        _pending_accesses.clear()
+
+    sizes = {}
+
+    for file in accesses:
+        try:
+            sizes[file] = os.stat(file).st_size
+        except OSError:
+            continue
+
+    if len(sizes) == 0:
+        return 0
+
+    update_files_in_cache(
+        {file: accesses[file][0] for file in sizes},
+        sizes,
+        {file: accesses[file][1] for file in sizes},
+    )
+
+    return len(sizes)
+
+
+def _ensure_access_flusher():
+    global _access_flusher_pid
+
+    # Threads do not survive a fork, start one per process
+    current_pid = os.getpid()
 
-def update_file_in_cache(file: str):
-    files_in_cache = get_files_in_cache()
+    if _access_flusher_pid == current_pid:
+        return
 
-    if file in files_in_cache:
-        files_without_new = [f for f in files_in_cache if f != file]
-        new_cache = [file] + files_without_new
-    else:
-        new_cache = [file] + files_in_cache
+    _access_flusher_pid = current_pid
 
-    set_files_in_cache(new_cache)
+    def flush_loop():
+        while True:
+            sleep(settings.S3_CACHE_ACCESS_FLUSH_SECONDS)
+
+            try:
+                flush_file_accesses()
+            except Exception as e:
+                logger.warning(f"Failed to flush cache accesses. Original error: {e}")
 
-    return new_cache
+    thread = threading.Thread(target=flush_loop, daemon=True)
+    thread.start()
 
 
 def remove_file_from_cache(file: str):
-    files_in_cache = get_files_in_cache()
-    cache_without_file = [f for f in files_in_cache if f != file]
+    return remove_files_from_cache([file])
+
+
+def remove_files_from_cache(files: list[str]):
+    if len(files) == 0:
+        return 0
 
-    set_files_in_cache(cache_without_file)
+    return _run_script(REMOVE_FILES_SCRIPT, _index_keys, files)
 
 
 def get_current_cache_size():
-    current_size = 0
+    total = _get_redis_client().get(cache_files_total_size_key)
 
-    for filepath in get_files_in_cache():
-        try:
-            file_stat = os.stat(filepath)
-            current_size += file_stat.st_size
-        except OSError:
-            import logging
+    if total is None:
+        return reconcile_cache_size()[0]
+
+    return max(0, int(total))
 
-            logging.getLogger().warning(
-                f"Failed to get size of {filepath}, removing from cache..."
-            )
 
-            remove_file_from_cache(filepath)
+def reconcile_cache_size():
+    """
+    Recompute the running cache size from the per file sizes.
+    Returns the reconciled size and the size it replaced.
+    """
+    total, previous = _run_script(
+        RECONCILE_SIZE_SCRIPT,
+        _index_keys,
+        [_index_ttl(), time.time() - CACHE_RESERVATION_TIMEOUT_SECONDS],
+    )
+
+    return int(total), int(previous)
 
-            if os.path.exists(filepath):
-                file_utils.delete_path(filepath)
 
-    return current_size
+def reserve_cache_space(file: str, size: int, max_size: int):
+    """
+    Count the size of a file about to be added to the cache in the running
+    total, unless the cache would grow over max_size. Concurrent admissions
+    cannot overshoot the limit. Adding the file (update_file_in_cache) turns
+    the reservation into its size, release_cache_space drops it.
+    """
+    args = [file, size, max_size, time.time(), _index_ttl()]
+    reserved = _run_script(RESERVE_SCRIPT, _index_keys, args)
+
+    if reserved < 0:
+        reconcile_cache_size()
+        reserved = _run_script(RESERVE_SCRIPT, _index_keys, args)
+
+    return reserved == 1
+
+
+def release_cache_space(file: str):
+    """
+    Drop the reservation of a file that could not be added to the cache
+    """
+    return _run_script(RELEASE_SCRIPT, _index_keys, [file]) == 1
 
 
 def get_max_cache_size():
@@ -89,18 +383,18 @@ def get_max_cache_size():
 
 
 def get_files_with_old_accessed_first():
-    all_files = get_files_in_cache()
-    last_index = len(all_files) - 1
-
-    return [all_files[last_index - i] for i in range(last_index + 1)]
+    return [
+        _decode(file)
+        for file in _get_redis_client().zrange(cache_files_index_key, 0, -1)
+    ]
 
 
 def refresh_cache():
-    redis_cache = _get_redis_cache()
+    redis_client = _get_redis_client()
+    ttl = _index_ttl()
 
-    redis_cache.touch(
-        cache_files_queue_key, timeout=settings.S3_IMAGES_CACHE_KEYS_REFRESH_SECONDS + 1
-    )
+    for key in _index_keys:
+        redis_client.expire(key, ttl)
 
 
 @contextmanager
@@ -125,6 +419,10 @@ def s3_cache_lock(timeout=10):
     return cache_lock(cache_files_lock_key, timeout)
 
 
+def s3_cache_file_lock(file: str, timeout=10):
+    return cache_lock(f"{cache_files_lock_key}_{file}", timeout)
+
+
 def create_heartbeat(key: str, interval=10):
     redis_cache = _get_redis_cache()
     redis_key = f"heartbeat:{key}"
@@ -153,5 +451,57 @@ def remove_heartbeat(key: str):
     redis_cache.delete(redis_key)
 
 
+@atexit.register
+def _flush_file_accesses_on_exit():
+    if len(_pending_accesses) == 0:
+        return
+
+    try:
+        flush_file_accesses()
+    except Exception:
+        pass
+
+
+def _write_access_trace(args: list):
+    # JSON lines of file accesses, replayed by the benchmark_cache_eviction command
+    try:
+        with open(settings.S3_CACHE_ACCESS_TRACE_FILE, "a") as f:
+            for i in range(0, len(args), 4):
+                file, accessed_at, size, hits = args[i : i + 4]
+
+                if hits > 0:
+                    entry = {
+                        "ts": accessed_at,
+                        "file": file,
+                        "size": size,
+                        "hits": hits,
+                    }
+                    f.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        logger.warning(f"Failed to write cache access trace. Original error: {e}")
+
+
+def _index_ttl():
+    return settings.S3_IMAGES_CACHE_KEYS_REFRESH_SECONDS + 1
+
+
+def _run_script(source: str, keys: list[str], args: list):
+    script = _scripts.get(source)
+
+    if script is None:
+        script = _get_redis_client().register_script(source)
+        _scripts[source] = script
+
+    return script(keys=keys, args=args)
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _get_redis_client():
+    return get_redis_connection("s3_images_cache")
+
+
 def _get_redis_cache():
     return caches["s3_images_cache"]